@@ -3,6 +3,10 @@
 # client.pl: sample client for mediafileinfo.py --pipe in Perl
 # by pts@fazekas.hu at Thu Jul 15 01:24:54 CEST 2021
 #
+# This client uses protocol v2 (see README.txt): all requests are queued at
+# once, and responses are printed in the order they arrive, which may differ
+# from the request order.
+#
 
 use integer;
 use strict;
@@ -13,13 +17,22 @@ $| = 1;  # Autoflush stdout.
 my($in, $out) = ("", "");
 # TODO(pts): How to set up binmode on Windows?
 my $h = start(["./mediafileinfo.py", "--pipe"], \$in, \$out) or die("start");
-for my $filename (@ARGV) {  # Treat each command-line argument as a filename.
-  $in = "$filename\n";
-  while (length($in)) { pump $h or die("pump in"); }  # Send request.
-  # Wait for and receive response.
+# Send handshake and requests. pump sends them while we wait for responses.
+$in = "!v2 max_in_flight=16\n";
+for my $i (0 .. $#ARGV) {  # Treat each command-line argument as a filename.
+  $in .= "$i $ARGV[$i]\n";
+}
+sub read_response() {
   while ($out !~ /\n/) { pump $h or die("pump out"); }
-  die if $out !~ s/^([^\n]+)\n\Z(?!\n)//;
-  my $response = $1;
+  die if $out !~ s/^([^\n]*)\n//;
+  return $1;
+}
+my $response = read_response();
+$response =~ /^!v2 / or die("handshake response: $response\n");
+for (@ARGV) {
+  $response = read_response();  # Wait for and receive next response.
+  $response =~ s/^(\d+) // or die("response id: $response\n");
+  my $filename = $ARGV[$1];
   $response =~ /^format=/ or die("response prefix: $response\n");
   $response =~ s/ f=\Q$filename\E$// or die("response suffix: $response\n");
   my $h = {map { split(/=/, $_, 2) } split(/ /, $response)};  # Parse response.
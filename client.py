@@ -6,37 +6,92 @@
 # Most of the complexity (e.g. lots of .encode(...) calls) below is caused by
 # maintaining compatibility with Python 2 and 3.
 #
+# This client uses protocol v2 (see README.txt): requests are sent by a
+# separate thread without waiting for responses, and responses are printed
+# in the order they arrive, which may differ from the request order.
+#
+
+import socket, subprocess, sys, threading
 
-import subprocess, sys
+import mediafileinfo_lines
 
 bytes_type = type(''.encode('ascii'))
 nlb = '\n'.encode('ascii')
+spb = ' '.encode('ascii')
 prefixb = 'format='.encode('ascii')
 spfb = ' f='.encode('ascii')
-p = subprocess.Popen(('./mediafileinfo.py', '--pipe'),
-                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-try:
-  # Treat each command-line argument as a filename.
-  for filename in sys.argv[1:]:
-    filenameb = filename
-    if not isinstance(filename, bytes_type):
-      filenameb = filename.encode(sys.getfilesystemencoding())
-    p.stdin.write(filenameb + nlb)  # Send request.
-    p.stdin.flush()
-    response = p.stdout.readline()  # Wait for and receive response.
-    assert response.endswith(nlb), 'incomplete response'
-    assert response.startswith(prefixb), 'response prefix: %r' % response
-    suffixb = spfb + filenameb + nlb
-    assert response.endswith(suffixb), 'response suffix: %r' % response
-    response = response[:-len(suffixb)]
-    if not isinstance(response, type('')):
-      response = response.decode('ascii')
-    h = dict(e.split('=', 1) for e in response.split(' '))  # Parse response.
-    h['f'] = filename
-    print(repr(h))  # Pretty-print parsed response to an STDOUT line.
-    sys.stdout.flush()
-finally:
-  p.stdin.close()
-  exit_code = p.wait()
-if exit_code:
-  raise RuntimeError('server failed')
+argv = sys.argv[1:]
+socket_path = None
+if argv and argv[0].startswith('--socket='):
+  # Connect to a running `mediafileinfo.py --daemon=...' instead.
+  socket_path = argv.pop(0).split('=', 1)[1]
+filenamebs = []
+for filename in argv:  # Treat each command-line argument as a filename.
+  if not isinstance(filename, bytes_type):
+    filenamebs.append(filename.encode(sys.getfilesystemencoding()))
+  else:
+    filenamebs.append(filename)
+
+
+def send_requests(wf, sock, request_ids):
+  try:
+    wf.write('!v2 max_in_flight=16'.encode('ascii') + nlb)  # Handshake.
+    for i in request_ids:  # Send all requests, don't wait.
+      wf.write(str(i).encode('ascii') + spb + filenamebs[i] + nlb)
+  finally:
+    wf.close()
+    if sock is not None:
+      sock.shutdown(socket.SHUT_WR)  # Indicate EOF to the daemon.
+
+
+request_ids = list(range(len(filenamebs)))  # Requests without a response.
+while 1:
+  if socket_path is None:
+    p = subprocess.Popen(('./mediafileinfo.py', '--pipe'),
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    sock, wf, rf = None, p.stdin, p.stdout
+  else:
+    p = None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    wf, rf = sock.makefile('wb'), sock.makefile('rb')
+  done_ids = set()
+  sender = threading.Thread(target=send_requests, args=(wf, sock, request_ids))
+  try:
+    sender.start()
+    response = rf.readline()
+    assert response.startswith('!v2 '.encode('ascii')), (
+        'handshake response: %r' % response)
+    for _ in range(len(request_ids)):
+      response = rf.readline()  # Wait for and receive next response.
+      if not response and p is None:
+        break  # The daemon has closed the connection (--max-requests=).
+      assert response.endswith(nlb), 'incomplete response'
+      request_id, response = response.split(spb, 1)
+      filename = argv[int(request_id)]
+      filenameb = filenamebs[int(request_id)]
+      assert response.startswith(prefixb), 'response prefix: %r' % response
+      suffixb = spfb + filenameb + nlb
+      assert response.endswith(suffixb), 'response suffix: %r' % response
+      response = response[:-len(suffixb)]
+      if not isinstance(response, type('')):
+        response = response.decode('ascii')
+      h = mediafileinfo_lines.parse_info_fields(response)  # Parse response.
+      h['f'] = filename
+      print(repr(h))  # Pretty-print parsed response to an STDOUT line.
+      sys.stdout.flush()
+      done_ids.add(int(request_id))
+  finally:
+    sender.join()
+    rf.close()
+    if p is None:
+      sock.close()
+      exit_code = 0
+    else:
+      exit_code = p.wait()
+  if exit_code:
+    raise RuntimeError('server failed')
+  request_ids = [i for i in request_ids if i not in done_ids]
+  if not request_ids:
+    break
+  # Reconnect, and resend the requests without a response.
@@ -3,11 +3,25 @@
 # client.rb: sample client for mediafileinfo.py --pipe in Ruby
 # by pts@fazekas.hu at Thu Jul 15 01:09:54 CEST 2021
 #
+# This client uses protocol v2 (see README.txt): requests are sent by a
+# separate thread without waiting for responses, and responses are printed
+# in the order they arrive, which may differ from the request order.
+#
 
 IO.popen ["./mediafileinfo.py", "--pipe"], "rb+" do |io|
-  ARGV.each do |filename|  # Treat each command-line argument as a filename.
-    io.puts(filename)  # Send request.
-    response = io.gets  # Wait for and receive response.
+  sender = Thread.new do
+    io.puts("!v2 max_in_flight=16")  # Handshake.
+    # Treat each command-line argument as a filename.
+    ARGV.each_with_index { |filename, i| io.puts("#{i} #{filename}") }
+    io.close_write
+  end
+  response = io.gets
+  raise "bad handshake: #{response.inspect}" if !response.start_with?("!v2 ")
+  ARGV.size.times do
+    response = io.gets  # Wait for and receive next response.
+    raise "bad id: #{response.inspect}" if response !~ /\A(\d+) /
+    filename = ARGV[$1.to_i]
+    response = response[$&.size .. -1]
     suffix = " f=#{filename.dup.force_encoding("ASCII-8BIT")}\n"
     raise "bad prefix: #{response.inspect}" if !response.start_with?("format=")
     raise "bad suffix: #{response.inspect}" if !response.end_with?(suffix)
@@ -17,4 +31,5 @@ IO.popen ["./mediafileinfo.py", "--pipe"], "rb+" do |io|
     p h  # Pretty-print parsed response to an STDOUT line.
     STDOUT.flush
   end
+  sender.join
 end
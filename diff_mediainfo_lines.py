@@ -0,0 +1,204 @@
+#! /usr/bin/python
+#
+# diff_mediainfo_lines.py: list changes between two scans (mediainfo files)
+#
+# Input: two mediainfo files (e.g. yesterday's and today's media_scan.py
+#        output), preferably sorted by filename (e.g. merge_mediainfo_lines.py
+#        output)
+# Output: change records on stdout, one per changed file, summary on stderr
+#
+# Usage:
+#
+#   diff_mediainfo_lines.py [<flag> ...] old.mfo new.mfo >changes.txt
+#
+# Flags:
+#
+#   --sort=auto: Sort the inputs by filename (externally) if needed. With
+#       --sort=false, the inputs must be sorted, with --sort=true, they are
+#       always sorted. Sorted inputs are diffed in a streaming way, using
+#       O(1) memory.
+#   --max-memory=<bytes>: Memory to use for sorting each input, default
+#       256 MiB. The rest is sorted in temporary files.
+#   --tmp-dir=<dir>: Directory for the temporary files of sorting.
+#   --keys=format,size,mtime,sha256,symlink: Keys to compare. A key missing
+#       from the old or the new info isn't a change.
+#
+# Like with media_scan.py --old=..., for multiple lines with the same
+# filename the last one counts, format=deleted (written by --watch) removes
+# the file, and lines without size= are ignored.
+#
+# Each change record looks like a mediainfo line, with the type of the
+# change (added, removed, modified or format) prepended, and then the keys
+# which have changed, and their old values, and then the new info (or the
+# old info for removed):
+#
+#   change=added format=jpeg ... f=a.jpg
+#   change=removed format=png ... f=b.png
+#   change=modified changed=mtime,sha256 old_mtime=... old_sha256=...
+#       format=jpeg ... f=c.jpg
+#   change=format changed=format,size old_format=? old_size=...
+#       format=mp4 ... f=d.mp4
+#
+
+import sys
+
+import media_scan_main
+import mediafileinfo_lines
+import merge_mediainfo_lines
+
+
+def is_sorted_file(filename):
+  """Returns whether the lines of filename are sorted by filename (f=)."""
+  get_line_filename = merge_mediainfo_lines.get_line_filename
+  f = open(filename, 'rb')
+  try:
+    prev_fn = ''
+    for line in f:
+      fn = get_line_filename(line)
+      if fn < prev_fn:
+        return False
+      prev_fn = fn
+  finally:
+    f.close()
+  return True
+
+
+def iter_checked_sorted_lines(f):
+  """Yields (filename, line) pairs of f, checks that it's sorted."""
+  get_line_filename = merge_mediainfo_lines.get_line_filename
+  prev_fn = ''
+  for line in f:
+    fn = get_line_filename(line)
+    if fn < prev_fn:
+      raise ValueError('Input not sorted by filename: %r before %r in %r '
+                       '(use --sort=true)' % (
+                       prev_fn, fn, getattr(f, 'name', '?')))
+    prev_fn = fn
+    yield fn, line
+
+
+def iter_last_infos(sorted_lines):
+  """Yields (filename, info) pairs with the current info of each file.
+
+  sorted_lines yields (filename, line) pairs sorted by filename. Lines are
+  interpreted like by add_old_files of media_scan.py.
+  """
+  get_old_item = media_scan_main.get_old_item
+  prev_fn, info = None, None
+  for fn, line in sorted_lines:
+    if fn != prev_fn:
+      if info is not None:
+        yield prev_fn, info
+      prev_fn, info = fn, None
+    info2 = mediafileinfo_lines.parse_info_line(line, do_decode=False)
+    if info2['format'] == 'deleted':  # Tombstone written by --watch.
+      info = None
+    elif get_old_item(info2) is not None:
+      info = info2
+  if info is not None:
+    yield prev_fn, info
+
+
+def iter_changes(old_infos, new_infos, keys):
+  """Yields (change, changed_keys, old_info, new_info) tuples.
+
+  old_infos and new_infos yield (filename, info) pairs sorted by filename,
+  like iter_last_infos. change is 'added', 'removed', 'modified' or
+  'format' (if format= has changed). Unchanged files are skipped.
+  """
+  old_item, new_item = next(old_infos, None), next(new_infos, None)
+  while old_item is not None or new_item is not None:
+    if new_item is None or (old_item is not None and
+                            old_item[0] < new_item[0]):
+      yield 'removed', (), old_item[1], None
+      old_item = next(old_infos, None)
+    elif old_item is None or new_item[0] < old_item[0]:
+      yield 'added', (), None, new_item[1]
+      new_item = next(new_infos, None)
+    else:
+      old_info, new_info = old_item[1], new_item[1]
+      changed_keys = [key for key in keys if key in old_info and
+                      key in new_info and old_info[key] != new_info[key]]
+      if changed_keys:
+        if 'format' in changed_keys:
+          change = 'format'
+        else:
+          change = 'modified'
+        yield change, changed_keys, old_info, new_info
+      old_item, new_item = next(old_infos, None), next(new_infos, None)
+
+
+def format_change(change, changed_keys, old_info, new_info):
+  """Returns the change record line of an iter_changes tuple."""
+  output = ['change=%s ' % change]
+  if changed_keys:
+    output.append('changed=%s ' % ','.join(changed_keys))
+    for key in changed_keys:
+      output.append('old_%s=%s ' % (key, old_info[key]))
+  output.append(mediafileinfo_lines.format_info(
+      new_info or old_info, do_encode=False))
+  return ''.join(output)
+
+
+def main(argv):
+  do_sort, max_memory, tmp_dir = None, 256 << 20, None
+  keys = ('format', 'size', 'mtime', 'sha256', 'symlink')
+  i = 1
+  while i < len(argv):
+    arg = argv[i]
+    i += 1
+    if arg == '--':
+      break
+    if arg == '-' or not arg.startswith('-'):
+      i -= 1
+      break
+    value = arg[arg.find('=') + 1:]
+    if arg.startswith('--sort='):
+      value = value.lower()
+      if value == 'auto':
+        do_sort = None
+      else:
+        do_sort = value in ('1', 'yes', 'true', 'on')
+    elif arg.startswith('--max-memory='):
+      max_memory = int(value)
+    elif arg.startswith('--tmp-dir='):
+      tmp_dir = value
+    elif arg.startswith('--keys='):
+      keys = tuple(value.split(','))
+    else:
+      sys.exit('Unknown flag: %s' % arg)
+  if len(argv) - i != 2:
+    sys.stderr.write('Usage: %s [<flag> ...] <old.mfo> <new.mfo>\n' % argv[0])
+    sys.exit(1)
+  files, iters = [], []
+  try:
+    for filename in argv[i:]:
+      if filename == '-':
+        f = sys.stdin
+      else:
+        f = open(filename, 'rb')
+      files.append(f)
+      if do_sort or (do_sort is None and (
+          f is sys.stdin or not is_sorted_file(filename))):
+        sorted_lines = merge_mediainfo_lines.iter_sorted_lines(
+            f, max_memory, tmp_dir)
+      else:
+        sorted_lines = iter_checked_sorted_lines(f)
+      iters.append(iter_last_infos(sorted_lines))
+    counts = {}
+    of = sys.stdout
+    for change, changed_keys, old_info, new_info in iter_changes(
+        iters[0], iters[1], keys):
+      of.write(format_change(change, changed_keys, old_info, new_info))
+      counts[change] = counts.get(change, 0) + 1
+  finally:
+    for f in files:
+      if f is not sys.stdin:
+        f.close()
+  print >>sys.stderr, 'info: changes: %s' % ' '.join(
+      '%s=%d' % (change, counts.get(change, 0))
+      for change in ('added', 'removed', 'modified', 'format'))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
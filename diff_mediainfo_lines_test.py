@@ -0,0 +1,119 @@
+#! /bin/sh
+
+""":" # diff_mediainfo_lines_test.py: Unit tests for diff_mediainfo_lines.py.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: diff_mediainfo_lines_test.py
+"""
+
+import cStringIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import diff_mediainfo_lines
+import merge_mediainfo_lines
+
+
+OLD_LINES = (
+    'format=jpeg mtime=5 sha256=aa size=10 f=b.jpg\n',
+    'format=png mtime=1 size=3 f=a.png\n',
+    'format=jpeg mtime=2 size=7 f=c.jpg\n',
+    'format=? mtime=1 size=1 f=d\n',
+    'format=deleted f=c.jpg\n',  # Tombstone.
+    'format=jpeg mtime=3 size=4 f=e.jpg\n',
+    'format=jpeg mtime=3 f=h.jpg\n',  # Ignored: no size=.
+)
+
+NEW_LINES = (
+    'format=gif size=5 f=g.gif\n',
+    'format=jpeg mtime=6 sha256=ab size=10 f=b.jpg\n',
+    'format=gif mtime=1 size=1 f=f.gif\n',
+    'format=png mtime=1 size=3 f=a.png\n',
+    'format=mp4 mtime=1 size=2 f=d\n',
+    'format=jpeg mtime=2 size=7 f=c.jpg\n',
+    'format=deleted f=f.gif\n',
+)
+
+EXPECTED_CHANGES = (
+    'change=modified changed=mtime,sha256 old_mtime=5 old_sha256=aa '
+    'format=jpeg mtime=6 sha256=ab size=10 f=b.jpg\n'
+    'change=added format=jpeg mtime=2 size=7 f=c.jpg\n'
+    'change=format changed=format,size old_format=? old_size=1 '
+    'format=mp4 mtime=1 size=2 f=d\n'
+    'change=removed format=jpeg mtime=3 size=4 f=e.jpg\n'
+    'change=added format=gif size=5 f=g.gif\n')
+
+
+class DiffTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='diff_mediainfo_lines_test.')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write_file(self, name, lines):
+    filename = os.path.join(self.tmp_dir, name)
+    f = open(filename, 'wb')
+    try:
+      f.writelines(lines)
+    finally:
+      f.close()
+    return filename
+
+  def run_main(self, flags, old_lines, new_lines):
+    """Runs main, returns (stdout, stderr)."""
+    argv = ['diff_mediainfo_lines.py'] + list(flags) + [
+        self.write_file('old.mfo', old_lines),
+        self.write_file('new.mfo', new_lines)]
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = cStringIO.StringIO(), cStringIO.StringIO()
+    try:
+      diff_mediainfo_lines.main(argv)
+      return sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+      sys.stdout, sys.stderr = stdout, stderr
+
+  def test_diff(self):
+    get_line_filename = merge_mediainfo_lines.get_line_filename
+    sorted_old = sorted(OLD_LINES, key=get_line_filename)  # Stable.
+    sorted_new = sorted(NEW_LINES, key=get_line_filename)
+    tmp_dir_flag = '--tmp-dir=%s' % self.tmp_dir
+    for flags, old_lines, new_lines in (
+        ((), sorted_old, sorted_new),
+        (('--sort=false',), sorted_old, sorted_new),
+        ((), OLD_LINES, NEW_LINES),  # --sort=auto.
+        ((), sorted_old, NEW_LINES),
+        (('--sort=true', '--max-memory=1', tmp_dir_flag),
+         OLD_LINES, sorted_new)):
+      self.assertEqual(
+          self.run_main(flags, old_lines, new_lines),
+          (EXPECTED_CHANGES,
+           'info: changes: added=2 removed=1 modified=1 format=1\n'))
+      self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                       ['new.mfo', 'old.mfo'])
+
+  def test_diff_unsorted(self):
+    self.assertRaises(ValueError, self.run_main, ('--sort=false',),
+                      OLD_LINES, NEW_LINES)
+
+  def test_diff_keys(self):
+    self.assertEqual(
+        self.run_main(('--keys=size',), OLD_LINES, NEW_LINES)[0],
+        'change=added format=jpeg mtime=2 size=7 f=c.jpg\n'
+        'change=modified changed=size old_size=1 '
+        'format=mp4 mtime=1 size=2 f=d\n'
+        'change=removed format=jpeg mtime=3 size=4 f=e.jpg\n'
+        'change=added format=gif size=5 f=g.gif\n')
+
+
+if __name__ == '__main__':
+  unittest.main(argv=[sys.argv[0], '-v'] + sys.argv[1:])
@@ -4,9 +4,9 @@
 """Generates standalone scripts by embedding modules.
 
 * Generates mediafileinfo.py from mediafileinfo_main.py, embedding
-  mediafileinfo_detect.py as a module.
+  mediafileinfo_detect.py (and the other modules it imports) as a module.
 * Generates media_scan.py from media_scan_main.py, embedding
-  mediafileinfo_detect.py as a module.
+  mediafileinfo_detect.py (and the other modules it imports) as a module.
 """
 
 import os
@@ -42,7 +42,8 @@ def module(f):
 def main(argv):
   if len(argv) > 1:
     sys.exit('fatal: too many command-line arguments')
-  modules_to_embed = ('mediafileinfo_detect', 'mediafileinfo_formatdb')
+  modules_to_embed = (
+      'mediafileinfo_detect', 'mediafileinfo_formatdb', 'mediafileinfo_lines')
   main_filenames = ('mediafileinfo.py', 'media_scan.py')
 
   modules = {}
@@ -0,0 +1,616 @@
+#! /bin/sh
+
+""":" # media_scan_main_test.py: Unit tests for media_scan_main.py.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+type python2.5 >/dev/null 2>&1 && exec python2.5 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.5, 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: media_scan_main_test.py
+"""
+
+import base64
+import cStringIO
+import os
+import shlex
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import media_scan_main
+import mediafileinfo_lines
+
+
+class OldFilesTest(unittest.TestCase):
+  maxDiff = None
+
+  def test_add_old_files(self):
+    old_files = {}
+    media_scan_main.add_old_files(cStringIO.StringIO(
+        'format=jpeg mtime=5 size=42 f=a/b.jpg\n'
+        'format=symlink mtime=6 size=5 symlink=b.jpg f=a/c.jpg\n'
+        'format=? mtime=7 size=3 tags=x,y f=a%20d\n'
+        'format=? mtime=7 size=3 f=gone\n'
+        'format=deleted f=gone\n'), old_files)
+    self.assertEqual(old_files, {
+        'a/b.jpg': (42, 5, None, None, False),
+        'a/c.jpg': (5, 6, '', 'b.jpg', True),
+        'a%20d': (3, 7, 'x,y', None, False)})
+
+  def test_compact_old_files(self):
+    old_files = media_scan_main.CompactOldFiles()
+    items = {
+        'a/b.jpg': (42, 5, None, None, False),
+        'a/c.jpg': (5, 6, '', 'b.jpg', True),
+        'a/d.jpg': (1 << 40, None, '', None, False),
+        'e': (0, 7, 'x,y', None, False),
+        'a//f': (3, 7, None, None, False)}
+    for i in xrange(100):
+      items['x/%d' % i] = (i, i, None, None, False)
+    for path, value in sorted(items.iteritems()):
+      old_files[path] = value
+    self.assertEqual(len(old_files), len(items))
+    for path, value in items.iteritems():
+      self.assertEqual(old_files.get(path), value)
+      self.assertTrue(path in old_files)
+    self.assertEqual(old_files.get('a/x'), None)
+    self.assertEqual(old_files.get('x/a/b.jpg'), None)
+    self.assertEqual(sorted(old_files), sorted(items))
+    old_files['e'] = (1, 2, None, None, False)
+    self.assertEqual(old_files['e'], (1, 2, None, None, False))
+    self.assertEqual(old_files.pop('a/b.jpg'), items['a/b.jpg'])
+    self.assertEqual(old_files.pop('a/b.jpg', None), None)
+    self.assertTrue('a/b.jpg' not in old_files)
+    self.assertEqual(len(old_files), len(items) - 1)
+    old_files['a/b.jpg'] = (9, 9, None, None, False)
+    self.assertEqual(old_files.get('a/b.jpg'), (9, 9, None, None, False))
+    self.assertEqual(len(old_files), len(items))
+
+
+class FormatInfoTest(unittest.TestCase):
+
+  def test_format_info(self):
+    class Tags(str):
+      pass
+    info = {'f': 'a b%.jpg', 'width': 640, 'size': 1 << 40, 'fps': 25.0,
+            'dur': 1.5, 'has_alpha': False, 'brands': ['jfif'],
+            'tags': Tags('x y,%'), 'format': 'jpeg'}
+    self.assertEqual(
+        media_scan_main.format_info(info),
+        'format=jpeg dur=1.5 fps=25 has_alpha=0 size=1099511627776 '
+        'tags=x%20y,%25 width=640 f=a b%.jpg\n')
+    self.assertEqual(media_scan_main.format_info({'codec': 'a\0\n'}),
+                     'format=? codec=a%00%0A\n')
+    self.assertRaises(ValueError, media_scan_main.format_info, {'f': 'a\nb'})
+    self.assertRaises(TypeError, media_scan_main.format_info, {'x': u'y'})
+
+
+class MultiHashTest(unittest.TestCase):
+
+  def test_retain(self):
+    multi_hash = media_scan_main.MultiHash(('sha256', 'md5'), 6)
+    buf = bytearray('cde')
+    multi_hash.update('ab')
+    multi_hash.update(buffer(buf, 0, 3))
+    buf[:] = 'xyz'  # Reused by the caller.
+    self.assertEqual(multi_hash.get_retained_data(), 'abcde')
+    multi_hash.update('f')
+    self.assertEqual(multi_hash.get_retained_data(), 'abcdef')
+    multi_hash.update('g')
+    self.assertEqual(multi_hash.get_retained_data(), None)  # Too large.
+    self.assertEqual(multi_hash.get_hexdigests(), {
+        'sha256': media_scan_main.sha256('abcdefg').hexdigest(),
+        'md5': '7ac66c0f148de9519b8bd264312c4d64'})
+    self.assertEqual(
+        media_scan_main.MultiHash(('sha256',)).get_retained_data(), None)
+
+
+class FailingHash(object):
+  def update(self, data):
+    raise ValueError('update failed')
+
+
+class ThreadedHasherTest(unittest.TestCase):
+
+  def test_hash_file(self):
+    f = tempfile.TemporaryFile()
+    try:
+      data = ''.join(chr(i & 255) * 100 for i in xrange(1000))
+      f.write(data)
+      hasher = media_scan_main.ThreadedHasher(4096, 2)
+      try:
+        f.seek(0)
+        hash_obj = media_scan_main.sha256()
+        self.assertEqual(hasher.hash_file(f, hash_obj), len(data))
+        self.assertEqual(hash_obj.hexdigest(),
+                         media_scan_main.sha256(data).hexdigest())
+        f.seek(0)
+        self.assertRaises(ValueError, hasher.hash_file, f, FailingHash())
+        f.seek(0)
+        hash_obj = media_scan_main.sha256()
+        self.assertEqual(hasher.hash_file(f, hash_obj), len(data))
+        self.assertEqual(hash_obj.hexdigest(),
+                         media_scan_main.sha256(data).hexdigest())
+      finally:
+        hasher.close()
+      self.assertEqual(hasher._thread, None)
+    finally:
+      f.close()
+
+
+class SparseHashTest(unittest.TestCase):
+  # (size, ((ofs, data), ...)) of each sparse file.
+  FILES = ((1 << 20, ((700000, 'lead' * 5000),)),  # Leading hole.
+           (3 << 19, ((0, 'trail' * 20000),)),  # Trailing hole.
+           (300000, ()),  # No data extent at all.
+           (2 << 20, ((5, 'a' * 70000), (1 << 20, 'b' * 100000))))
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='media_scan_main_test.')
+    self.filenames = []
+    for i, (size, extents) in enumerate(self.FILES):
+      filename = os.path.join(self.tmp_dir, 'sparse%d' % i)
+      f = open(filename, 'wb')
+      try:
+        for ofs, data in extents:
+          f.seek(ofs)
+          f.write(data)
+        f.truncate(size)
+      finally:
+        f.close()
+      self.filenames.append(filename)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def check_hash(self, hash_func):
+    """Checks hash_func(f, hash_obj) on each file, from 2 start offsets."""
+    for filename in self.filenames:
+      f = open(filename, 'rb')
+      try:
+        data = f.read()
+        for start_ofs in (0, 5):
+          f.seek(start_ofs)
+          hash_obj = media_scan_main.sha256()
+          self.assertEqual(hash_func(f, hash_obj), len(data) - start_ofs)
+          self.assertEqual(
+              (filename, start_ofs, hash_obj.hexdigest(), f.tell()),
+              (filename, start_ofs,
+               media_scan_main.sha256(data[start_ofs:]).hexdigest(),
+               len(data)))
+      finally:
+        f.close()
+
+  def test_hash_sparse_file_tail(self):
+    if media_scan_main.SEEK_DATA is None:
+      return
+    def hash_func(f, hash_obj):
+      result = media_scan_main.hash_sparse_file_tail(f, hash_obj, 65536)
+      if result is None:  # Filesystem without holes or SEEK_DATA.
+        return media_scan_main.hash_file_tail(f, hash_obj)
+      return result[0]
+    self.check_hash(hash_func)
+
+  def test_uncached_hasher(self):
+    try:
+      hasher = media_scan_main.UncachedHasher(65536)
+    except (ImportError, NotImplementedError):
+      return
+    self.check_hash(hasher.hash_file)
+
+  def test_hash_file_tail(self):
+    for do_sparse, do_thread, uncached_min_size in (
+        (False, False, None), (True, False, None), (False, True, None),
+        (True, True, None), (False, False, 1), (True, False, 1),
+        (False, True, 1), (True, True, 1)):
+      try:
+        hash_opts = media_scan_main.HashOptions(
+            do_thread, do_sparse=do_sparse,
+            uncached_min_size=uncached_min_size)
+      except (ImportError, NotImplementedError):
+        continue
+      try:
+        self.check_hash(lambda f, hash_obj: media_scan_main.hash_file_tail(
+            f, hash_obj, hash_opts))
+      finally:
+        hash_opts.close()
+
+
+class FakeStat(object):
+  def __init__(self, st_ino, st_nlink, st_size=3, st_mtime=5):
+    self.st_dev, self.st_ino, self.st_nlink = 1, st_ino, st_nlink
+    self.st_size, self.st_mtime, self.st_mode = st_size, st_mtime, 0100644
+
+
+class HardlinkInfoCacheTest(unittest.TestCase):
+
+  def test_get_put(self):
+    link_cache = media_scan_main.HardlinkInfoCache(4)
+    info = {'format': 'jpeg', 'width': 2, 'sha256': 'ab', 'f': 'a/b.jpg',
+            'tags': 'x', 'mtime': 5}
+    link_cache.put(FakeStat(10, 1), info, False)  # Not saved: single link.
+    self.assertEqual(link_cache.get(FakeStat(10, 1)), None)
+    link_cache.put(FakeStat(11, 3), info, False)
+    self.assertEqual(link_cache.get(FakeStat(11, 3, st_mtime=6)), None)
+    link_cache.put(FakeStat(11, 3), info, False)
+    expected = ({'format': 'jpeg', 'width': 2, 'sha256': 'ab'}, False)
+    self.assertEqual(link_cache.get(FakeStat(11, 3)), expected)
+    self.assertEqual(link_cache.get(FakeStat(11, 3)), expected)
+    self.assertEqual(link_cache.get(FakeStat(11, 3)), None)  # All links seen.
+    for st_ino in xrange(20, 25):
+      link_cache.put(FakeStat(st_ino, 2), info, True)
+    self.assertEqual(link_cache.get(FakeStat(20, 2)), None)  # Dropped.
+    self.assertEqual(link_cache.get(FakeStat(24, 2)),
+                     (expected[0], True))
+
+
+class StopWatch(Exception):
+  pass
+
+
+class FakeWatcher(object):
+  """Returns the events of the callables in changes, then stops."""
+
+  def __init__(self, changes):
+    self.changes = list(changes)
+
+  def add_tree(self, path):
+    return False
+
+  def remove_tree(self, path):
+    pass
+
+  def read_events(self, timeout):
+    if not self.changes:
+      raise StopWatch
+    return self.changes.pop(0)()
+
+
+def write_file(filename, data='x'):
+  f = open(filename, 'wb')
+  try:
+    f.write(data)
+  finally:
+    f.close()
+
+
+class WatchScanTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='media_scan_main_test.')
+    self.root = os.path.join(self.tmp_dir, 'r')
+    for path in ('', 'd1', 'd2', 'd2/sub'):
+      os.mkdir(self.get_path(path))
+    for path in ('x', 'd1/a', 'd1/b', 'd2/c', 'd2/sub/e', 'd2/sub/f'):
+      write_file(self.get_path(path))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def get_path(self, path):
+    return os.path.join(self.root, path)
+
+  def scan(self, old_files):
+    return list(media_scan_main.scan(
+        [self.root], old_files, True, False, False, True, None, None))
+
+  def test_watch_scan(self):
+    get_path = self.get_path
+    def create_and_delete():
+      write_file(get_path('d1/new'))
+      os.remove(get_path('d1/a'))
+      return [(get_path('d1/new'), media_scan_main.IN_CLOSE_WRITE),
+              (get_path('d1/a'), media_scan_main.IN_DELETE)]
+    def move_dir():
+      os.rename(get_path('d2'), get_path('d3'))
+      return [(get_path('d2'), media_scan_main.IN_MOVED_FROM |
+               media_scan_main.IN_ISDIR),
+              (get_path('d3'), media_scan_main.IN_MOVED_TO |
+               media_scan_main.IN_ISDIR)]
+    def overflow():  # The events of these changes are lost.
+      os.remove(get_path('d1/b'))
+      shutil.rmtree(get_path('d3/sub'))
+      write_file(get_path('d1/z'))
+      return [(None, media_scan_main.IN_Q_OVERFLOW)]
+    for old_files in ({}, media_scan_main.CompactOldFiles()):
+      self.tearDown()
+      self.setUp()
+      for info in self.scan(old_files):
+        old_files[info['f']] = media_scan_main.get_old_item(info)
+      outf = cStringIO.StringIO()
+      self.assertRaises(
+          StopWatch, media_scan_main.watch_scan,
+          FakeWatcher((create_and_delete, move_dir, overflow)), [self.root],
+          outf, old_files, True, False, False, True, None, 0)
+      output = []
+      for line in outf.getvalue().splitlines(True):
+        info = mediafileinfo_lines.parse_info_line(line)
+        output.append((info['format'] == 'deleted',
+                       info['f'][len(self.root) + 1:]))
+      self.assertEqual(output, [
+          (True, 'd1/a'), (False, 'd1/new'),
+          (True, 'd2/c'), (True, 'd2/sub/e'), (True, 'd2/sub/f'),
+          (False, 'd3/c'), (False, 'd3/sub/e'), (False, 'd3/sub/f'),
+          (True, 'd1/b'), (True, 'd3/sub/e'), (True, 'd3/sub/f'),
+          (False, 'd1/z')])
+      self.assertEqual(sorted(old_files), sorted(
+          info['f'] for info in self.scan({})))
+
+  def test_old_files_tree(self):
+    tree = media_scan_main.OldFilesTree(
+        ('a', 'd/b', 'd/e/f', 'd/e/g/h', 'de/i', '/j', '/k/l'))
+    tree.discard('d/e/f')
+    self.assertEqual(sorted(tree.pop_tree('d')), ['d/b', 'd/e/g/h'])
+    self.assertEqual(tree.pop_tree('d'), [])
+    self.assertEqual(tree.pop_tree('/k/'), ['/k/l'])
+    self.assertEqual(sorted(tree.pop_tree('.')), ['a', 'de/i'])
+    self.assertEqual(tree.pop_tree('/'), ['/j'])
+
+
+class FakeOutput(object):
+  def fsync(self):
+    pass
+
+
+class CheckpointTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='media_scan_main_test.')
+    self.root = os.path.join(self.tmp_dir, 'r')
+    for path in ('', 'd1', 'd1/e', 'd2', 'd3'):
+      os.mkdir(os.path.join(self.root, path))
+    for path in ('x', 'y', 'd1/a', 'd1/b', 'd1/e/c', 'd1/e/d', 'd2/f',
+                 'd2/g', 'd2/h'):
+      write_file(os.path.join(self.root, path))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def scan(self, old_files, checkpoint=None):
+    return media_scan_main.scan(
+        [self.root], old_files, True, False, False, True, None, None,
+        checkpoint)
+
+  def get_checkpoint(self):
+    return media_scan_main.ScanCheckpoint(
+        os.path.join(self.tmp_dir, 'out.checkpoint'), 0, FakeOutput(),
+        [self.root])
+
+  def test_resume(self):
+    expected = [info['f'] for info in self.scan({})]
+    self.assertEqual(len(expected), 9)
+    for stop_after in xrange(1, len(expected)):
+      checkpoint, old_files, scanned = self.get_checkpoint(), {}, []
+      scan_iter = self.scan({}, checkpoint)
+      for info in scan_iter:  # Interrupted after stop_after files.
+        old_files[info['f']] = media_scan_main.get_old_item(info)
+        scanned.append(info['f'])
+        if len(scanned) == stop_after:
+          break
+      scan_iter.close()
+      checkpoint = self.get_checkpoint()
+      checkpoint.load()
+      self.assertTrue(checkpoint.state)
+      scanned.extend(info['f'] for info in self.scan(old_files, checkpoint))
+      self.assertEqual((stop_after, scanned), (stop_after, expected))
+      checkpoint.remove()
+
+
+class ShardTest(unittest.TestCase):
+
+  def test_shards_disjoint_and_complete(self):
+    tmp_dir = tempfile.mkdtemp(prefix='media_scan_main_test.')
+    try:
+      paths = [os.path.join(tmp_dir, 'top')]
+      for a in xrange(4):
+        for b in xrange(3):
+          subdir = os.path.join(tmp_dir, 'd%d' % a, 'e%d' % b)
+          os.makedirs(os.path.join(subdir, 'g'))
+          for c in xrange(3):
+            paths.append(os.path.join(subdir, 'f%d' % c))
+            paths.append(os.path.join(subdir, 'g', 'f%d' % c))
+      for path in paths:
+        open(path, 'w').close()
+      for shard_depth in (1, 2, 3):
+        scanned = []
+        for shard_index in xrange(3):
+          scanned.extend(info['f'] for info in media_scan_main.scan(
+              [tmp_dir], {}, False, False, False, True, None, 0,
+              shard=(shard_index, 3, shard_depth)))
+        self.assertEqual(sorted(scanned), sorted(paths))
+    finally:
+      shutil.rmtree(tmp_dir)
+
+
+# A fake `gm' command for testing, the fingerprint is the SHA-256 of the
+# input file. Its `gm batch' splits lines like a POSIX shell, or at
+# whitespace (ignoring quotes) if $FAKE_GM_SPLIT is set.
+FAKE_GM_SCRIPT = r'''
+import hashlib, os, shlex, sys
+def convert(args):
+  assert args[0] == 'convert' and args[-1].startswith('mono:'), args
+  if args[1].startswith('xc:'):
+    data = '\0'
+  else:
+    data = hashlib.sha256(open(args[1], 'rb').read()).digest()
+  if args[-1] == 'mono:-':
+    sys.stdout.write(data)
+  else:
+    open(args[-1][5:], 'wb').write(data)
+if sys.argv[1] == 'convert':
+  try:
+    convert(sys.argv[1:])
+  except IOError, e:
+    sys.exit('gm convert: %s' % e)
+else:
+  assert sys.argv[1] == 'batch', sys.argv
+  split = (shlex.split, str.split)[bool(os.getenv('FAKE_GM_SPLIT'))]
+  for line in iter(sys.stdin.readline, ''):
+    try:
+      convert(split(line))
+      sys.stdout.write('PASS\n')
+    except IOError, e:
+      sys.stderr.write('gm convert: %s\n' % e)
+      sys.stdout.write('FAIL\n')
+    sys.stdout.flush()
+'''
+
+
+class GmBatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='media_scan_main_test.')
+    gm_filename = os.path.join(self.tmp_dir, 'gm')
+    write_file(gm_filename, '#! %s\n%s' % (sys.executable, FAKE_GM_SCRIPT))
+    os.chmod(gm_filename, 0755)
+    self.old_environ = dict(os.environ)
+    os.environ['PATH'] = os.pathsep.join((self.tmp_dir, os.environ['PATH']))
+    os.environ.pop('FAKE_GM_SPLIT', None)
+
+  def tearDown(self):
+    media_scan_main.close_gm_batch()
+    os.environ.clear()
+    os.environ.update(self.old_environ)
+    shutil.rmtree(self.tmp_dir)
+
+  def test_quote_gm_batch_arg(self):
+    quote_gm_batch_arg = media_scan_main.quote_gm_batch_arg
+    for arg, expected in (
+        ('a/b-1.jpg', 'a/b-1.jpg'), ('160x160!', '160x160!'), ('', '""'),
+        ('a b', '"a b"'), ("it's", '"it\'s"'),
+        ('a"b\\c', '"a\\"b\\\\c"')):
+      self.assertEqual(quote_gm_batch_arg(arg), expected)
+      self.assertEqual(shlex.split(quote_gm_batch_arg(arg)), [arg])
+
+  def test_fingerprint_image_with_gm_batch(self):
+    for i, name in enumerate(('a.pgm', 'a b.pgm', 'a"b\\c.pgm', "it's")):
+      filename = os.path.join(self.tmp_dir, name)
+      write_file(filename, 'data%d' % i)
+      expected = base64.b64encode(media_scan_main.sha256(
+          'data%d' % i).digest())
+      self.assertEqual(
+          media_scan_main.fingerprint_image_with_gm_batch(filename), expected)
+      self.assertEqual(
+          media_scan_main.fingerprint_image_with_gm_convert(filename),
+          expected)
+    self.assertRaises(  # The gm batch process survives this.
+        IOError, media_scan_main.fingerprint_image_with_gm_batch,
+        os.path.join(self.tmp_dir, 'missing'))
+    self.assertEqual(
+        media_scan_main.fingerprint_image_with_gm_batch(filename), expected)
+
+  def test_is_gm_batch_available(self):
+    self.assertTrue(media_scan_main.is_gm_batch_available())
+    media_scan_main.close_gm_batch()
+    os.environ['FAKE_GM_SPLIT'] = '1'  # Breaks quoted filenames.
+    self.assertFalse(media_scan_main.is_gm_batch_available())
+    self.assertEqual(media_scan_main.gm_batch_ary, [])
+    os.environ['PATH'] = self.tmp_dir  # No gm at all.
+    os.remove(os.path.join(self.tmp_dir, 'gm'))
+    self.assertFalse(media_scan_main.is_gm_batch_available())
+
+
+def fake_fingerprint_impl(filename):
+  if filename == 'crash':
+    os._exit(1)
+  if filename == 'bad':
+    raise IOError('bad image')
+  return (filename * 44)[:43] + '='
+
+
+class FingerprintPoolTest(unittest.TestCase):
+
+  def test_submit(self):
+    fp_pool = media_scan_main.FingerprintPool(2, impl=fake_fingerprint_impl)
+    try:
+      requests = [fp_pool.submit(filename) for filename in
+                  ('a', 'crash', 'b', 'bad', 'c', 'd')]
+      output = []
+      for request in requests:
+        info = {'f': request.filename, 'xfidfp': request}
+        fp_pool.resolve_info(info)
+        output.append(info['xfidfp'][:3])
+      self.assertEqual(output, ['aaa', 'err', 'bbb', 'err', 'ccc', 'ddd'])
+    finally:
+      fp_pool.close()
+
+
+def make_jpeg(width, height):
+  """Returns a minimal JPEG file header with the specified dimensions."""
+  return ('\xff\xd8\xff\xc0' + struct.pack('>HBHH', 8, 8, height, width) +
+          '\x01\xff\xd9')
+
+
+def make_tiff_ifd(entries, next_ofs=0):
+  """Returns a little-endian TIFF IFD with (tag, value) LONG entries."""
+  return (struct.pack('<H', len(entries)) +
+          ''.join(struct.pack('<HHLL', tag, 4, 1, value)
+                  for tag, value in entries) +
+          struct.pack('<L', next_ofs))
+
+
+class FindJpegPreviewTest(unittest.TestCase):
+
+  def test_jpeg_exif_and_mpf(self):
+    thumb = make_jpeg(160, 120)  # Too small.
+    wide = make_jpeg(1000, 500)  # Bad aspect ratio.
+    large = make_jpeg(640, 480)
+    # EXIF: empty IFD0, IFD1 pointing to thumb at the end.
+    exif = ('II*\0\x08\0\0\0' + make_tiff_ifd((), 14) +
+            make_tiff_ifd(((0x201, 44), (0x202, len(thumb)))) + thumb)
+    app1 = '\xff\xe1' + struct.pack('>H', 8 + len(exif)) + 'Exif\0\0' + exif
+    main = make_jpeg(4000, 3000)
+    mpf_size = 8 + 2 + 12 + 4 + 48
+    mpf_base = 2 + len(app1) + 8
+    after_main = mpf_base + mpf_size + len(main) - 2
+    entries = ((0x030000, 100, 0), (0x010001, len(wide), after_main),
+               (0x010002, len(large), after_main + len(wide)))
+    mpf = ('II*\0\x08\0\0\0' + struct.pack('<HHHLL', 1, 0xb002, 7, 48, 26) +
+           '\0\0\0\0' + ''.join(struct.pack('<LLLHH', attr, size, ofs - mpf_base
+                                            if ofs else 0, 0, 0)
+                                for attr, size, ofs in entries))
+    app2 = '\xff\xe2' + struct.pack('>H', 6 + len(mpf)) + 'MPF\0' + mpf
+    data = '\xff\xd8' + app1 + app2 + main[2:] + wide + large
+    self.assertEqual(data[after_main : after_main + 4], '\xff\xd8\xff\xc0')
+    f = cStringIO.StringIO(data)
+    self.assertEqual(media_scan_main.find_jpeg_preview(f, 4000, 3000, 320),
+                     (after_main + len(wide), len(large)))
+    self.assertEqual(media_scan_main.find_jpeg_preview(f, 4000, 3000, 100),
+                     (2 + 4 + 6 + 44, len(thumb)))
+    self.assertEqual(media_scan_main.find_jpeg_preview(f, 4000, 3000, 641),
+                     None)
+    self.assertEqual(media_scan_main.find_jpeg_preview(f, 600, 450, 100),
+                     (2 + 4 + 6 + 44, len(thumb)))  # Not larger than main.
+
+  def test_tiff_subifd(self):
+    preview = make_jpeg(1500, 1000)
+    data = ('II*\0\x08\0\0\0' + make_tiff_ifd(((330, 26),)) +
+            make_tiff_ifd(((0x201, 56), (0x202, len(preview)))) + preview)
+    f = cStringIO.StringIO(data)
+    self.assertEqual(media_scan_main.find_jpeg_preview(f, 6000, 4000, 320),
+                     (56, len(preview)))
+    self.assertEqual(media_scan_main.find_jpeg_preview(f, 6000, 3000, 320),
+                     None)
+
+  def test_fingerprint_pool_data(self):
+    fp_pool = media_scan_main.FingerprintPool(1, impl=fake_fingerprint_impl)
+    try:
+      request = fp_pool.submit('a.jpg', make_jpeg(400, 300), 'jpeg')
+      tmp_filename = request.tmp_filename
+      self.assertTrue(os.path.isfile(tmp_filename))
+      self.assertTrue(tmp_filename.endswith('.jpeg'))
+      info = {'f': 'a.jpg', 'xfidfp': request}
+      fp_pool.resolve_info(info)
+      self.assertEqual(len(info['xfidfp']), 44)
+      self.assertFalse(os.path.exists(tmp_filename))
+    finally:
+      fp_pool.close()
+
+
+if __name__ == '__main__':
+  unittest.main(argv=[sys.argv[0], '-v'] + sys.argv[1:])
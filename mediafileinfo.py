@@ -444,7 +444,9 @@ def mediafileinfo_detect():
       'A_PCM/INT/LIT': 'pcm',
       'A_PCM/FLOAT/IEEE': 'pcm',
       'A_MPC': 'mpc',
-      'A_AC3': 'ac3',
+      'A_AC3': 'ac3',   # ATSC A/52a https://wiki.multimedia.cx/index.php/A52
+      'A_EC3': 'eac3',  # ATSC A/52b https://wiki.multimedia.cx/index.php/A52
+      'A_TRUEHD': 'truehd',
       'A_ALAC': 'alac',
       'A_DTS': 'dts',
       'A_DTS/EXPRESS': 'dts-express',
@@ -702,6 +704,11 @@ def mediafileinfo_detect():
                 raise ValueError('EOF in CodecID element.')
               data = data.rstrip('\0')  # Broken, but some mkv files have it.
               track_info['codec'] = MKV_CODEC_IDS.get(data, data)
+            elif xid == '\x63\xA2':  # CodecPrivate.
+              data = read_n(size)
+              if len(data) != size:
+                raise ValueError('EOF in CodecPrivate element.')
+              track_info['codec_private'] = data
             elif xid == '\x25\x86\x88':  # CodecName.
               data = read_n(size)
               if len(data) != size:
@@ -712,6 +719,23 @@ def mediafileinfo_detect():
               if len(data) != size:
                 raise ValueError('EOF in in-Track element.')
           if 'type' in track_info:
+            data = track_info.pop('codec_private', None)
+            if data and track_info['codec'] == 'V_MS/VFW/FOURCC':
+              dib_info = {}
+              try:
+                parse_dib_header(dib_info, data)  # Function dependency.
+              except ValueError:
+                pass
+              try:
+                codec = int(dib_info.get('codec', ''))
+              except ValueError:
+                codec = None
+              if codec:
+                # Function dependency.
+                track_info['codec'] = get_windows_video_codec(struct.pack('<L', codec))
+              for key in ('width', 'height'):
+                if key in dib_info:
+                  track_info[key] = dib_info[key]
             info['tracks'].append(track_info)
         break  #  in Segment, don't read anything beyond Tracks, they are large.
       else:
@@ -1459,6 +1483,53 @@ def mediafileinfo_detect():
         (xmax - xmin + 10) // 20, (ymax - ymin + 10) // 20)
 
 
+  # --- dv: DIF (digital interface format) DV (digital video).
+
+  def analyze_dv(fread, info, fskip, format='dv', fclass='media',
+                 spec=(0, '\x1f\7\0')):
+    # IEC 61834 (paid)
+    # https://github.com/FFmpeg/FFmpeg/blob/da5497a1a22d06d6979a888d2ded79521c428d29/libavcodec/dv_profile.c#L73-L292
+    # https://github.com/FFmpeg/FFmpeg/blob/da5497a1a22d06d6979a888d2ded79521c428d29/libavformat/dv.c#L641
+    # https://github.com/MediaArea/MediaInfoLib/blob/c567c176f5d145efeb5821b67467fba33d87354c/Source/MediaInfo/Multiple/File_DvDif.cpp
+    header = fread(80)  # Block 0.
+    if len(header) < 3:
+      raise ValueError('Too short for dv.')
+    if not header.startswith('\x1f\7\0'):
+      raise ValueError('dv signature not found.')
+    info['format'] = 'dv'
+    width = height = None
+    if len(header) == 80:
+      for _ in xrange(5):
+        data = fread(80)  # Next block.
+        # Typical first 6 prefixes: ('\x1f\7\0', '\x3f\7\0', '\x3f\7\1', '\x5f\7\0', '\x5f\7\1', '\x5f\7\2').
+        if len(data) < 80 or data.startswith('\x5f\7\2'):
+          break
+      stype = is_pal = None
+      if len(data) == 80 and data.startswith('\x5f\7\2'):
+        dsf = (ord(header[3]) & 0x80) >> 7
+        if (ord(header[3]) & 0x7f) == 0x3f and data[51] == '\xff':
+          # Created by QuickTime 3. https://trac.ffmpeg.org/ticket/217
+          stype, is_pal = 0, dsf
+        else:
+          stype, is_pal = ord(data[51]) & 0x1f, (ord(data[51]) & 0x20) >> 5
+          if dsf == is_pal and stype in (0, 1, 4, 0x14, 0x15, 0x18):
+            pass
+          else:
+            dsf = stype = is_pal = None
+      if stype is not None and is_pal is not None:
+        if stype in (0, 1, 4):
+          width, height = 720, (576, 480)[not is_pal]
+        elif stype in (0x14, 0x15):
+          width, height = (1440, 1280)[not is_pal], (1080, 1035)[stype != 0x14]
+        elif stype == 0x18:
+          width, height = 960, 720
+    info['tracks'] = []
+    if width and height:
+      video_track_info = {'type': 'video', 'codec': 'dv', 'width': width, 'height': height}
+      info['tracks'].append(video_track_info)
+    # TODO(pts): Add info about the audio track.
+
+
   # --- ogg.
 
 
@@ -1892,6 +1963,45 @@ def mediafileinfo_detect():
 
   # --- Windows
 
+  # Only BMP (DIB) image codecs. Also used in AVI etc. for keyframe-only video codecs.
+  # See also WINDOWS_VIDEO_CODECS for more video codecs.
+  DIB_CODECS = {
+      0: 'uncompressed',
+      1: 'rle',
+      2: 'rle',
+      3: 'bitfields',
+      4: 'jpeg',
+      5: 'flate',  # PNG.
+      6: 'bitfields',
+      11: 'uncompressed',
+      12: 'rle',
+      13: 'rle',
+  }
+
+
+  def parse_dib_header(info, data):
+    # BITMAPINFOHEADER struct in data.
+    # https://docs.microsoft.com/en-us/windows/win32/api/wingdi/ns-wingdi-bitmapinfoheader
+    if not isinstance(data, (str, buffer)):
+      raise TypeError
+    if len(data) < 8:
+      raise ValueError('Too short for dib.')
+    bi_size, = struct.unpack('<L', data[:4])
+    #if bi_size not in (12, 40, 64, 108, 124):  # From Pillow-8.4.0.
+    if 12 <= bi_size < 40:
+      # BITMAPCOREHEADER struct: bc_size, bc_width, bc_height, bc_planes, bc_bitcnt = struct.unpack('<LHHHH')
+      info['width'], info['height'] = struct.unpack('<HH', data[4 : 8])
+      info['codec'] = 'uncompressed'
+    elif 40 <= bi_size <= 127:
+      if len(data) >= 12:
+        info['width'], info['height'] = struct.unpack('<LL', data[4 : 12])
+        if len(data) >= 20:
+          bi_compression, = struct.unpack('<L', data[16 : 20])
+          info['codec'] = DIB_CODECS.get(bi_compression, str(bi_compression))
+    else:
+      raise ValueError('Bad dib bi_size: %d' % bi_size)
+
+
   # FourCC.
   # See some on: http://www.fourcc.org/
   # See many on: https://github.com/MediaArea/MediaInfoLib/blob/master/Source/Resource/Text/DataBase/CodecID_Video_Riff.csv
@@ -1911,11 +2021,13 @@ def mediafileinfo_detect():
       'dvx4': 'divx',
       '3iv2': 'divx',
       'h264': 'h264',
+      'x264': 'h264',
       'xvid': 'divx',
       'mjpg': 'mjpeg',
       'msvc': 'msvc',
       'cram': 'msvc',
-      'x265': 'h264',
+      'h265': 'h265',
+      'x265': 'h265',
       'iv50': 'indeo5',
       'iv41': 'indeo4',
       'dvsd': 'dv',
@@ -1936,6 +2048,7 @@ def mediafileinfo_detect():
       'vcr2': 'vcr2',
       'av01': 'av1',
       'flv1': 'flv1',  # Flash Player 6, modified H.263, Sorenson Spark.
+      'wvc1': 'vc1',
       # TODO(pts): Add these.
       # 13 ffds: Not a specific codec, but anything ffdshow (ffmpeg) supports.
       #  7 uldx
@@ -1946,16 +2059,13 @@ def mediafileinfo_detect():
 
 
   def get_windows_video_codec(codec):
+    bi_compression, = struct.unpack('<L', codec)
+    if bi_compression <= 31:  # Just a random limit.
+      return DIB_CODECS.get(bi_compression, str(bi_compression))
+    if bi_compression in (0x10000001, 0x10000002):
+      return 'mpeg'
     codec = codec.strip().lower()  # Canonicalize FourCC.
-    if codec == '\0\0\0\0':
-      codec = 'uncompressed'
-    elif codec in ('\1\0\0\x10', '\2\0\0\x10'):
-      codec = 'mpeg'
-    elif codec == '\2\0\0\x10':
-      codec = 'mpeg'
-    elif codec in ('\1\0\0\0', '\2\0\0\0'):
-      codec = 'rle'
-    elif '\0' in codec:
+    if '\0' in codec:
       raise ValueError('NUL in Windows video codec %r.' % codec)
     return WINDOWS_VIDEO_CODECS.get(codec, codec)
 
@@ -2117,16 +2227,17 @@ def mediafileinfo_detect():
           if strh_data[:4] == 'vids':
             if len(strf_data) < 20:
               raise ValueError('avi strf chunk to short for video track.')
-            # BITMAPINFO starts with BITMAPINFOHEADER.
+            # strf_data contains BITMAPINFO, which starts with BITMAPINFOHEADER.
             # https://msdn.microsoft.com/en-us/library/windows/desktop/dd183376(v=vs.85).aspx
-            width, height = struct.unpack('<LL', strf_data[4 : 12])
-            if strh_data[4 : 8] == '\0\0\0\0':
+            tmp_info = {}
+            parse_dib_header(tmp_info, strf_data)
+            if strh_data[4 : 8] != '\0\0\0\0':
               video_codec = strf_data[16 : 20]
             else:
               video_codec = strh_data[4 : 8]
             video_codec = get_windows_video_codec(video_codec)
             track_info = {'type': 'video', 'codec': video_codec}
-            set_video_dimens(track_info, width, height)
+            set_video_dimens(track_info, tmp_info['width'], tmp_info['height'])
             info['tracks'].append(track_info)
           elif strh_data[:4] == 'auds':
             if len(strf_data) < 16:
@@ -4146,8 +4257,122 @@ def mediafileinfo_detect():
     raise AssertionError('Internal JPEG parser error.')
 
 
+  def count_is_jpeg(header):
+    if not header.startswith('\xff\xd8\xff'):
+      return False
+    i, lh = 2, len(header)
+    c = 100 * i
+    # Try to match more bytes (i.e. increasing c) of the most popular APP* markers.
+    while i + 4 <= lh:
+      marker = header[i + 1]
+      if header[i] != '\xff' or marker not in '\xe0\xe1\xe2\xe3\xe4\xe5\xe6\xe7\xe8\xe9\xea\xeb\xec\xed\xee\xef':
+        break
+      c += 150  # 1 value for header[i], 16 values for marker.
+      i += 2
+      size, = struct.unpack('>H', header[i : i + 2])
+      if size < 2 or i + size > lh:
+        break
+      # See statistics for leading most popular APP* segments below.
+      j = i + 2
+      es = i + size
+      while j < es and header[j] != '\0':
+        j += 1
+      if j < es:
+        c_name = 100 * (j + 1 - i) + (100 - 50)
+        c += c_name
+        name = marker + header[i + 2 : j]
+        i = j + 1
+        #print [name, header[i : es]]
+        if name == '\xe0JFIF': # 8251073 https://www.w3.org/Graphics/JPEG/jfif3.pdf Example: '\x01\x02\x00\x00\x01\x00\x01\x00\x00'.
+          if i + 9 <= es:
+            if size == 16:
+              c += 200
+            if header[i : i + 2] in ('\1\0', '\1\1', '\1\2'):  # Version.
+              c += 181
+            if header[i + 3] in '\0\1\2':  # Units.
+              c += 81
+            if header[i + 3 : i + 5] == '\0\1':  # X density.
+              c += 200
+            if header[i + 5 : i + 7] == '\0\1':  # Y density.
+              c += 200
+            if header[i + 7] == '\0':  # Thumbnail width.
+              c += 100
+            if header[i + 8] == '\0':  # Thumbnail height.
+              c += 100
+        elif name == '\xe1Exif':  # 1244210 Example: '\x00II*\x00\x08\x00\x00\x00'.
+          if i + 9 <= es and header[i] == '\0' and header[i + 1 : i + 5] in ('II*\0', 'MM\0*'):  # TIFF.
+            c += 488
+            if header[i + 4] == '\0' and header[i + 5 : i + 9] == '\x08\0\0\0':
+              c += 400
+        elif name == '\xeeAdobe': # 1003621 https://exiftool.org/TagNames/JPEG.html#Adobe Example: 'd\x08\x00\x00\x00\x01'.
+          if i + 6 <= es:
+            if i + 6 == es:
+              c += 200
+            if header[i] in '\x64\x65':
+              c += 88
+            if header[i + 1 : i + 3] in ('\x80\0', '\0\0'):
+              c += 188
+            if header[i + 3 : i + 5] == '\0\0':
+              c += 200
+            if header[i + 5] in '\0\1\2':
+              c += 81
+        elif name in ('\xe1http://ns.adobe.com/xap/1.0/', '\xe1http://ns.adobe.com/xap/1.0/ '): # 824414, 12330 https://wwwimages2.adobe.com/content/dam/acom/en/devnet/xmp/pdfs/XMP%20SDK%20Release%20cc-2016-08/XMPSpecificationPart3.pdf Example: '<?xpacket begin="'.
+          if header[i : i + 16] == '<?xpacket begin=':  # TODO(pts): Also support UTF-16BE, UTF-16LE.
+            c += 1600
+          if '<x:xmpmeta ' in header[i : es]:
+            c += 1100
+        elif name == '\xedPhotoshop 3.0': # 805633 https://wwwimages2.adobe.com/content/dam/acom/en/devnet/xmp/pdfs/XMP%20SDK%20Release%20cc-2016-08/XMPSpecificationPart3.pdf Example: '8BIM\x04\x04\x00\x00\x00\x00??'.
+          if i + 12 <= es and header[i : i + 4] == '8BIM':
+            c += 400
+            if header[i + 4 : i + 6] in ('\3\xf0', '\3\xfc', '\4\x04', '\4\x0a', '\4\x0b', '\4\x22', '\4\x24', '\4\x25'):  # Resource ID.
+              c += 63
+            if header[i + 6 : i + 8] == '\0\0':  # Resource name size.
+              c += 200
+              if header[i + 8 : i + 10] == '\0\0':  # High 2 bytes of size.
+                c += 200
+        elif name == '\xecDucky': # 570605 https://exiftool.org/TagNames/APP12.html#Ducky Example: '\x01\x00\x04\x00\x00\x00d\x00\x00'.
+          if i + 9 <= es and header[i] == '\1':
+            if i + 9 == es:
+              c += 200
+            c += 100
+            if header[i + 1 : i + 3] == '\0\4':
+              c += 200
+              if header[i + 3 : i + 6] == '\0\0\0':  # Quality is between 1 and 100, we check 0..255.
+                c += 300
+              if header[i + 7 : i + 9] == '\0\0':  # End.
+                c += 200
+        elif name == '\xe2ICC_PROFILE': # 508030 Example: '\x01?\x00???'.
+          if i + 3 <= es and header[i] == '\1':  # Chunk index.
+            c += 100
+            if header[i + 2] == '\0':  # High byte of profile size (4 bytes).
+              c += 100
+        elif name == '\xe2MPF': # 24363 http://fileformats.archiveteam.org/wiki/Multi-Picture_Format Example: 'II*\x00\x08\x00\x00\x00'.
+          if i + 8 <= es and header[i : i + 4] in ('II*\0', 'MM\0*'):  # TIFF.
+            c += 388
+            if header[i + 3] == '\0' and header[i + 4 : i + 8] == '\x08\0\0\0':
+              c += 400
+        elif name == '\xe0JFXX': # 1409 https://www.w3.org/Graphics/JPEG/jfif3.pdf Example: '\x13'.
+          if size >= 1 and header[i] in '\x10\x11\x13':
+            c += 81
+        else:
+          c -= c_name
+      i = es
+    if i < lh and header[i] == '\xff':
+      c += 100
+      i += 1
+      if i < lh and header[i] in ('\xc0', '\xc2', '\xdb', '\xfe'):
+        c += 75
+    return c
+
+
   def analyze_jpeg(fread, info, fskip, format='jpeg', fclass='image',
-                   spec=(0, '\xff\xd8\xff')):
+                   spec=((0, '\xff\xd8\xff\xe0'),
+                         (0, '\xff\xd8\xff\xe1'),  # Separate spec because of very different relative frequencies of header[3].
+                         (0, '\xff\xd8\xff\xdb'),
+                         (0, '\xff\xd8\xff', 3, ('\xe2', '\xc0', '\xee', '\xfe', '\xed')),
+                         # 408 is arbitrary, but since cups-raster has it, we can also that much.
+                         (0, '\xff\xd8\xff', 408, lambda header: adjust_confidence(300, count_is_jpeg(header))))):  # Most files will match this with highest confidence.
+    # Statistics for header[3]: 8220887 e0, 560958 e1, 212585 db, 1964 e2, 1246 c0, 1215 ee, 873 fe, 473 ed.
     header = fread(4)
     if len(header) < 3:
       raise ValueError('Too short for jpeg.')
@@ -5436,7 +5661,7 @@ def mediafileinfo_detect():
 
 
   def analyze_wav(fread, info, fskip, format='wav', fclass='audio', ext='.wav',
-                  spec=(0, 'RIFF', 8, ('WAVE', 'RMP3'), 12, ('fmt ', 'bext'), 20, lambda header: (len(header) < 20 or header[12 : 16] != 'fmt ' or (16 <= ord(header[16]) <= 80 and header[17 : 20] == '\0\0\0'), 315 * (header[12 : 16] == 'fmt ') or 1))):
+                  spec=(0, 'RIFF', 8, ('WAVE', 'RMP3'), 12, ('fmt ', 'bext', 'JUNK'), 20, lambda header: (len(header) < 20 or header[12 : 16] != 'fmt ' or (16 <= ord(header[16]) <= 80 and header[17 : 20] == '\0\0\0'), 315 * (header[12 : 16] == 'fmt ') or 1))):
     # 'RMP3' as .rmp extension, 'WAVE' has .wav extension. 'WAVE' can also have codec=mp3.
     header = fread(36)
     if len(header) < 16:
@@ -5445,7 +5670,7 @@ def mediafileinfo_detect():
       raise ValueError('wav signature not found.')
     info['format'] = 'wav'
     info['tracks'] = []
-    while header[12 : 16] == 'bext':  # Skip 'bext' chunk(s).
+    while header[12 : 16] in ('bext', 'JUNK'):  # Skip 'bext' and 'JUNK' chunk(s).
       chunk_size, = struct.unpack('<L', header[16 : 20])
       chunk_size += chunk_size & 1
       i = chunk_size - (len(header) - 20)
@@ -5634,7 +5859,7 @@ def mediafileinfo_detect():
 
 
   def analyze_exe(fread, info, fskip, format='exe', fclass='code',
-                  # 408 is arbitrary, but since cups-raster has it, we can also that much.
+                  # 408 (header_size_limit) is arbitrary, but since cups-raster has it, we can also that much.
                   spec=((0, 'MZ', 408, lambda header: adjust_confidence(200, count_is_exe(header))),
                         # format='hxs' bare. Usually there is a PE header (analyze_exe) in front of this.
                         (0, 'ITOLITLS\1\0\0\0\x28\0\0\0', 24, '\xc1\x07\x90\nv@\xd3\x11\x87\x89\x00\x00\xf8\x10WT')),
@@ -5859,7 +6084,55 @@ def mediafileinfo_detect():
     return data
 
 
-  def analyze_xml(fread, info, fskip):
+  def count_is_xml(header):
+    # XMLDecl in https://www.w3.org/TR/2006/REC-xml11-20060816/#sec-rmd
+    if header.startswith('<?xml?>'):
+      # XMLDecl needs version="...", but we are lenient here.
+      return 700
+    if not header.startswith('<?xml') and header[5 : 6].isspace():
+      return False
+    i = 6
+    while i < len(header) and header[i].isspace():
+      i += 1
+    header = header[i : i + 13]
+    if header.startswith('?>'):
+      return (i + 2) * 100
+    for decl in ('version=', 'encoding=', 'standalone='):
+      i = len(decl)
+      if header.startswith(decl) and len(header) > i and header[i] in '"\'':
+        return (i + 1) * 100
+    return False
+
+
+  def count_is_xml_comment(header):
+    i = 0
+    while i < len(header) and header[i].isspace():
+      i += 1
+    if header[i : i + 4] != '<!--':
+      return False
+    return (i + 4) * 100
+
+
+  UOF_FORMAT_BY_MIMETYPE = {
+      'vnd.uof.presentation': 'uof-uop',
+      'vnd.uof.spreadsheet': 'uof-uos',
+      'vnd.uof.text': 'uof-uot',
+  }
+
+  ODF_FLATXML_FORMAT_BY_MIMETYPE = {
+      'application/vnd.oasis.opendocument.graphics': 'odf-flatxml-fodg',
+      'application/vnd.oasis.opendocument.presentation': 'odf-flatxml-fodp',
+      'application/vnd.oasis.opendocument.spreadsheet': 'odf-flatxml-fods',
+      'application/vnd.oasis.opendocument.text': 'odf-flatxml-fodt',
+  }
+
+
+  def analyze_xml(fread, info, fskip, format='xml', fclass='other',
+                  extra_formats=('xml-comment', 'xhtml', 'mathml', 'uof-xml', 'odf-flatxml') + tuple(UOF_FORMAT_BY_MIMETYPE.itervalues()) + tuple(ODF_FLATXML_FORMAT_BY_MIMETYPE.itervalues()),  # Also generates 'smil' etc.
+                  spec=((0, '<?xml', 5, WHITESPACE + ('?',), 256, lambda header: adjust_confidence(6, count_is_xml(header))),
+                        # 408 is arbitrary, but since cups-raster has it, we can also that much.
+                        (0, '<!--', 408, lambda header: adjust_confidence(400, count_is_xml_comment(header))),
+                        (0, WHITESPACE, 408, lambda header: adjust_confidence(12, count_is_xml_comment(header))))):
     # https://www.w3.org/TR/2006/REC-xml11-20060816/#sec-rmd
     whitespace = '\t\n\x0b\x0c\r '
     whitespace_tagend = whitespace + '>'
@@ -5970,7 +6243,7 @@ def mediafileinfo_detect():
         if not c.isalpha():
           raise ValueError('Bad xml attr name start.')
         j = i
-        while i < len(data) and (data[i].isalpha() or data[i] in '-:_'):
+        while i < len(data) and (data[i].isalnum() or data[i] in '-:_'):
           i += 1
         if i == len(data):
           raise ValueError('EOF in attr name.')
@@ -6039,13 +6312,15 @@ def mediafileinfo_detect():
           elif not data[i].isalpha():
             raise ValueError('Bad xml tag name start.')
           i += 1
-          while i < len(data) and (data[i].isalpha() or data[i] == '-'):
+          while i < len(data) and (data[i].isalpha() or data[i] == '-' or data[i] == ':'):
             i += 1
           tag_name = data[j : i]
           j = i
           i = data.find('>', j) + 1
           if i <= 0:
             raise EOFError
+          if i - 1 > j and data[i - 2] == '/':
+            i -= 1
           if tag_name.startswith('!'):
             if tag_name == '!DOCTYPE':  # XML doctype is uppercase.
               if had_doctype:
@@ -6059,10 +6334,10 @@ def mediafileinfo_detect():
                   raise EOFError
               continue
             raise ValueError('Unknown xml special tag: %s' % tag_name)
-          elif tag_name == 'smil':
+          elif tag_name in ('smil', 'smil:smil'):
             info['format'] = 'smil'
             # No width= and height= attributes in SMIL.
-          elif tag_name == 'svg':
+          elif tag_name in ('svg', 'svg:svg'):
             info['format'] = 'svg'
             # Typical: attrs['xmlns'] == 'http://www.w3.org/2000/svg'.
             attrs = parse_attrs(buffer(data, j, i - j - 1))
@@ -6092,6 +6367,28 @@ def mediafileinfo_detect():
             attrs = parse_attrs(buffer(data, j, i - j - 1))
             if (attrs.get('version', '') + 'xx')[:2] not in ('1.', '2.', '3.'):
               raise ValueError('Bad texmacs version: %r' % attrs.get('version'))
+          elif tag_name == 'math':
+            attrs = parse_attrs(buffer(data, j, i - j - 1))
+            if attrs.get('xmlns') == 'http://www.w3.org/1998/Math/MathML':
+              info['format'] = 'mathml'
+          elif tag_name == 'uof:UOF':
+            # Replace xmlns:SOMENONEASCII= with xmlns:=
+            attrs_str = ''.join((c for c in buffer(data, j, i - j - 1) if ord(c) < 128))
+            attrs = parse_attrs(attrs_str)
+            if attrs.get('xmlns:uof') == 'http://schemas.uof.org/cn/2003/uof':
+              format = UOF_FORMAT_BY_MIMETYPE.get(attrs.get('uof:mimetype'))
+              if format is not None:
+                info['format'] = format
+              else:
+                info['format'] = 'uof-xml'
+          elif tag_name == 'office:document':
+            attrs = parse_attrs(buffer(data, j, i - j - 1))
+            if attrs.get('xmlns:office') == 'urn:oasis:names:tc:opendocument:xmlns:office:1.0':
+              format = ODF_FLATXML_FORMAT_BY_MIMETYPE.get(attrs.get('office:mimetype'))
+              if format is not None:
+                info['format'] = format
+              else:
+                info['format'] = 'odf-flatxml'
           break
         else:
           raise ValueError('xml tag expected.')
@@ -6111,67 +6408,78 @@ def mediafileinfo_detect():
             break
 
 
-  DIB_CODECS = {
-      0: 'uncompressed',
-      1: 'rle',
-      2: 'rle',
-      3: 'bitfields',
-      4: 'jpeg',
-      5: 'flate',  # PNG.
-      6: 'bitfields',
-      11: 'uncompressed',
-      12: 'rle',
-      13: 'rle',
-  }
-
-
-  def populate_dib(info, data, format):
+  def populate_bmp_info(info, data, format):
     # Should be preceded by: data = fread(34).
     if len(data) < 22:
-      raise ValueError('Too short for %s dib.' % format)
+      raise ValueError('Too short for %s bmp.' % format)
     if not data.startswith('BM'):
-      raise ValueError('%s dib signature not found.' % format)
-    if data[6 : 10] != '\0\0\0\0' or data[15 : 18] != '\0\0\0':
-      raise ValueError('Bad %s dib data.'  % format)
-    b = ord(data[14])
-    if not 12 <= b <= 127:
-      raise ValueError('Bad %s dib info size: %d' % (format, b))
+      raise ValueError('%s bmp signature not found.' % format)
+    if data[6 : 10] != '\0\0\0\0':
+      raise ValueError('Bad %s bmp data.'  % format)
+    parse_dib_header(info, buffer(data, 14))
     info['format'] = format
-    if b < 40 and len(data) >= 12:
-      info['width'], info['height'] = struct.unpack(
-          '<HH', data[18 : 22])
-      info['codec'] = 'uncompressed'
-    elif b >= 40 and len(data) >= 26:
-      info['width'], info['height'] = struct.unpack(
-          '<LL', data[18 : 26])
-      if len(data) >= 34 and b != 64:
-        codec, = struct.unpack('<L', data[30 : 34])
-        info['codec'] = DIB_CODECS.get(codec, str(codec))
 
 
-
-  def analyze_bmp(fread, info, fskip):
+  def analyze_bmp(fread, info, fskip, format='bmp', fclass='image',
+                  spec=(0, 'BM', 6, '\0\0\0\0', 15, '\0\0\0', 22, lambda header: (len(header) >= 22 and 12 <= ord(header[14]) <= 127, 52))):
     # https://en.wikipedia.org/wiki/BMP_file_format
+    # https://github.com/ImageMagick/ImageMagick/blob/1b04b8317378589d1c3a2fddecf30ef1f7cf2c80/coders/bmp.c#L618
     data = fread(34)
     if len(data) < 22:
       raise ValueError('Too short for bmp.')
     if not data.startswith('BM'):
       raise ValueError('bmp signature not found.' )
-    populate_dib(info, data, 'bmp')
+    populate_bmp_info(info, data, 'bmp')
+
 
+  DIB_BI_SIZES = (12, 40, 64, 108, 124)  # From Pillow-8.4.0.
+  DIB_BI_BITCNTS = (1, 2, 4, 8, 16, 24, 32)
 
-  def analyze_rdi(fread, info, fskip):
+
+  def analyze_dib(fread, info, fskip, format='dib', fclass='image',
+                  spec=((0, '\x0c\0\0\0', 8, '\1\0', 10, ('\1', '\2', '\4', '\x08', '\x18'), 11, '\0'),
+                        (0, tuple(chr(c) for c in DIB_BI_SIZES if c >= 20), 1, '\0\0\0', 12, '\1\0', 14, tuple(chr(c) for c in DIB_BI_BITCNTS), 15, '\0', 17, lambda header: (len(header) >= 17 and ord(header[16]) < 32, 38), 17, '\0\0\0'))):
+    # BITMAPINFOHEADER struct (and its various versions), starting at offset 14
+    # of format=bmp.
+    data = fread(20)
+    if len(data) < 12:
+      raise ValueError('Too short for dib.')
+    # Do some checks before calling the permissive parse_dib_header.
+    bi_size, = struct.unpack('<L', data[:4])
+    if bi_size not in DIB_BI_SIZES:
+      raise ValueError('dib signature not found.')
+    info['format'] = 'dib'
+    if bi_size == 12:
+      if data[8 : 10] != '\1\0':
+        raise ValueError('Bad dib bc_planes.')
+      bi_bitcnt, = struct.unpack('<H', data[10 : 12])
+      if bi_bitcnt in (16, 32):
+        raise ValueError('Bad dib bc_bitcnt.')
+    else:
+      if data[12 : 14] != '\1\0':
+        raise ValueError('Bad dib bi_planes.')
+      bi_bitcnt, = struct.unpack('<H', data[14 : 16])
+      if ord(data[16]) >= 32:
+        raise ValueError('Bad dib bi_compression.')
+    if bi_bitcnt not in DIB_BI_BITCNTS:
+      raise ValueError('Bad dib bi_bitcnt.')
+    parse_dib_header(info, data)
+
+
+  def analyze_rdib(fread, info, fskip, format='rdib', fclass='image',
+                   spec=((0, 'RIFF', 8, 'RDIBBM'),
+                         (0, 'RIFF', 8, 'RDIBdata'))):
     # http://fileformats.archiveteam.org/wiki/RDIB
     # https://www.aelius.com/njh/wavemetatools/doc/riffmci.pdf
     # We don't support the ``extended RDIB'', because it has hard to find any
     # sample files.
     header = fread(20 + 34)
     if len(header) < 14:
-      raise ValueError('Too short for rdi.')
+      raise ValueError('Too short for rdib.')
     has_data = header[12 : 16] == 'data'
     if not (header.startswith('RIFF') and header[8 : 12] == 'RDIB' and (has_data or header[12 : 14] == 'BM')):
       raise ValueError('rdi signature not found.' )
-    info['format'] = 'rdi'
+    info['format'] = 'rdib'
     if has_data:
       # If there is a 4-byte chunk_size field after 'data', then header[26 :
       # 30] becomes '\0\0\0\0' (dib_data[6 : 10]). This is how we detect the
@@ -6180,7 +6488,7 @@ def mediafileinfo_detect():
     else:
       header = header[12:]
     if len(header) >= 22:
-      populate_dib(info, header, 'rdi')
+      populate_bmp_info(info, header, 'rdib')
 
 
   def analyze_flic(fread, info, fskip, format='flic', fclass='video',
@@ -6222,13 +6530,28 @@ def mediafileinfo_detect():
 
 
   def analyze_png(fread, info, fskip, format='png', extra_formats=('apng',), fclass='image',
-                  spec=(0, '\x89PNG\r\n\x1a\n\0\0\0', 12, 'IHDR')):
+                  spec=((0, '\x89PNG\r\n\x1a\n\0\0\0', 12, 'IHDR'),
+                        (0, '\x89PNG\r\n\x1a\n\0\0\0\x04CgBI\x50\0\x20', 24, '\0\0\0', 28, 'IHDR'))):
     # https://tools.ietf.org/html/rfc2083
     # https://wiki.mozilla.org/APNG_Specification
     header = fread(24)
     if len(header) < 24:
       raise ValueError('Too short for png.')
-    if not header.startswith('\x89PNG\r\n\x1a\n\0\0\0') or header[12 : 16] != 'IHDR':
+    if header.startswith('\x89PNG\r\n\x1a\n\0\0\0'):
+      if header[12 : 16] == 'IHDR':
+        pass
+      elif header[12 : 19] == 'CgBI\x50\0\x20':
+        # https://iphonedev.wiki/index.php/CgBI_file_format
+        # https://stackoverflow.com/a/20670192/
+        header += fread(16)
+        if len(header) == 40 and header[24 : 27] == '\0\0\0' and header[28 : 32] == 'IHDR':
+          info['subformat'] = 'apple'  # For iOS.
+          header = header[16:]
+        else:
+          header = ''
+    else:
+      header = ''
+    if not header:
       raise ValueError('png signature not found.')
     info['format'], info['codec'] = 'png', 'flate'
     info['width'], info['height'] = struct.unpack('>LL', header[16 : 24])
@@ -6314,23 +6637,76 @@ def mediafileinfo_detect():
         info['codec'] = str(codec)
 
 
-  def analyze_pcx(fread, info, fskip):
+  def analyze_pcx(fread, info, fskip, format='pcx', fclass='image',
+                  spec=(0, '\n', 1, ('\0', '\2', '\3', '\4', '\5'), 2, ('\0', '\1'), 3, ('\1', '\2', '\4', '\x08'))):
     # https://en.wikipedia.org/wiki/PCX
     header = fread(12)
     if len(header) < 12:
       raise ValueError('Too short for pcx.')
     signature, version, encoding, bpp, xmin, ymin, xmax, ymax = struct.unpack(
         '<BBBBHHHH', header)
-    if signature != 10 or version > 5 or encoding != 1 or bpp not in (1, 2, 4, 8):
+    if not (signature == 10 and version in (0, 2, 3, 4, 5) and encoding in (0, 1) and bpp in (1, 2, 4, 8)):
       raise ValueError('pcx signature not found.')
     if xmax < xmin:
       raise ValueError('pcx xmax smaller than xmin.')
     if ymax < ymin:
       raise ValueError('pcx ymax smaller than ymin.')
-    info['format'], info['codec'] = 'pcx', 'rle'
+    info['format'] = 'pcx'
+    info['codec'] = ('uncompressed', 'rle')[encoding]
     info['width'], info['height'] = xmax - xmin + 1, ymax - ymin + 1
 
 
+  def is_f32_pos_nbit16(f):
+    """Is f (an f32) a positive integer, smaller than (1 << 16)?"""
+    return (f > 0 and 0 <= (f >> 23) - 127 < 16 and
+            not (f & ((1 << (150 - (f >> 23))) - 1)))
+
+
+  def count_is_spider(header):
+    if len(header) < 48:
+      return False
+    if header.startswith('\x3f\x80\0\0') and header[16 : 20] == '\x3f\x80\0\0':
+      fmt = '>'
+    elif header.startswith('\0\0\x80\x3f') and header[16 : 20] == '\0\0\x80\x3f':
+      fmt = '<'
+    else:
+      return False
+    height, width = struct.unpack(fmt + '4xL36xL', buffer(header, 0, 48))
+    if not (is_f32_pos_nbit16(width) and is_f32_pos_nbit16(height)):
+      return False
+    # Confidence of is_f32_pos_nbit16 is 201.
+    return (800 - 13) + 2 * 201
+
+
+  def analyze_spider(fread, info, fskip, format='spider', fclass='image',
+                     spec=(0, ('\x3f\x80\0\0', '\0\0\x80\x3f'), 48, lambda header: adjust_confidence(800 - 13, count_is_spider(header)))):
+    # https://github.com/python-pillow/Pillow/blob/862be7cbcda1a4fc566a4679ad38b0cd8bba22fe/src/PIL/SpiderImagePlugin.py#L234-L259
+    # https://en.wikipedia.org/wiki/Single-precision_floating-point_format
+    header = fread(48)
+    if len(header) < 48:
+      raise ValueError('Too short for spider.')
+    if not (  # Check slice_count == 1.0 and iform == 1.0 (2D), both as f32.
+       (header.startswith('\x3f\x80\0\0') and header[16 : 20] == '\x3f\x80\0\0') or
+       (header.startswith('\0\0\x80\x3f') and header[16 : 20] == '\0\0\x80\x3f')):
+      raise ValueError('spider signature not found.')
+
+    def get_int_from_posint_f32(f):
+      shift = 150 - (f >> 23)
+      assert 0 <= shift <= 23
+      return int((0x800000 | f & 0x7fffff) >> shift)
+
+    fmt = '<>'[header[0] != '\0']  # Detect endianness.
+    height, width = struct.unpack(fmt + '4xL36xL', buffer(header, 0, 48))
+    # Valid iform (header[16 : 20]) values: 1 (2D), 3, -11, -12, -21, -22.
+    if not is_f32_pos_nbit16(width):
+      raise ValueError('Bad spider width.')
+    if not is_f32_pos_nbit16(height):
+      raise ValueError('Bad spider height.')
+    info['format'], info['codec'] = 'spider', 'uncompressed'
+    info['width'] = get_int_from_posint_f32(width)
+    info['height'] = get_int_from_posint_f32(height)
+
+
   def analyze_dcx(fread, info, fskip):
     # http://fileformats.archiveteam.org/wiki/DCX
     # Sample: https://github.com/ImageMagick/ImageMagick6/blob/master/PerlMagick/t/input.dcx
@@ -6715,22 +7091,16 @@ def mediafileinfo_detect():
         info['subformat'] = 'pgm'
       elif header[1] in '36':
         info['subformat'] = 'ppm'
+      elif header[1] == '7':
+        info['subformat'] = 'ppmx'
       if header[1] in '123':
         info['codec'] = 'uncompressed-ascii'
       else:
         info['codec'] = 'uncompressed'  # Raw.
     else:
       raise ValueError('pnm signature not found.')
-    if header[1] == '7':
-      # http://fileformats.archiveteam.org/wiki/XV_thumbnail
-      # https://github.com/ingowald/updated-xv/blob/395756178dad44efb950e3ea6739fe60cc62d314/xvbrowse.c#L4034-L4059
-      header += fread(4)
-      if header != 'P7 332\n':
-        raise ValueError('xv-thumbnail signature not found.')
-      info['format'] = 'xv-thumbnail'
-    else:
-      info['format'] = 'pnm'
-    data = header[-1]
+    info['format'] = 'pnm'
+    data, header = header[-1], header[:-1]
     state = 0
     dimensions = []
     memory_budget = 100
@@ -6739,6 +7109,8 @@ def mediafileinfo_detect():
         break # raise ValueError('EOF in %s header.' % info['format'])
       if memory_budget < 0:
         raise ValueError('pnm header too long.')
+      if header[1] == '7' and len(header) < 7:
+        header += data
       if state == 0 and data.isdigit():
         state = 1
         memory_budget -= 1
@@ -6755,6 +7127,13 @@ def mediafileinfo_detect():
             break
         state = 0
       elif data in pnm_whitespace:
+        if header == 'P7 332\n':
+          # http://fileformats.archiveteam.org/wiki/XV_thumbnail
+          # https://github.com/ingowald/updated-xv/blob/395756178dad44efb950e3ea6739fe60cc62d314/xvbrowse.c#L4034-L4059
+          dimensions.pop()
+          info['format'] = 'xv-thumbnail'
+          info.pop('subformat', None)
+          header += '.'
         if len(dimensions) == 2:
           break
         state = 0
@@ -8355,25 +8734,34 @@ def mediafileinfo_detect():
     info['width'], info['height'] = width, height
 
 
-  def analyze_art(fread, info, fskip):
+  def analyze_art(fread, info, fskip, format='art', fclass='image',
+                  spec=(0, 'JG', 2, ('\3', '\4'), 3, '\x0e\0\0\0')):
     # By AOL browser.
     # https://en.wikipedia.org/wiki/ART_image_file_format
     # https://multimedia.cx/eggs/aol-art-format/
     # http://samples.mplayerhq.hu/image-samples/ART/
+    # https://samples.ffmpeg.org/image-samples/ART/
+    # https://bugzilla.mozilla.org/show_bug.cgi?id=153450
+    # https://msfn.org/board/topic/125338-aol-art-compressed-image/
+    #   2009, Internet Explorer 6, Windows registry FEATURE_IMAGING_USE_ART.
+    # Proprietary and undocumented jgdw400.dll . There is also jgdw500.dll .
+    #   There is also jgdwaol.dll .
+    # ACDSee 5.01 has ART support. It works on Windows 10, but it doesn't work
+    #   on Wine 1.6.
     header = fread(17)
-    if len(header) < 17:
+    if len(header) < 7:
       raise ValueError('Too short for art.')
     if not (header.startswith('JG') and header[2] in '\3\4' and
-            header[3 : 8] == '\016\0\0\0\0'):
+            header[3 : 7] == '\x0e\0\0\0'):
       raise ValueError('art signature not found.')
-    # Usually header[8 : 13] == '\7\0\x40\x15\x03'.
     info['format'] = info['codec'] = 'art'
-    # This is mostly an educated guess based on samples, the file format is
+    # These are mostly an educated guess based on samples, the file format is
     # not documented. Not even XnView MP or IrfanView can open them.
-    if header[8 : 13] == '\7\0\x40\x15\3':
+    if header[2] == '\4' and header[7 : 13] in ('\0\7\0\x40\x15\3', '\0\7\0\x40\x15\x20'):
       info['width'], info['height'] = struct.unpack('<HH', header[13 : 17])
-    else:
-      pass  # Example: P50374Bc.art has header[8 : 13] == '\x8c\x16\0\0\x7d'.
+    elif ((header[2] == '\3' and header[7 : 12] == '\4\x8e\x02\x0a\0') or
+          (header[2] == '\4' and header[7 : 12] == '\0\x8c\x16\0\0')):
+      info['height'], info['width'] = struct.unpack('<HH', header[12 : 16])
 
 
   def analyze_fuji_raf(fread, info, fskip):
@@ -8439,17 +8827,24 @@ def mediafileinfo_detect():
         raise ValueError('Bad %s image_offset.' % format)
       best = max(best, (width * height, width, height, image_offset))
     _, info['width'], info['height'], image_offset = best  # Largest icon.
-    # Detect .png compression at image_offset.
+    # Detect codec at image_offset.
     if format == 'ico' and fskip(image_offset - min_image_offset):
       data = fread(20)
       if len(data) == 20:
         # https://github.com/ImageMagick/ImageMagick/blob/2059f96eeae8c2d26e8683aa17fd65f78f42ad30/coders/icon.c#L276-L277
-        # 'IHDR' conflicts with BITMAPINFOHEADER.color_plane_count and .bits_per_pixel.
-        if data.startswith('\x89PNG') or data[12 : 16] == 'IHDR':
+        # 'IHDR' conflicts with BITMAPINFOHEADER.biPlanes and .biBitCnt.
+        if data.startswith('\x89PNG') and data[12 : 16] == 'IHDR':
           info['subformat'], info['codec'] = 'png', 'flate'
         else:
-          codec, = struct.unpack('<L', data[16 : 20])
-          info['subformat'], info['codec'] = 'bmp', DIB_CODECS.get(codec, str(codec))
+          dib_info = {}
+          parse_dib_header(dib_info, data)
+          if dib_info['width'] != width:
+            raise ValueError('Bad %s dib width.')
+          if dib_info['height'] != (height << 1):
+            raise ValueError('Bad %s dib height.')
+          info['subformat'] = 'bmp'
+          if 'codec' in dib_info:
+            info['codec'] = dib_info['codec']
 
 
   def analyze_ico(fread, info, fskip, format='ico', fclass='image',
@@ -9620,7 +10015,7 @@ def mediafileinfo_detect():
     info['format'], info['codec'] = 'gz', 'flate'
 
 
-  def analyze_xz(fread, info, fskip, format='xz', fclass='other',
+  def analyze_xz(fread, info, fskip, format='xz', fclass='compress',
                  spec=(0, '\xfd7zXZ\0')):
     # http://fileformats.archiveteam.org/wiki/XZ
     header = fread(6)
@@ -10110,6 +10505,100 @@ def mediafileinfo_detect():
       info['format'] = 'signify-signature'
 
 
+  ODF_FORMAT_BY_MIMETYPE = {
+      'application/vnd.oasis.opendocument.base': 'odf-odb',
+      'application/vnd.oasis.opendocument.formula': 'odf-odf',
+      'application/vnd.oasis.opendocument.graphics': 'odf-odg',
+      'application/vnd.oasis.opendocument.presentation': 'odf-odp',
+      'application/vnd.oasis.opendocument.spreadsheet': 'odf-ods',
+      'application/vnd.oasis.opendocument.text': 'odf-odt',
+      'application/vnd.oasis.opendocument.graphics-template': 'odf-otg',
+      'application/vnd.oasis.opendocument.presentation-template': 'odf-otp',
+      'application/vnd.oasis.opendocument.spreadsheet-template': 'odf-ots',
+      'application/vnd.oasis.opendocument.text-template': 'odf-ott',
+  }
+
+
+  def analyze_zip(fread, info, fskip, format='zip', fclass='archive',
+                  extra_formats=('msoffice-zip', 'msoffice-docx', 'msoffice-xlsx', 'msoffice-pptx', 'odf-zip') + tuple(ODF_FORMAT_BY_MIMETYPE.itervalues()),
+                  spec=((0, 'PK', 2, ('\1\2', '\3\4', '\5\6', '\7\x08', '\6\6')),
+                        (0, 'PK00PK', 6, ('\1\2', '\3\4', '\5\6', '\7\x08', '\6\6')))):
+    # Also Java jar, Android apk, Python .zip, .docx, .xlsx, .pptx,  ODT, ODS, ODP.
+    header = fread(4)
+    if header == 'PK00':
+      header = fread(4)
+    if len(header) < 4:
+      raise ValueError('Too short for zip.')
+    # 'PK\6\6' is ZIP64.
+    if header in ('PK\1\2', 'PK\5\6', 'PK\7\x08', 'PK\6\6'):
+      info['format'] = 'zip'
+      return
+    elif header != 'PK\3\4':
+      raise ValueError('zip signature not found.')
+    info['format'] = 'zip'
+    data = fread(26)  # Local file header.
+    if len(data) < 26:
+      return
+    # crc32 is of the uncompressed, decrypted file. We ignore it.
+    (version, flags, method, mtime_time, mtime_date, ignored_crc32, compressed_size,
+     uncompressed_size, filename_size, extra_field_size,
+    ) = struct.unpack('<HHHHHlLLHH', data)
+    if method not in (0, 8):  # 0=uncompressed, 8=flate.
+      return
+    assert method in (0, 8), method  # See meanings in METHODS.
+    if flags & 1:  # Encrypted file.
+      return
+    if flags & 8:  # Data descriptor comes after file contents.
+      if method == 8:
+        compressed_size = uncompressed_size = None
+      elif method == 0:
+        if uncompressed_size == 0:
+          uncompressed_size = compressed_size
+    # 8-bit name of the first archive member.
+    filename = fread(filename_size)
+    if len(filename) != filename_size or not fskip(extra_field_size):
+      return
+    if filename == '[Content_Types].xml':
+      info['format'], max_size = 'msoffice-zip', 65536
+    elif filename == 'mimetype':
+      info['format'], max_size = 'odf-zip', 256  # OpenDocument Format.
+    else:
+      return
+
+    if method:  # Usually compressed for msoffice-zip.
+      try:
+        import zlib
+      except ImportError:
+        return
+      zd = zlib.decompressobj(-15)
+      if compressed_size is None:
+        data = fread(max_size)
+      else:
+        zd = zlib.decompressobj(-15)
+        data = fread(min(compressed_size, max_size))
+      try:
+        data = zd.decompress(data)[:max_size]  # TODO(pts): Decompress in 256-byte chunks to prevent size blowup.
+      except zlib.error:
+        return
+    else:  # Usuually uncompressed for odf-zip.
+      data = fread(min(uncompressed_size, max_size))
+    if info['format'] == 'msoffice-zip' and data.startswith('<?xml '):
+      is_docx = ' PartName="/word/' in data
+      is_xlsx = ' PartName="/xl/' in data
+      is_pptx = ' PartName="/ppt/' in data
+      if is_docx + is_xlsx + is_pptx == 1:
+        if is_docx:
+          info['format'] = 'msoffice-docx'
+        elif is_xlsx:
+          info['format'] = 'msoffice-xlsx'
+        elif is_pptx:
+          info['format'] = 'msoffice-pptx'
+    elif info['format'] == 'odf-zip':
+      format = ODF_FORMAT_BY_MIMETYPE.get(data)
+      if format is not None:
+        info['format'] = format
+
+
   def count_is_troff(header):
     i = 0
     if header.startswith('.\\" ') or header.startswith('.\\"*'):
@@ -10148,35 +10637,6 @@ def mediafileinfo_detect():
       return (i + 1) * 100  # +1: '\n'
 
 
-  def count_is_xml(header):
-    # XMLDecl in https://www.w3.org/TR/2006/REC-xml11-20060816/#sec-rmd
-    if header.startswith('<?xml?>'):
-      # XMLDecl needs version="...", but we are lenient here.
-      return 700
-    if not header.startswith('<?xml') and header[5 : 6].isspace():
-      return False
-    i = 6
-    while i < len(header) and header[i].isspace():
-      i += 1
-    header = header[i : i + 13]
-    if header.startswith('?>'):
-      return (i + 2) * 100
-    for decl in ('version=', 'encoding=', 'standalone='):
-      i = len(decl)
-      if header.startswith(decl) and len(header) > i and header[i] in '"\'':
-        return (i + 1) * 100
-    return False
-
-
-  def count_is_xml_comment(header):
-    i = 0
-    while i < len(header) and header[i].isspace():
-      i += 1
-    if header[i : i + 4] != '<!--':
-      return False
-    return (i + 4) * 100
-
-
   def count_is_html(header):
     i = 0
     while i < len(header) and header[i].isspace():
@@ -10208,11 +10668,110 @@ def mediafileinfo_detect():
     return False
 
 
+  def count_is_msoffice_owner(header):
+    # File names starting with ~$ , they are called ``owner files'' in the Microsoft Office documentation.
+    # https://support.microsoft.com/en-us/topic/description-of-how-word-creates-temporary-files-66b112fb-d2c0-8f40-a0be-70a367cc4c85
+    # File format prefix is an educated guess based on samples.
+    if len(header) < 54:
+      return False
+    name_size = ord(header[0])
+    if not 1 <= name_size <= 53:
+      return False
+    c = 29  # Confidence.
+    for i in xrange(1, name_size + 1):  # Username in 8-bit encoding.
+      if ord(header[i]) < 32:
+        return False
+      c += 38
+    b2 = ''
+    for i in xrange(name_size + 1, 54):
+      if b2:
+        if header[i] != b2:
+          return False
+        c += 100
+      else:
+        b2 = header[i]
+        if b2 not in ' \0':
+          return False
+        c += 78
+    if len(header) >= 56:
+      name_size2, = struct.unpack('<H', header[54 : 56])
+      if name_size2 != name_size:
+        if len(header) >= 57 and b2 == ' ' and header[54] == b2:
+          name_size2, = struct.unpack('<H', header[55 : 57])
+          if name_size2 != name_size:
+            return False
+          c += 100
+        else:
+          return False
+      c += 200
+    elif len(header) == 55:
+      if ord(header[54]) != name_size:
+        return False
+      c += 100
+    return c
+
+
+  def count_is_rds_ascii(header):
+    if not (header.startswith('A\n2\n') or header.startswith('A\n3\n')):
+      return False
+    i, j, m, c = 4, 5, min(len(header) - 1, 14), 387 + 61 + 100
+    if m < 4 or not header[4].isdigit() or header[4] == '0':
+      return False
+    while j < m and header[j].isdigit():
+      j += 1
+    if header[j] != '\n':
+      return False
+    r_version = int(header[i : j])
+    if r_version >> 24:
+      return False
+    v1, v2, v3 = (r_version >> 16) & 255, (r_version >> 8) & 255, r_version & 255
+    if not 1 <= v1 <= 6:  # Major R version (4 in 2021).
+      return False
+    if not (v2 <= 20 and v3 <= 20):
+      return False
+    return c
+
+
+  def count_is_hsqldb_log(header):
+    if not header.startswith('/*'):
+      return False
+    if len(header) < 4 or header[3] == '0':
+      return False
+    i, c = 3, 300
+    while i < len(header) and header[i].isdigit():
+      i += 1
+      c += 55
+    # Usually: "*/SET SCHEMA PUBLIC\n" or "*/SET SCHEMA SYSTEM_LOBS\n".
+    expected = '*/SET SCHEMA '
+    if header[i : i + len(expected)] != expected:
+      return False
+    return c + 100 * len(expected)
+
+
+  def count_is_torrent(header):
+    # https://en.wikipedia.org/wiki/Torrent_file
+    # https://fileformats.fandom.com/wiki/Torrent_file
+    if len(header) < 3 or header[0] != 'd' or header[1] not in '123456789':
+      return False
+    c = 161
+    if header[2] == ':':
+      c += 100
+      i, size = 3, int(header[1])
+    elif header[2].isdigit() and header[3 : 4] == ':':
+      c += 159
+      i, size = 4, int(header[1 : 3])
+    if len(header) < i + size:
+      return False
+    # The most common (>=99.84%) key is 'announce'.
+    if header[i : i + size] not in ('announce', 'created by', 'announce-list', 'comment', 'comment.utf-8', 'info', 'creation date', 'nodes', 'httpseeds'):
+      return False
+    return c + 100 * size
+
+
   # ---
 
 
-  # TODO(pts): Move everything from here to analyze_...(..., format=..., spec=...).
-  # TODO(pts): Make Spec matching callable from analyze_...().
+  # TODO(pts): Move everything from here to def analyze_...(..., format=..., spec=...) or add_format(...).
   # TODO(pts): Static analysis: autodetect conflicts and subsumes in string-only matchers.
   # TODO(pts): Optimization: create prefix dict of 8 bytes as well.
   FORMAT_ITEMS.extend((
@@ -10229,8 +10788,6 @@ def mediafileinfo_detect():
       # http://stnsoft.com/DVD/ifo.html
       ('dvd-video-video-ts-ifo', (0, 'DVDVIDEO-VMG\0')),
       ('dvd-video-vts-ifo', (0, 'DVDVIDEO-VTS\0')),
-      # DIF DV (digital video).
-      ('dv', (0, '\x1f\x07\x00')),
       # http://fileformats.archiveteam.org/wiki/RIFX
       # Big endian RIFF. Not in mainstream use, not analyzing further.
       ('rifx', (0, ('RIFX', 'XFIR'), 12, lambda header: (len(header) >= 12 and header[8 : 12].lower().strip().isalnum(), 100))),
@@ -10246,10 +10803,9 @@ def mediafileinfo_detect():
       # IrfanView also supports a lot: https://www.irfanview.com/main_formats.htm
 
       ('lepton', (0, '\xcf\x84', 2, ('\1', '\2'), 3, ('X', 'Y', 'Z'))),
-      ('pnm', (0, 'P', 1, ('1', '4'), 2, ('\t', '\n', '\x0b', '\x0c', '\r', ' ', '#'))),
-      ('pnm', (0, 'P', 1, ('2', '5'), 2, ('\t', '\n', '\x0b', '\x0c', '\r', ' ', '#'))),
-      ('pnm', (0, 'P', 1, ('3', '6'), 2, ('\t', '\n', '\x0b', '\x0c', '\r', ' ', '#'))),
-      ('xv-thumbnail', (0, 'P7 332\n')),
+      ('pnm', (0, 'P', 1, ('1', '2', '3', '4', '5', '6', '7'), 2, ('\t', '\n', '\x0b', '\x0c', '\r', ' ', '#'), 4, lambda header: (len(header) >= 3 and header[2] == '#' or header[3].isdigit(), 1))),
+      # Detected as 'pnm'.
+      ('xv-thumbnail',),
       # 408 is arbitrary, but since cups-raster has it, we can also that much.
       ('pam', (0, 'P7\n', 3, tuple('#\nABCDEFGHIJKLMNOPQRSTUVWXYZ'), 408, lambda header: adjust_confidence(400, count_is_pam(header)))),
       ('xbm', (0, '#define', 7, (' ', '\t'), 256, lambda header: adjust_confidence(800, count_is_xbm(header)))),  # '#define test_width 42'.
@@ -10284,7 +10840,6 @@ def mediafileinfo_detect():
       ('gem', (0, GEM_XIMG_HEADERS, 16, 'XIMG\0\0')),
       # By PCPaint >=2.0 and Pictor.
       ('pcpaint-pic', (0, '\x34\x12', 6, '\0\0\0\0', 11, tuple('\xff123'), 13, tuple('\0\1\2\3\4'))),
-      ('art', (0, 'JG', 2, ('\3', '\4'), 3, '\016\0\0\0\0')),
       ('fuji-raf', (0, 'FUJIFILMCCD-RAW 020', 19, ('0', '1'), 20, 'FF383501')),
       ('minolta-raw', (0, '\0MRM\0', 6, ('\0', '\1', '\2', '\3'), 8, '\0PRD\0\0\0\x18')),
       ('dpx', (0, 'SDPX\0\0', 8, 'V', 9, ('1', '2'), 10, '.', 11, tuple('0123456789'))),
@@ -10343,10 +10898,6 @@ def mediafileinfo_detect():
       ('qtif', (0, '\0\0\0', 4, 'idsc')),
       # .mov preview image.
       ('pnot', (0, '\0\0\0\x14pnot', 12, '\0\0')),
-      ('bmp', (0, 'BM', 6, '\0\0\0\0', 15, '\0\0\0', 22, lambda header: (len(header) >= 22 and 12 <= ord(header[14]) <= 127, 52))),
-      ('rdi', (0, 'RIFF', 8, 'RDIBBM')),
-      ('rdi', (0, 'RIFF', 8, 'RDIBdata')),
-      ('pcx', (0, '\n', 1, ('\0', '\1', '\2', '\3', '\4', '\5'), 2, '\1', 3, ('\1', '\2', '\4', '\x08'))),
       ('dcx', (0, '\xb1\x68\xde\x3a', 8, lambda header: (len(header) < 8 or header[5 : 8] != '\0\0\0' or ord(header[4]) >= 12, 2))),
       # Not all tga (targa) files have 'TRUEVISION-XFILE.\0' footer.
       ('tga', (0, ('\0',) + tuple(chr(c) for c in xrange(30, 64)), 1, ('\0', '\1'), 2, ('\1', '\2', '\3', '\x09', '\x0a', '\x0b', '\x20', '\x21'), 7, ('\0', '\x10', '\x18', '\x20'), 16, ('\1', '\2', '\4', '\x08', '\x0f', '\x10', '\x18', '\x20'))),
@@ -10385,8 +10936,8 @@ def mediafileinfo_detect():
       ('realaudio', (0, '.ra\xfd')),
       ('ralf', (0, 'LSD:', 4, ('\1', '\2', '\3'))),
       # http://midi.teragonaudio.com/tech/midifile/mthd.htm
-      ('midi', (0, 'MThd\0\0\0\6\0\0\0\1')),
-      ('midi', (0, 'MThd\0\0\0\6\0', 9, ('\1', '\2'), 10, ('\0', '\1', '\2', '\3'))),
+      ('midi', (0, 'MThd\0\0\0\6\0\0\0\1')),  # This assumes that for Format=0, it is always Tracks=2. But there are some counterexamples.
+      ('midi', (0, 'MThd\0\0\0\6\0', 9, ('\0', '\1', '\2'), 10, ('\0', '\1', '\2', '\3'))),
       # http://web.archive.org/web/20110610135604/http://www.midi.org/about-midi/rp29spec(rmid).pdf
       ('midi-rmid', (0, 'RIFF', 8, 'RMIDdata', 20, 'MThd\0\0\0\6\0', 29, ('\0', '\1', '\2'))),  # .rmi
       ('aiff', (0, 'FORM', 8, 'AIFFCOMM\0\0\0\x12')),
@@ -10480,13 +11031,12 @@ def mediafileinfo_detect():
       # http://fileformats.archiveteam.org/wiki/Microsoft_Help_2
       # http://www.russotto.net/chm/itolitlsformat.html
       # TODO(pts): Also add .mshc (.zip-based). https://fileinfo.com/extension/mshc
+      # ---
+      # https://www.opendesign.com/files/guestdownloads/OpenDesign_Specification_for_.dwg_files.pdf
+      ('autodesk-dwg', (0, 'AC10', 4, ('12', '14', '15', '18', '21', '24', '27', '32'), 6, '\0\0\0\0\0', 12, '\1')),
 
       # fclass='archive': Compressed archive.
 
-      # '\6\6' is ZIP64.
-      # Also Java jar and Android apk.
-      ('zip', (0, 'PK', 2, ('\1\2', '\3\4', '\5\6', '\7\x08', '\6\6'))),
-      ('zip', (0, 'PK00PK', 6, ('\1\2', '\3\4', '\5\6', '\7\x08', '\6\6'))),
       ('rar', (0, 'Rar!')),
       ('zpaq', (0, ('7kS', 'zPQ'), 4, lambda header: (header.startswith('7kSt') or (header.startswith('zPQ') and 1 <= ord(header[3]) <= 127), 52))),
       ('7z', (0, '7z\xbc\xaf\x27\x1c')),
@@ -10596,25 +11146,8 @@ def mediafileinfo_detect():
       # https://github.com/pts/upxbc/blob/0c5c63aef8c5c3336945a92a3829078d64dfdee2/upxbc#L1239
       ('upxz', (0, 'UPXZ')),
 
-      # fclass='code', fclass='other': Non-compressed, non-media.
+      # fclass='code': Code: source code, machine code or bytecode.
 
-      ('appledouble', (0, '\0\5\x16\7\0', 6, lambda header: (header[5] <= '\3', 25))),
-      ('dsstore', (0, '\0\0\0\1Bud1\0')),  # https://en.wikipedia.org/wiki/.DS_Store
-      ('xml', (0, '<?xml', 5, WHITESPACE + ('?',), 256, lambda header: adjust_confidence(6, count_is_xml(header)))),
-      # 408 is arbitrary, but since cups-raster has it, we can also that much.
-      ('xml-comment', (0, '<!--', 408, lambda header: adjust_confidence(400, count_is_xml_comment(header)))),
-      ('xml-comment', (0, WHITESPACE, 408, lambda header: adjust_confidence(12, count_is_xml_comment(header)))),
-      ('php', (0, '<?', 2, ('p', 'P'), 6, WHITESPACE, 7, lambda header: (header[:5].lower() == '<?php', 200))),
-      # We could be more strict here, e.g. rejecting non-HTML docypes.
-      # 408 is arbitrary, but since cups-raster has it, we can also that much.
-      ('html', (0, '<', 408, lambda header: adjust_confidence(100, count_is_html(header)))),
-      ('html', (0, WHITESPACE, 408, lambda header: adjust_confidence(12, count_is_html(header)))),
-      ('xhtml',),  # From 'html' and 'xml'.
-      # Contains thumbnails of multiple images files.
-      # http://fileformats.archiveteam.org/wiki/PaintShop_Pro_Browser_Cache
-      # pspbrwse.jbf
-      # https://github.com/0x09/jbfinspect/blob/master/jbfinspect.c
-      ('jbf', (0, 'JASC BROWS FILE\0')),
       # .o object files created by Go.
       # See printObjHeader in go/src/cmd/compile/internal/gc/obj.go
       # TODO(pts): Read XCOFF in go/src/cmd/link/internal/ld/lib.go
@@ -10627,9 +11160,6 @@ def mediafileinfo_detect():
       # doesn't seem to print any specific header in the assemble(...)
       # function. The corresponding lex.c in Go prints "go object ".
       ('go-object', (0, 'go object ')),
-      # `nasm -f rdf' output.
-      # https://en.wikipedia.org/wiki/Netwide_Assembler#RDOFF
-      ('rdoff', (0, 'RDOFF', 5, ('1', '2'))),
       # This header seems to come right after 'go object ...\n!\n', so it
       # isn't at the beginning of the file.
       # .o object files created by newer (1.14) Go.
@@ -10713,18 +11243,6 @@ def mediafileinfo_detect():
       ('scumm-index', (0, '\xad\xb1\xbe\xb2\xff\xff\xff\xf6\xff\xb2\xbe\xa7\xac')),
       # https://en.wikipedia.org/wiki/Scratch_(programming_language)#File_formats
       ('scratch', (0, ('ScratchV01', 'ScratchV02'))),
-      # OLE compound file == composite document file, including Thumbs.db and
-      # Microsoft Office 97--2003 documents (.doc, .xls, .ppt).
-      ('olecf', (0, ('\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', '\x0e\x11\xfc\x0d\xd0\xcf\x11\x0e'))),
-      ('avidemux-mpeg-index', (0, 'ADMY')),
-      ('avidemux-project', (0, '//AD')),
-      # *** These modified files were found in JOE when it aborted on ...
-      # *** JOE was aborted by UNIX signal ...
-      # *** Modified files in JOE when it aborted on
-      ('deadjoe', (0, '\n*** ', 5, ('These modified', 'JOE was aborte', 'Modified files'))),
-      # Filename extension: .mfo
-      # Example: output of pymediafileinfo and media_scan.py.
-      ('mediafileinfo', (0, 'format=')),
       ('unixscript', (0, '#!', 4, lambda header: (header.startswith('#!/') or header.startswith('#! /'), 110))),
       # Windows .cmd or DOS .bat file. Not all such file have a signature though.
       ('windows-cmd', (0, '@', 1, ('e', 'E'), 11, lambda header: (header[:11].lower() == '@echo off\r\n', 900))),
@@ -10739,6 +11257,42 @@ def mediafileinfo_detect():
       # TODO(pts): For the ASCII (.ll) format: https://subscription.packtpub.com/book/application_development/9781785285981/1/ch01lvl1sec13/converting-ir-to-llvm-bitcode
       ('llvm-bitcode', (0, '\xde\xc0\x17\x0b\0\0\0\0')),
       ('llvm-bitcode', (0, 'BC\xc0\xde')),  # Usually continues with '\x21\0c\00' -- is it a function?
+      # https://en.wikipedia.org/wiki/Netwide_Assembler#RDOFF
+      ('rdoff', (0, 'RDOFF', 5, ('1', '2'))),
+
+      # fclass='other': Non-code, non-compressed, non-media.
+
+      ('appledouble', (0, '\0\5\x16\7\0', 6, lambda header: (header[5] <= '\3', 25))),
+      ('dsstore', (0, '\0\0\0\1Bud1\0')),  # https://en.wikipedia.org/wiki/.DS_Store
+      ('php', (0, '<?', 2, ('p', 'P'), 6, WHITESPACE, 7, lambda header: (header[:5].lower() == '<?php', 200))),
+      # We could be more strict here, e.g. rejecting non-HTML docypes.
+      # 408 is arbitrary, but since cups-raster has it, we can also that much.
+      ('html', (0, '<', 408, lambda header: adjust_confidence(100, count_is_html(header)))),
+      ('html', (0, WHITESPACE, 408, lambda header: adjust_confidence(12, count_is_html(header)))),
+      # Some yamls files omit this header (e.g. Google App Engine app.yaml),
+      # they can't be detected.
+      ('yaml', (0, ('---\n', '---\r', '--- '))),
+      # https://toml.io/en/v1.0.0
+      # No signature.
+      ('toml',),
+      # Contains thumbnails of multiple images files.
+      # http://fileformats.archiveteam.org/wiki/PaintShop_Pro_Browser_Cache
+      # pspbrwse.jbf
+      # https://github.com/0x09/jbfinspect/blob/master/jbfinspect.c
+      ('jbf', (0, 'JASC BROWS FILE\0')),
+      # `nasm -f rdf' output.
+      # OLE compound file == composite document file, including Thumbs.db and
+      # Microsoft Office 97--2003 documents (.doc, .xls, .ppt).
+      ('olecf', (0, ('\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', '\x0e\x11\xfc\x0d\xd0\xcf\x11\x0e'))),
+      ('avidemux-mpeg-index', (0, 'ADMY')),
+      ('avidemux-project', (0, '//AD')),
+      # *** These modified files were found in JOE when it aborted on ...
+      # *** JOE was aborted by UNIX signal ...
+      # *** Modified files in JOE when it aborted on
+      ('deadjoe', (0, '\n*** ', 5, ('These modified', 'JOE was aborte', 'Modified files'))),
+      # Filename extension: .mfo
+      # Example: output of pymediafileinfo and media_scan.py.
+      ('mediafileinfo', (0, 'format=')),
       ('cue', (0, 'REM GENRE ')),
       ('cue', (0, 'REM DATE ')),
       ('cue', (0, 'REM DISCID ')),
@@ -10776,6 +11330,183 @@ def mediafileinfo_detect():
           # 270 possible manufacturer values: http://www.color.org/signatureRegistry/index.xalter
           #48, ('\0\0\0\0', 'ADBE', 'CANO', 'EPSO', 'HP  ', 'IBM ', 'IEC ', 'KODA', 'QMS ', 'TEKT', 'argl', 'none'),
       )),
+      # https://specifications.freedesktop.org/desktop-entry-spec/desktop-entry-spec-latest.html
+      ('desktop', (0, '[Desktop Entry]', 15, ('\r', '\n'))),
+      ('desktop', (0, '[KDE Desktop Entry]', 19, ('\r', '\n'))),
+      # Microsoft Windows shortcut.
+      # https://ithreats.files.wordpress.com/2009/05/lnk_the_windows_shortcut_file_format.pdf
+      # file-5.30/magic/Magdir/windows
+      ('lnk', (0, '\114\0\0\0\001\024\002\0\0\0\0\0\300\0\0\0\0\0\0\106')),
+      # Microsoft Windows program information file.
+      # https://smsoft.ru/en/pifdoc.htm
+      # file-5.30/magic/Magdir/msdos
+      ('pif', (0, '\0', 30, '  ', 0x171, 'MICROSOFT PIFEX\0\x87\1\0\0')),
+      # Microsoft Windows internet shortcut.
+      # http://www.lyberty.com/encyc/articles/tech/dot_url_format_-_an_unofficial_guide.html
+      # https://stackoverflow.com/q/13088263
+      ('url', (0, '[InternetShortcut]', 18, ('\r', '\n'))),
+      ('msoffice-owner', (0, tuple(chr(c) for c in xrange(1, 54)), 57, lambda header: adjust_confidence(29, count_is_msoffice_owner(header)))),
+      # https://hwiegman.home.xs4all.nl/desktopini.html
+      ('desktopini', (0, '[.ShellClassInfo]', 17, ('\r', '\n'))),
+      ('desktopini', (0, '[LocalizedFileNames]', 20, ('\r', '\n'))),
+      ('desktopini', (0, '[ViewState]', 11, ('\r', '\n'))),
+      ('desktopini', (0, '\r\n[.ShellClassInfo]', 19, ('\r', '\n'))),
+      ('desktopini', (0, '\r\n[LocalizedFileNames]', 22, ('\r', '\n'))),
+      ('desktopini', (0, '\xff\xfe\x0d\0\x0a\0[\0.\0S\0h\0e\0l\0l\0C\0l\0a\0s\0s\0I\0n\0f\0o\0]\0', 40, ('\r', '\n'))),
+      ('desktopini', (0, '\xff\xfe\x0d\0\x0a\0[\0L\0o\0c\0a\0l\0i\0z\0e\0d\0F\0i\0l\0e\0N\0a\0m\0e\0s\0]\0', 46, ('\r', '\n'))),
+      ('vcalendar-ics', (0, 'BEGIN:VCALENDAR', 15, ('\r', '\n'))),
+      ('vcard-vcf', (0, 'BEGIN:VCARD', 11, ('\r', '\n'))),
+      ('m3u-extended', (0, '#EXTM3U', 7, ('\r', '\n'))),
+      ('torrent', (0, 'd', 1, ('1', '2', '3', '4', '5', '6', '7', '8', '9'), 22, lambda header: adjust_confidence(161, count_is_torrent(header)))),
+      ('vobsub-idx', (0, '# VobSub index file, v')),
+      # TODO(pts): Allow a leading '\n' or '\r\n'. Detect more files.
+      # TODO(pts): Allow UTF-8 and UTF-16LE and UTF-16BE BOM.
+      ('srt', (0, ('0', '1'), 1, '\r\n00:', 6, tuple('0123456789'), 7, tuple('0123456789'), 8, ':')),  # Subtitle.
+      ('srt', (0, ('0', '1'), 1, '\n00:', 5, tuple('0123456789'), 6, tuple('0123456789'), 7, ':')),  # Subtitle.
+
+      # fclass='database': Database.
+
+      # https://stackoverflow.com/a/69722897
+      ('sqlite2', (0, '** This file contains an SQLite 2.', 34, ('0', '1'), 35, ' database **\0', 48, ('\xda\xe3\x75\x28', '\x28\x75\xe3\xda'))),
+      # https://www.sqlite.org/fileformat.html#the_database_header
+      # https://stackoverflow.com/a/69722897
+      ('sqlite3', (0, 'SQLite format 3\0', 16, ('\0\1', '\2\0', '\4\0', '\x08\0', '\x10\0', '\x20\0', '\x40\0', '\x80\0'), 18, ('\1', '\2', '\3', '\4'), 19, ('\1', '\2', '\3', '\4'))),
+      # DBNAME-journal file.
+      # https://www.sqlite.org/fileformat.html#the_rollback_journal
+      # Many times the header (first 8 bytes) is overwritten with \0s.
+      ('sqlite3-journal', (0, '\xd9\xd5\x05\xf9\x20\xa1\x63\xd7')),
+      # https://www.sqlite.org/fileformat.html#the_write_ahead_log
+      ('sqlite3-wal', (0, '\x37\x7f\x06', 3, ('\x82', '\x83'), 4, '\x00\x2d\xe2\x18', 8, ('\0\0\2\0', '\0\0\4\0', '\0\0\x08\0', '\0\0\x10\0', '\0\0\x20\0', '\0\0\x40\0', '\0\0\x80\0', '\0\1\0\0'))),
+      # https://www.sqlite.org/walformat.html#walidxfmt
+      ('sqlite3-shm', (0, '\x00\x2d\xe2\x18\0\0\0\0', 12, '\0\0\0\1')),  # Big endian.
+      ('sqlite3-shm', (0, '\x18\xe2\x2d\x00\0\0\0\0', 12, '\1\0\0\0')),  # Little endian.
+      # Microsoft Access database file before Access 2007.
+      # http://jabakobob.net/mdb/first-page.html
+      ('msoffice-mdb', (0, '\0\1\0\x00Standard Jet DB\0', 22, '\0\0')),
+      # Microsoft Access database file since Access 2007.
+      # http://jabakobob.net/mdb/first-page.html
+      ('msoffice-accdb', (0, '\0\1\0\x00Standard ACE DB\0', 22, '\0\0')),
+      # CDB database files don't have any header.
+      # https://cr.yp.to/cdb/cdb.txt
+      ('djb-cdb',),
+      # https://github.com/LMDB/lmdb/blob/4b6154340c27d03592b8824646a3bc4eb7ab61f5/libraries/liblmdb/mdb.c#L634
+      # https://blog.separateconcerns.com/2016-04-03-lmdb-format.html
+      ('lmdb-data', (0, ('\0\0\0\0\0\0\0\x08\0\0\0\0\xbe\xef\xc0\xde\0\0\0\1', '\0\0\0\0\0\0\x08\0\0\0\0\0\xde\xc0\xef\xbe\1\0\0\0'))),
+      ('lmdb-lock', (0, ('\xbe\xef\xc0\xde', '\xde\xc0\xef\xbe'), 8, lambda header: (len(header) >= 8 and ((header[0] == '\xbe' and header[7] in '\1\2\3\4') or (header[0] == '\xde' and header[4] in '\1\2\3\4')), 75))),
+      # https://github.com/erthink/libmdbx
+      ('mdbx-data', (0, '\0\0\0\0\0\0\0\0\0\0' '\x08\0' '\0\0\0\0\0\0\0\0', 20, ('\1', '\2', '\3', '\4', '\5', '\6'), 21, '\x11\x4c\xef\xbd\x9d\x65\x59')),  # Little endian.
+      ('mdbx-data', (0, '\0\0\0\0\0\0\0\0\0\0' '\0\x08' '\0\0\0\0\0\0\0\0' '\x59\x65\x9d\xbd\xef\x4c\x11', 27, ('\1', '\2', '\3', '\4', '\5', '\6'))),  # Big endian.
+      ('mdbx-lock', (0, ('\1', '\2', '\3', '\4', '\5', '\6'), 1, '\x11\x4c\xef\xbd\x9d\x65\x59')),  # The lock file is empty if not in use.
+      ('mdbx-lock', (0,'\x59\x65\x9d\xbd\xef\x4c\x11', 7, ('\1', '\2', '\3', '\4', '\5', '\6'))),
+      # DuckDB also supports it, but may not be its native format: https://duckdb.org/docs/data/parquet
+      # https://github.com/apache/parquet-format
+      # https://github.com/apache/parquet-format/blob/master/src/main/thrift/parquet.thrift
+      # TODO(pts): Parse the first few fields in Thrift format, just to understand.
+      # TODO(pts): Add detection of the Apache Arrow file format.
+      ('parquet', (0, 'PAR1')),
+      # https://www.loc.gov/preservation/digital/formats/fdd/fdd000470.shtml
+      # https://github.com/vnmabus/rdata/tree/develop/rdata/tests/data
+      # http://yetanothermathprogrammingconsultant.blogspot.com/2016/02/r-rdata-file-format.html
+      # This can read only binary: https://github.com/vnmabus/rdata
+      # TODO(pts): Also detect format=rdata if it's gzip-compressed, sometimes bzip2- or xz-compressed.
+      ('rdata', (0, ('RDX2\nX\n', 'RDX3\nX\n', 'RDA2\nA\n', 'RDA2\nB\n', 'RDX2\nB\n'))),
+      # R languge, writeRDS.
+      # Sample file: https://www.dropbox.com/s/e1tb76d57oqc79g/data_corpus_foreignaffairscommittee.rds?dl=1&v=1
+      # Sample file: https://www.dropbox.com/s/7mu92jzodpq11zc/data_corpus_guardian.rds?dl=1&v=1
+      # TODO(pts): Also detect format=rds if it's gzip-compressed, sometimes bzip2- or xz-compressed.
+      ('rds', (0, 'X\n\0\0\0', 5, ('\2', '\3'), 6, '\0', 7, ('\1', '\2', '\3', '\4', '\5', '\6'))),
+      ('rds', (0, 'A\n', 2, ('2', '3'), 3, '\n', 14, lambda header: adjust_confidence(387, count_is_rds_ascii(header)))),
+      # https://support.hdfgroup.org/release4/doc/DS.pdf
+      ('hdf4', (0, '\x0e\x03\x13\x01', 10, '\0\x1e\0\1')),
+      ('hdf4', (0, '\x0e\x03\x13\x01')),
+      # https://support.hdfgroup.org/HDF5/doc/H5.format.html#Superblock
+      ('hdf5', (0, '\x89HDF\r\n\x1a\n', 8, ('\0', '\1', '2'))),
+      # There is no signature in SDBM pag and dir files.
+      # See ext/SDBM_File/sdbm/sdbm.{c,h} in perl-5.10.1.tar.gz
+      ('sdbm-pag',),
+      ('sdbm-dir',),
+      # Probably there is no signature in DBM files (by Ken Thompson in 1978 and 1979).
+      # Source code and documentation are not available.
+      ('dbm',),
+      # http://fileformats.archiveteam.org/wiki/TDB_(Samba)
+      # struct tdb_header in common/tdb_private.h in https://www.samba.org/ftp/tdb/tdb-1.4.5.tar.gz
+      # The version (header[32 : 36]) is (0x26011967 + 6) between tdb-1.1.3 and tdb-1.4.5.
+      ('samba-tdb', (0, 'TDB file\n\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0', 36, lambda header: (len(header) >= 36 and (header[32 : 35] == '\x26\x01\x19' or header[33 : 36] == '\x19\x01\x26'), 300))),
+      # samba-ntdb is not in active use by Samba, it was a proposal in 2013.
+      # struct ntdb_header in struct ntdb_header in https://www.samba.org/ftp/tdb/ntdb-1.0.tar.gz
+      # The version (header[64 : 72]) is (0x26011967 + 7) in ntdb-1.0.
+      ('samba-ntdb', (0, 'NTDB file\n\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0', 72, lambda header: (len(header) >= 72 and (header[64 : 71] == '\0\0\0\0\x26\x01\x19' or header[65 : 72] == '\x19\x01\x26\0\0\0\0'), 300))),
+      # https://fallabs.com/qdbm/
+      # Search for magic in: https://fallabs.com/qdbm/spex.html
+      # https://fallabs.com/qdbm/qdbm-1.8.78.tar.gz
+      # Library version (header[12: 14]) is 14 in qdbm-1.8.78.
+      ('qdbm', (0, ('[DEPOT]\n\f\0\0\0', '[depot]\n\f\0\0\0'), 12, ('1\0\0\0', '2\0\0\0', '3\0\0\0', '4\0\0\0', '5\0\0\0', '6\0\0\0', '7\0\0\0', '8\0\0\0', '9\0\0\0', '10\0\0', '11\0\0', '12\0\0', '13\0\0', '14\0\0'))),
+      # Same as Apache Arrow Feather V1.
+      # https://github.com/wesm/feather/blob/master/doc/FORMAT.md
+      ('arrow-feather', (0, 'FEA1')),
+      # Same as Apache Arrow Feather V2.
+      # https://arrow.apache.org/docs/format/Columnar.html#ipc-file-format
+      ('arrow-ipc', (0, 'ARROW1\0\0')),
+      # ndbm and GDBM use the same format.
+      ('ndbm', (0, ('\x13\x57\x9a\xcd', '\x13\x57\x9a\xce', '\x13\x57\x9a\xcf', '\xcd\x9a\x57\x13', '\xce\x9a\x57\x13', '\xcf\x9a\x57\x13'))),
+      # https://www.gnu.org.ua/software/gdbm/manual/Numsync.html
+      ('gdbm-numsync', (0, ('\x13\x57\x9a\xd0', '\x13\x57\x9a\xd1', '\xd0\x9a\x57\x13', '\xd1\x9a\x57\x13'))),
+      # Created by `gdbm_dump --format=ascii'.
+      ('gdbm-export-ascii', (0, '# GDBM dump file created by ')),
+      # Created by `gdbm_dump --format=binary'.
+      ('gdbm-export-binary', (0, '!\r\n! GDBM FLAT FILE DUMP -- THIS IS NOT A TEXT FILE\r\n! ')),
+      # docs/programmer_reference/magic.txt in https://github.com/berkeleydb/libdb/releases/download/v5.3.28/db-5.3.28.tar.gz
+      ('berkeleydb', (0, ('\x00\x06\x15\x61', '\x61\x15\x06\x00'), 4, '\0\0\0', 7, ('\1', '\2', '\3', '\4', '\5', '\6', '\7', '\x08', '\x09'), 8, ('\0\0\x10\xe1', '\0\0\x04\xd2'))),
+      ('berkeleydb', (0, ('\x00\x05\x31\x62', '\x62\x31\x05\x00'), 4, ('\0\0\0\1', '\0\0\0\2', '\0\0\0\3', '\0\0\0\4', '\0\0\0\5', '\0\0\0\6', '\0\0\0\7', '\0\0\0\x08', '\0\0\0\x09', '\1\0\0\0', '\2\0\0\0', '\3\0\0\0', '\4\0\0\0', '\5\0\0\0', '\6\0\0\0', '\7\0\0\0', '\x08\0\0\0', '\x09\0\0\0'))),
+      # TODO(pts): Maybe values other than 0 and 1 are also valid in the first 12 bytes if Berkeley DB >=2.
+      ('berkeleydb', (0, '\0\0\0\0\0\0\0\0\0\0\0\1', 12, ('\x00\x04\x09\x88', '\x00\x05\x31\x62', '\x00\x06\x15\x61', '\x00\x07\x45\x82', '\x00\x04\x22\x53'), 16, '\0\0\0')),
+      ('berkeleydb', (0, '\0\0\0\0\1\0\0\0\0\0\0\0', 12, ('\x88\x09\x04\x00', '\x62\x31\x05\x00', '\x61\x15\x06\x00', '\x82\x45\x07\x00', '\x53\x22\x04\x00'), 17, '\0\0\0')),
+      # Created by `db_dump'.
+      # https://github.com/berkeleydb/libdb/releases/download/v5.3.28/db-5.3.28.tar.gz
+      ('berkeleydb-export', (0, 'VERSION=', 8, ('2', '3', '4', '5'), 9, '\n')),
+      ('berkeleydb-export', (0, 'format=print\n')),  # Version 1.
+      ('berkeleydb-export', (0, 'format=bytevalue\n')),  # Version 1.
+      # http://fallabs.com/tokyocabinet/spex-en.html
+      ('tokyocabinet', (0, 'ToKyO CaBiNeT\n', 24, '\0\0\0\0\0\0\0\0', 32, ('\0', '\1', '\2', '\3'))),
+      # https://dbmx.net/kyotocabinet/spex.html
+      # kchashdb.h in https://dbmx.net/kyotocabinet/pkg/kyotocabinet-1.2.79.tar.gz
+      # Record count (offset 32) file size (offset 40) are 64-bit big endian.
+      ('kyotocabinet', (0, 'KC\n\0', 4, tuple(chr(c) for c in xrange(1, 20)), 5, tuple(chr(c) for c in xrange(1, 20)), 6, tuple(chr(c) for c in xrange(1, 10)), 8, ('\x30', '\x31', '\x40', '\x41'), 32, '\0\0', 40, '\0\0')),
+      # https://github.com/wiredtiger/wiredtiger
+      ('wiredtiger-block', (0, '\x41\xd8\x01\x00\1\0', 7, '\0', 12, '\0\0\0\0')),
+      ('wiredtiger-log', (0, '\x64\x10\x10\x00', 5, '\0\0\0', 14, '\0\0')),
+      # https://dbmx.net/tkrzw/
+      # https://dbmx.net/tkrzw/pkg/tkrzw-1.0.18.tar.gz
+      ('tkrzw-tree', (0, 'TDB\0', 4, ('\0', '\1', '\2', '\3'), 34, ('\0', '\1'), 40, ('\0', '\1'))),
+      ('tkrzw-hash', (0, 'TkrzwHDB\n', 10, ('\1', '\2', '\3', '\4'), 16, '\0\0\0', 24, '\0\0', 32, '\0\0', 40, '\0\0')),
+      ('tkrzw-skip', (0, 'TkrzwSDB\n', 10, ('\1', '\2', '\3', '\4'), 24, '\0\0', 32, '\0\0', 40, '\0\0')),
+      ('tkrzw-queue', (0, 'TkrzwMQX\n')),
+      # http://hsqldb.org/download/hsqldb_251_jdk6/
+      # http://hsqldb.org/download/hsqldb_251_jdk6/hsqldb-2.3.8-jdk6-sources.jar
+      # http://hsqldb.org/download/hsqldb_251_jdk6/hsqldb-2.3.8-jdk6.jar
+      # http://hsqldb.org/download/hsqldb_251_jdk6/sqltool-2.3.8-jdk6.jar
+      # *.lck file.
+      ('hsqldb-lck', (0, 'HSQLLOCK')),
+      # *.script file.
+      # getPropertiesSQL in org/hsqldb/persist/Logger.java
+      # TODO(pts): Sometimes it's gzip-compressed (.gz) text file.
+      # There also used to be a a binary format, but not anymore in hsqldb-2.3.8.
+      ('hsqldb-script', (0, 'SET DATABASE UNIQUE NAME ')),
+      # *.properties file.
+      ('hsqldb-properties', (0, '#HSQL Database Engine ')),
+      # *.data file containing the cache after a `SHUTDOWN;' statement. It
+      # It doesn't have a signature, typically it starts with ~16 \0 bytes.
+      ('hsqldb-data',),
+      # *.log file.
+      # Sometimes the file is empty.
+      ('hsqldb-log', (0, '/*C', 64, lambda header: adjust_confidence(300, count_is_hsqldb_log(header)))),
+      # It doesn't have a signature. Sumetimes it's gzip-compressed (.gz).
+      ('hsqldb-backup',),
+      # It doesn't have a signature.
+      ('hsqldb-lobs',),
+
+      # fclass='crypto': Cryptography: encrypted files, keys, keychains.
+
       # https://tools.ietf.org/html/draft-ietf-openpgp-rfc4880bis-09#section-5.3
       # (0,' \x8c') is generated by gpg(1).
       # (1, ...) includes no session key, and session key with keytable size any of 16, 24 and 32.
@@ -10842,6 +11573,11 @@ def mediafileinfo_detect():
       ('ssh-public-keys', (0, 'sk-ecdsa-sha2-nistp256@openssh.com ')),
       ('ssh-public-keys', (0, 'sk-ecdsa-sha2-nistp384@openssh.com ')),
       ('ssh-public-keys', (0, 'sk-ecdsa-sha2-nistp521@openssh.com ')),
+      # smime.p7s file attachments.
+      ('pkcs7-signature', (0, '\x30\x80\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x02')),
+
+      # fclass='font'.
+
       # PostScript Type 1 font, ASCII.
       # http://fileformats.archiveteam.org/wiki/Adobe_Type_1
       ('pfa', (0, '%!PS-AdobeFont-1.', 17, ('0', '1'), 18, ': ')),  # .pfa
@@ -10870,7 +11606,6 @@ def mediafileinfo_detect():
   # TODO(pts): Move everything from here to analyze(..., format=...).
   ANALYZE_FUNCS_BY_FORMAT = {
       'deep': analyze_deep,
-      'pcx': analyze_pcx,
       'dcx': analyze_dcx,
       'xbm': analyze_xbm,
       'xpm': analyze_xpm,
@@ -10884,7 +11619,6 @@ def mediafileinfo_detect():
       'miff': analyze_miff,
       'jbig2': analyze_jbig2,
       'djvu': analyze_djvu,
-      'art': analyze_art,
       'webp': analyze_webp,
       'jpegxr': analyze_jpegxr,
       'flif': analyze_flif,
@@ -10941,11 +11675,7 @@ def mediafileinfo_detect():
       'pnot': analyze_pnot,
       'ac3': analyze_ac3,
       'dts': analyze_dts,
-      'bmp': analyze_bmp,
-      'rdi': analyze_rdi,
       'mng': analyze_mng,
-      'xml': analyze_xml,
-      'xml-comment': analyze_xml,
       'html': analyze_xml,
       'svg': analyze_xml,
       'smil': analyze_xml,
@@ -11068,6 +11798,8 @@ def mediafileinfo_formatdb():
   # import math; print ["\0"+"".join(chr(int(100. / 8 * math.log(i) / math.log(2))) for i in xrange(1, 1084))]'
   LOG2_SUB = '\0\0\x0c\x13\x19\x1d #%\')+,./0234566789::;<<==>??@@AABBBCCDDEEEFFFGGGHHHIIIJJJKKKKLLLLMMMMNNNNOOOOOPPPPPQQQQQRRRRRSSSSSSTTTTTTUUUUUUVVVVVVVWWWWWWWXXXXXXXXYYYYYYYYZZZZZZZZ[[[[[[[[[\\\\\\\\\\\\\\\\\\]]]]]]]]]]^^^^^^^^^^^___________```````````aaaaaaaaaaaaabbbbbbbbbbbbbcccccccccccccdddddddddddddddeeeeeeeeeeeeeeeeffffffffffffffffggggggggggggggggghhhhhhhhhhhhhhhhhhiiiiiiiiiiiiiiiiiiiijjjjjjjjjjjjjjjjjjjjkkkkkkkkkkkkkkkkkkkkklllllllllllllllllllllllmmmmmmmmmmmmmmmmmmmmmmmmnnnnnnnnnnnnnnnnnnnnnnnnnnoooooooooooooooooooooooooopppppppppppppppppppppppppppppqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrsssssssssssssssssssssssssssssssssttttttttttttttttttttttttttttttttttttuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwwxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzzz{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{{|||||||||||||||||||||||||||||||||||||||||||||||||||||||}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}~'
   assert len(LOG2_SUB) == 1084, 'Unexpected LOG2_SUB size.'
+  # True but slow: assert 50 == 100 - ord(LOG2_SUB[16])
+  # True but slow: assert 75 == 100 - ord(LOG2_SUB[4])
 
 
   def copy_info_from_tracks(info):
@@ -11291,7 +12023,7 @@ def mediafileinfo_formatdb():
           else:
             raise TypeError('Bad pattern type: %r' % type(pattern))
           if fps > header_size_limit:
-            raise ValueError('Header too long.')
+            raise ValueError('Header for format too long: format=%r spec=%r size=%d limit=%d' % (format, spec, fps, header_size_limit))
           hps = max(hps, fps)
         for prefix in get_spec_prefixes(spec, max_prefix_size=max_prefix_size):
           fbp2 = fbp[len(prefix)]
@@ -11301,7 +12033,7 @@ def mediafileinfo_formatdb():
             fbp2[prefix] = [format_spec]
       self.header_preread_size = hps  # Typically 64, we have 408.
       if hps > header_size_limit:
-        raise AssertionError('Header too long, maximum size is %s.' % header_size_limit)
+        raise AssertionError('Headers too long: size=%d limit=%d' % (hps, header_size_limit))
       self.formats_by_prefix = fbp
       self.formats = frozenset(item[0] for item in format_items)
 
@@ -11417,6 +12149,472 @@ def mediafileinfo_formatdb():
 
   return locals()
 
+@module
+def mediafileinfo_lines():
+  """Reading and writing lines of the mediafileinfo (.mfo) format.
+
+  See mediafileinfo_format.md for the format. This module works with
+  Python 2.4--2.7 and 3.x, so that sample clients (e.g. client.py) can also
+  use it.
+  """
+
+  import os
+  import re
+  import sys
+  import threading
+  import time
+  import zlib
+
+
+  class LineWriter(object):
+    """Buffered writer of complete lines to a file descriptor.
+
+    Lines are buffered until the buffer reaches flush_size bytes or the oldest
+    buffered line becomes flush_sec seconds old (whichever happens first), and
+    then the buffer is written with a single os.write call (per 1 GiB). Thus a
+    killed process leaves only whole lines behind, just like with an
+    unbuffered file and one write call per line, but with much fewer system
+    calls. The time-based flushes are done by a background thread, started
+    at the first write.
+
+    Optionally, the file descriptor is also fsync()ed after a flush if the
+    previous fsync was at least fsync_sec seconds ago.
+
+    Callers which need a response to be visible immediately (e.g. the --pipe
+    server) should call flush() explicitly after each response.
+
+    If a write fails, the unwritten data is kept in the buffer. An exception
+    raised by a flush in the background thread is re-raised by the next call
+    to write(), flush(), fsync() or close().
+
+    This class is thread-safe. close() must be called (e.g. with atexit) to
+    stop the background thread before the interpreter exits.
+    """
+
+    def __init__(self, fd, flush_size=65536, flush_sec=0.2, fsync_sec=None,
+                 do_close_fd=False):
+      self.fd = fd
+      self.flush_size = flush_size
+      self.flush_sec = flush_sec
+      self.fsync_sec = fsync_sec
+      self.do_close_fd = do_close_fd
+      self._buf = []
+      self._buf_size = 0
+      self._buf_time = 0  # time.time() of the first write to an empty _buf.
+      self._lock = threading.Lock()
+      self._cond = threading.Condition(self._lock)
+      self._thread = None
+      self._fsynced_at = time.time()
+      self._error = None  # Exception raised in the background thread.
+
+    def fileno(self):
+      return self.fd
+
+    def write(self, data):
+      """Buffers data, which must be a concatenation of complete lines."""
+      self._lock.acquire()
+      try:
+        if self.fd < 0:
+          raise ValueError('Write to closed LineWriter.')
+        self._raise_error_locked()
+        if not self._buf_size:
+          self._buf_time = time.time()
+          if self.flush_sec is not None:
+            if self._thread is None:
+              self._thread = threading.Thread(target=self._run_flusher)
+              self._thread.setDaemon(True)
+              self._thread.start()
+            self._cond.notify()
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size >= self.flush_size:
+          self._flush_locked()
+      finally:
+        self._lock.release()
+
+    def _run_flusher(self):
+      """Flushes the buffer flush_sec seconds after the first write to it."""
+      self._lock.acquire()
+      try:
+        while self.fd >= 0:
+          if not self._buf_size or self._error is not None:
+            self._cond.wait()  # Don't retry until the error is reported.
+            continue
+          delay = self._buf_time + self.flush_sec - time.time()
+          if delay > 0:
+            self._cond.wait(delay)
+          else:
+            try:
+              self._flush_locked()
+            except Exception:
+              self._error = sys.exc_info()[1]
+      finally:
+        self._lock.release()
+
+    def _raise_error_locked(self):
+      error = self._error
+      if error is not None:
+        self._error = None
+        self._cond.notify()  # Let the background thread retry.
+        raise error
+
+    def _flush_locked(self):
+      if not self._buf_size:
+        return
+      data = self._buf[0][:0].join(self._buf)  # Works with str and bytes.
+      i, size = 0, len(data)
+      try:
+        while i < size:
+          if i or size > 1 << 30:
+            i += os.write(self.fd, data[i : i + (1 << 30)])
+          else:  # Fast path without copying.
+            i += os.write(self.fd, data)
+      except:
+        self._buf[:] = [data[i:]]  # Keep the unwritten data for a retry.
+        self._buf_size = size - i
+        raise
+      del self._buf[:]
+      self._buf_size = 0
+      if (self.fsync_sec is not None and
+          time.time() >= self._fsynced_at + self.fsync_sec):
+        self._fsync_locked()
+
+    def _fsync_locked(self):
+      os.fsync(self.fd)
+      self._fsynced_at = time.time()
+
+    def flush(self):
+      self._lock.acquire()
+      try:
+        if self.fd >= 0:
+          self._raise_error_locked()
+          self._flush_locked()
+      finally:
+        self._lock.release()
+
+    def fsync(self):
+      """Flushes and fsync()s the file descriptor."""
+      self._lock.acquire()
+      try:
+        self._raise_error_locked()
+        self._flush_locked()
+        self._fsync_locked()
+      finally:
+        self._lock.release()
+
+    def close(self):
+      self._lock.acquire()
+      try:
+        thread, self._thread = self._thread, None
+        error, self._error = self._error, None
+        if self.fd >= 0:
+          try:
+            self._flush_locked()
+            if self.fsync_sec is not None:
+              self._fsync_locked()
+          finally:
+            if self.do_close_fd:
+              os.close(self.fd)
+            self.fd = -1
+            self._cond.notify()
+      finally:
+        self._lock.release()
+      if thread is not None and thread is not threading.currentThread():
+        thread.join()
+      if error is not None:
+        raise error
+
+
+  class RecordReader(object):
+    """Buffered reader of records (e.g. lines) from a file descriptor.
+
+    Unlike a file object, this supports any single-byte record terminator
+    (e.g. '\\0'), and the terminator can be changed between records.
+    readline() returns as soon as a complete record is available, it doesn't
+    wait for more data.
+    """
+
+    def __init__(self, fd, read_size=65536):
+      self.fd = fd
+      self.read_size = read_size
+      self._buf = ''.encode('ascii')
+      self._i = 0  # Start of unread data in self._buf.
+      self._nl = '\n'.encode('ascii')
+
+    def fileno(self):
+      return self.fd
+
+    def readline(self, terminator=None):
+      """Returns the next record including the terminator, or the partial
+      record without a terminator at EOF, or an empty string at EOF."""
+      if terminator is None:
+        terminator = self._nl
+      buf, i = self._buf, self._i
+      j = buf.find(terminator, i)
+      while j < 0:
+        data = os.read(self.fd, self.read_size)
+        if not data:
+          self._buf, self._i = buf[:0], 0
+          return buf[i:]
+        k = len(buf) - i
+        buf, i = buf[i:] + data, 0
+        j = buf.find(terminator, k)
+      self._buf, self._i = buf, j + 1
+      return buf[i : j + 1]
+
+
+  # --- Parsing mediainfo lines.
+
+  _bytes_type = type(''.encode('ascii'))
+
+
+  def _get_parse_consts(str_type):
+    if str_type is str:
+      encode = str
+      hex_to_char = lambda match: chr(int(match.group(1), 16))
+    else:  # bytes in Python 3.
+      encode = lambda s: s.encode('ascii')
+      hex_to_char = lambda match: str_type((int(match.group(1), 16),))
+    return (encode(' f='), encode(' '), encode('='), encode('%'),
+            encode('\n'), encode('f'),
+            re.compile(encode(r'%([0-9a-fA-F]{2})')), hex_to_char)
+
+
+  # (f_sep, item_sep, eq, percent, newline, f_key, percent_hex_re,
+  # hex_to_char) for str, and for bytes (if different, i.e. in Python 3).
+  _PARSE_CONSTS = {str: _get_parse_consts(str)}
+  if _bytes_type is not str:
+    _PARSE_CONSTS[_bytes_type] = _get_parse_consts(_bytes_type)
+
+
+  def decode_info_value(value):
+    """Decodes the %XX escapes in an info value (as written by format_info)."""
+    consts = _PARSE_CONSTS[type(value)]
+    if consts[3] not in value:  # Fast path.
+      return value
+    return consts[6].sub(consts[7], value)
+
+
+  def parse_info_fields(fields, keys=None, do_decode=True):
+    """Parses space-separated key=value fields of a mediainfo line to a dict.
+
+    Args:
+      fields: The part of the line before ` f=', a str (or bytes in Python 3).
+      keys: None to keep all fields, or a collection of the keys to keep.
+        Other fields are not decoded.
+      do_decode: Whether to decode %XX escapes in the values. If false, values
+        are kept encoded, and can be decoded later with decode_info_value.
+    Returns:
+      A dict mapping keys to values (of the same type as fields).
+    Raises:
+      ValueError: If a field is not key=value, or a key is duplicate or f.
+    """
+    item_sep, eq, percent, _, f_key, percent_hex_re, hex_to_char = (
+        _PARSE_CONSTS[type(fields)][1:])
+    items = fields.split(item_sep)
+    try:
+      info = dict([item.split(eq, 1) for item in items])  # Fast, in C.
+    except ValueError:
+      for item in items:
+        if eq not in item:
+          raise ValueError('Expected key=value, got: %r' % item)
+      raise
+    if len(info) != len(items) or f_key in info:
+      seen = {}
+      for item in items:
+        key = item.split(eq, 1)[0]
+        if key in seen or key == f_key:
+          raise ValueError('Duplicate key %r in info line %r' % (key, fields))
+        seen[key] = True
+    if keys is not None:
+      info = dict([(key, info[key]) for key in keys if key in info])
+    if do_decode and percent in fields:  # Most lines don't have %XX.
+      for key, value in list(info.items()):
+        if percent in value:
+          info[key] = percent_hex_re.sub(hex_to_char, value)
+    return info
+
+
+  def parse_info_line(line, keys=None, do_decode=True):
+    """Parses a mediainfo line (format_info output) to a dict.
+
+    The filename (f=, always present in the result) is never decoded. See
+    parse_info_fields for the arguments.
+
+    Raises:
+      ValueError: If the line is malformed.
+    """
+    consts = _PARSE_CONSTS[type(line)]
+    if line.endswith(consts[4]):
+      line = line[:-1]  # Don't remove '\r', it's binary.
+    i = line.find(consts[0])
+    if i < 0:
+      raise ValueError('f= not found in line: %r' % line)
+    info = parse_info_fields(line[:i], keys, do_decode)
+    info[consts[5]] = line[i + 3:]
+    return info
+
+
+  def iter_info_lines(line_source, keys=None, do_decode=True):
+    """Yields the parsed lines of line_source (e.g. a file) lazily.
+
+    See parse_info_line for the arguments.
+    """
+    for line in line_source:
+      yield parse_info_line(line, keys, do_decode)
+
+
+  # --- Formatting mediainfo lines.
+
+
+  def _format_bool(v):
+    return str(int(v))
+
+
+  def _format_float(v):
+    if abs(v) < 1e15 and int(v) == v:  # Remove the trailing '.0'.
+      return str(int(v))
+    return repr(v)
+
+
+  def _encode_str(v):
+    # Most values don't need escaping, and `in' is faster than .replace.
+    if '%' in v or ' ' in v or '\n' in v or '\0' in v:
+      return (v.replace('%', '%25').replace('\0', '%00').replace('\n', '%0A')
+              .replace(' ', '%20'))
+    return v
+
+
+  def _check_encoded_str(v):
+    if ' ' in v or '\n' in v:
+      raise ValueError('Bad info string value: %r' % v)
+    return v
+
+
+  def _get_value_formatters(format_str):
+    """Returns a dict mapping value types to formatter functions.
+
+    None as a formatter means that values of that type are omitted.
+    """
+    formatters = {bool: _format_bool, int: str, type(1 << 64): str,
+                  float: _format_float, str: format_str}
+    for type_obj in (tuple, list, dict, set):
+      formatters[type_obj] = None
+    return formatters
+
+
+  # Dispatch tables by exact type, for format_info(..., do_encode=...).
+  _VALUE_FORMATTERS = {True: _get_value_formatters(_encode_str),
+                       False: _get_value_formatters(_check_encoded_str)}
+
+
+  def _get_subclass_formatter(formatters, type_obj):
+    """Finds the formatter of a subclass (slow path) and caches it."""
+    for base_type in (bool, int, type(1 << 64), float, str,
+                      tuple, list, dict, set):
+      if issubclass(type_obj, base_type):
+        formatters[type_obj] = formatter = formatters[base_type]
+        return formatter
+    raise TypeError(type_obj)
+
+
+  def format_info(info, terminator='\n', do_encode=True):
+    """Formats an info dict as a mediainfo line.
+
+    The output is format=... first, then the other fields sorted by key, and
+    then f=... (unescaped) last. Values of type tuple, list, dict and set are
+    omitted.
+
+    Args:
+      info: A dict mapping str keys to values.
+      terminator: The line terminator, '\\n' or '\\0'.
+      do_encode: Whether to %XX-escape str values. If false, the values must
+        already be escaped (e.g. parsed with do_decode=False).
+    Returns:
+      The line as a str.
+    Raises:
+      ValueError: If the filename or a value (with do_encode=False) contains
+        an invalid byte.
+      TypeError: If a value has an unsupported type.
+    """
+    formatters = _VALUE_FORMATTERS[bool(do_encode)]
+    value = info.get('format') or '?'
+    try:
+      formatter = formatters[type(value)]
+    except KeyError:
+      formatter = _get_subclass_formatter(formatters, type(value))
+    if formatter is None:
+      raise TypeError(type(value))
+    output = ['format=', formatter(value)]
+    for key, value in sorted(info.items()):
+      if key != 'f' and key != 'format':
+        try:
+          formatter = formatters[type(value)]
+        except KeyError:
+          formatter = _get_subclass_formatter(formatters, type(value))
+        if formatter is not None:
+          output.append(' %s=%s' % (key, formatter(value)))
+    filename = info.get('f')
+    if filename is not None:
+      if '\0' in filename or (terminator == '\n' and '\n' in filename):
+        raise ValueError('Invalid byte in filename: %r' % filename)
+      output.append(' f=')  # Emit ` f=' last.
+      output.append(filename)
+    output.append(terminator)
+    return ''.join(output)
+
+
+  # --- Sharding: splitting a scan among multiple independent runs.
+  #
+  # With --shard=i/N (media_scan.py and mediafileinfo.py), each of the N runs
+  # scans a disjoint part of the same directory trees, without coordination.
+  # Directories within --shard-depth= (the command-line arguments have depth
+  # 1) are split: their files and subdirectories are assigned to a shard by a
+  # hash of their path. Each deeper subdirectory, with its entire subtree,
+  # belongs to a single shard. The decisions depend only on the path (not on
+  # e.g. the number of entries, which may change between the runs), so the
+  # shards are disjoint and together they cover everything.
+  #
+
+
+  def get_shard_index(path, shard_count):
+    """Returns the shard index of path, the same on all platforms."""
+    return (zlib.crc32(path) & 0xffffffff) % shard_count
+
+
+  def get_shard_subdir_depth(path, shard_depth, shard):
+    """Decides about a subdirectory of a split directory.
+
+    Args:
+      path: Path of the subdirectory.
+      shard_depth: Depth of the split parent directory. The (virtual) parent
+        of the command-line arguments has depth 0.
+      shard: A (shard_index, shard_count, max_split_depth) tuple.
+    Returns:
+      (is_in_shard, subdir_shard_depth) pair. If is_in_shard is false, the
+      subdirectory should be skipped. subdir_shard_depth is None if the entire
+      subtree is in the shard, otherwise it is the depth of path, and its
+      entries have to be filtered.
+    """
+    shard_index, shard_count, max_split_depth = shard
+    shard_depth += 1
+    if shard_depth <= max_split_depth:
+      return True, shard_depth
+    return get_shard_index(path, shard_count) == shard_index, None
+
+
+  def parse_shard_flag(value):
+    """Parses the i/N value of --shard=, returns (shard_index, shard_count)."""
+    try:
+      shard_index, shard_count = map(int, value.split('/'))
+    except ValueError:
+      shard_index = shard_count = 0
+    if not 0 <= shard_index < shard_count:
+      raise ValueError('Bad shard, expected i/N with 0 <= i < N: %s' % value)
+    return shard_index, shard_count
+
+  return locals()
+
 
 import os
 import os.path
@@ -11428,35 +12626,7 @@ ANALYZE = mediafileinfo_formatdb.FormatDb(mediafileinfo_detect).analyze
 ANALYZE_FUNCS_BY_FORMAT = mediafileinfo_formatdb.get_analyze_funcs_by_format(mediafileinfo_detect)
 
 
-def format_info(info):
-  def format_value(v):
-    if isinstance(v, bool):
-      return int(v)
-    if isinstance(v, float):
-      if abs(v) < 1e15 and int(v) == v:  # Remove the trailing '.0'.
-        return int(v)
-      return repr(v)
-    if isinstance(v, (int, long)):
-      return str(v)
-    if isinstance(v, str):
-      # Faster than a regexp if there are no matches.
-      return (v.replace('%', '%25').replace('\0', '%00').replace('\n', '%0A')
-              .replace(' ', '%20'))
-    raise TypeError(type(v))
-  output = ['format=%s' % format_value(info.get('format') or '?')]
-  # TODO(pts): Display brands list.
-  output.extend(
-      ' %s=%s' % (k, format_value(v))
-      for k, v in sorted(info.iteritems())
-      if k != 'f' and k != 'format' and
-      not isinstance(v, (tuple, list, dict, set)))
-  filename = info.get('f')
-  if filename is not None:
-    if '\n' in filename or '\0' in filename:
-      raise ValueError('Invalid byte in filename: %r' % filename)
-    output.append(' f=%s' % filename)  # Emit ` f=' last.
-  output.append('\n')
-  return ''.join(output)
+format_info = mediafileinfo_lines.format_info
 
 
 def get_file_info(filename, stat_obj):
@@ -11541,8 +12711,25 @@ def get_symlink_info(filename, stat_obj):
   return info, False
 
 
-def info_scan(dirname, outf, get_file_info_func, has_lstat):
-  """Prints results sorted by filename."""
+# --- Sharding: see mediafileinfo_lines.py .
+
+
+get_shard_index = mediafileinfo_lines.get_shard_index
+get_shard_subdir_depth = mediafileinfo_lines.get_shard_subdir_depth
+parse_shard_flag = mediafileinfo_lines.parse_shard_flag
+
+
+# ---
+
+
+def info_scan(dirname, outf, get_file_info_func, has_lstat, shard=None, shard_depth=None):
+  """Prints results sorted by filename.
+
+  Args:
+    shard: None or a (shard_index, shard_count, shard_depth) tuple.
+    shard_depth: None if all entries in dirname are in the shard, otherwise
+      the depth of dirname. See get_shard_subdir_depth for details.
+  """
   had_error = False
   try:
     entries = os.listdir(dirname)
@@ -11568,6 +12755,8 @@ def info_scan(dirname, outf, get_file_info_func, has_lstat):
       had_error = True
     elif stat.S_ISDIR(stat_obj.st_mode):
       subdirs.append(filename)
+    elif shard_depth is not None and get_shard_index(filename, shard[1]) != shard[0]:
+      pass
     elif (stat.S_ISREG(stat_obj.st_mode) or
           stat.S_ISLNK(stat_obj.st_mode)):
       files.append((filename, stat_obj))
@@ -11582,13 +12771,18 @@ def info_scan(dirname, outf, get_file_info_func, has_lstat):
       print >>sys.stderr, 'warning: unknown file format: %r' % filename
       had_error = True
     outf.write(format_info(info))
-    outf.flush()
   for filename in sorted(subdirs):
-    had_error |= info_scan(filename, outf, get_file_info_func, has_lstat)
+    subdir_shard_depth = None
+    if shard_depth is not None:
+      is_in_shard, subdir_shard_depth = get_shard_subdir_depth(
+          filename, shard_depth, shard)
+      if not is_in_shard:
+        continue
+    had_error |= info_scan(filename, outf, get_file_info_func, has_lstat, shard, subdir_shard_depth)
   return had_error
 
 
-def process(filename, outf, get_file_info_func, has_lstat):
+def process(filename, outf, get_file_info_func, has_lstat, shard=None):
   """Prints results sorted by filename."""
   try:
     if has_lstat:
@@ -11599,11 +12793,17 @@ def process(filename, outf, get_file_info_func, has_lstat):
     print >>sys.stderr, 'error: missing file %r: %s' % (filename, e)
     return True
   if stat.S_ISDIR(stat_obj.st_mode):
-    return info_scan(filename, outf, get_file_info_func, has_lstat)
+    shard_depth = None
+    if shard:
+      is_in_shard, shard_depth = get_shard_subdir_depth(filename, 0, shard)
+      if not is_in_shard:
+        return False
+    return info_scan(filename, outf, get_file_info_func, has_lstat, shard, shard_depth)
+  elif shard and get_shard_index(filename, shard[1]) != shard[0]:
+    return False
   elif stat.S_ISREG(stat_obj.st_mode):
     info, had_error = get_file_info_func(filename, stat_obj)
     outf.write(format_info(info))
-    outf.flush()
     if not had_error and info.get('format') == '?':
       print >>sys.stderr, 'warning: unknown file format: %r' % filename
       had_error = True
@@ -11611,46 +12811,507 @@ def process(filename, outf, get_file_info_func, has_lstat):
   elif has_lstat and stat.S_ISLNK(stat_obj.st_mode):
     info, had_error = get_symlink_info(filename, stat_obj)
     outf.write(format_info(info))
-    outf.flush()
     return had_error
   else:
     return False
 
 
-def run_pipe(inf, outf, get_file_info_func, has_lstat):
+def get_pipe_response(filename, get_file_info_func, has_lstat,
+                      terminator='\n'):
+  """Returns the response record (including the terminator) for filename."""
+  try:
+    if has_lstat:
+      stat_obj = os.lstat(filename)
+    else:
+      stat_obj = os.stat(filename)
+  except OSError, e:
+    stat_obj = None
+  if stat_obj is None:
+    return 'format=? error=missing_file f=%s%s' % (filename, terminator)
+  elif stat.S_ISDIR(stat_obj.st_mode):
+    return 'format=? error=is_dir f=%s%s' % (filename, terminator)
+  elif stat.S_ISREG(stat_obj.st_mode):
+    # This returns 'format=? ... error=...' upon an error.
+    info, had_error = get_file_info_func(filename, stat_obj)
+    if info is None:  # File disappeared or unreadable.
+      return 'format=? error=missing_file f=%s%s' % (filename, terminator)
+    return format_info(info, terminator)
+  elif has_lstat and stat.S_ISLNK(stat_obj.st_mode):
+    info, had_error = get_symlink_info(filename, stat_obj)
+    return format_info(info, terminator)
+  else:  # Not a file or directory.
+    return 'format=? error=bad_node f=%s%s' % (filename, terminator)
+
+
+def parse_pipe_options(line):
+  """Parses the `!v2 key=value ...' handshake line, returns a dict."""
+  options = {}
+  for item in line.split(' ')[1:]:
+    if item:
+      key, value = (item.split('=', 1) + [''])[:2]
+      options[key] = value
+  return options
+
+
+def get_pipe_record_value(record, terminator):
+  if terminator == '\n':
+    return record.rstrip('\r\n')  # Either, both etc.
+  return record[:-1]
+
+
+def read_pipe_batch(inf, terminator):
+  """Reads the filenames of a !batch request, up to an empty record.
+
+  Returns the list of filenames, or None if EOF or an incomplete record was
+  reached before the empty record.
+  """
+  filenames = []
+  while 1:
+    record = inf.readline(terminator)
+    if not record.endswith(terminator):
+      return None
+    filename = get_pipe_record_value(record, terminator)
+    if not filename:
+      return filenames
+    filenames.append(filename)
+
+
+def run_pipe(inf, outf, get_file_info_func, has_lstat,
+             workers=4, max_in_flight=64, max_requests=0):
+  """Serves requests on inf, flushing outf after each response.
+
+  inf must be a mediafileinfo_lines.RecordReader or similar. If the first
+  line is a handshake (`!v1 ...' or `!v2 ...'), then the session is
+  extended: it has the options (e.g. framing=nul) specified in the
+  handshake, and it accepts !batch requests. `!v2' makes requests
+  concurrent, see run_pipe_v2. Otherwise requests are served one by one,
+  in order.
+
+  If max_requests is positive, stops reading requests after that many
+  (each filename in a !batch counts as a request), and returns when their
+  responses have been written.
+
+  Returns:
+    The number of requests served.
+  """
   import signal
   signal.signal(signal.SIGINT, signal.SIG_DFL)  # Prevent KeyboardInterrupt.
-  while 1:
-    line = inf.readline()
-    if not line:
-      break
-    if not line.endswith('\n'):
-      outf.write('format=? error=incomplete_line\n')
+  line = inf.readline()
+  terminator, is_extended = '\n', False
+  if line.endswith('\n') and line[:3] in ('!v1', '!v2'):
+    version = line[:3]
+    value = get_pipe_record_value(line, '\n')
+    if value == version or value.startswith(version + ' '):
+      options = parse_pipe_options(value)
+      if options.get('framing') == 'nul':
+        terminator = '\0'
+      if version == '!v2':
+        return run_pipe_v2(inf, outf, get_file_info_func, has_lstat, options,
+                           terminator, workers, max_in_flight, max_requests)
+      outf.write('!v1 framing=%s\n' % ('line', 'nul')[terminator == '\0'])
+      outf.flush()
+      line, is_extended = inf.readline(terminator), True
+  request_count = 0
+  while line:
+    if not line.endswith(terminator):
+      outf.write('format=? error=incomplete_line%s' % terminator)
       outf.flush()
       break
-    filename = line = line.rstrip('\r\n')  # Either, both etc.
+    filename = get_pipe_record_value(line, terminator)
+    if is_extended and filename == '!batch':
+      filenames = read_pipe_batch(inf, terminator)
+      if filenames is None:
+        outf.write('format=? error=incomplete_batch%s' % terminator)
+        outf.flush()
+        break
+      output = [get_pipe_response(
+          filename, get_file_info_func, has_lstat, terminator)
+          for filename in filenames]
+      output.append('!end%s' % terminator)
+      outf.write(''.join(output))
+      request_count += len(filenames)
+    else:
+      outf.write(get_pipe_response(
+          filename, get_file_info_func, has_lstat, terminator))
+      request_count += 1
+    outf.flush()
+    if max_requests > 0 and request_count >= max_requests:
+      break
+    line = inf.readline(terminator)
+  return request_count
+
+
+def run_pipe_v2(inf, outf, get_file_info_func, has_lstat, options,
+                terminator, workers, max_in_flight, max_requests=0):
+  """Serves `<id> <filename>' and `<id> !batch' requests on inf concurrently.
+
+  Responses are written as `<id> <response>' records in the order they are
+  ready, which is not necessarily the request order. The responses of a
+  batch are written together (followed by `<id> !end'), in request order.
+  At most max_in_flight requests are being processed (or waiting for a
+  worker thread) at a time; when this limit is reached, no more requests
+  are read from inf. Returns the number of requests served, stopping after
+  max_requests (if positive) like run_pipe.
+  """
+  import Queue
+  import threading
+  try:
+    client_max_in_flight = int(options.get('max_in_flight') or 0)
+  except ValueError:
+    client_max_in_flight = 0
+  if client_max_in_flight > 0:
+    max_in_flight = min(max_in_flight, client_max_in_flight)
+  max_in_flight = max(max_in_flight, 1)
+  workers = max(min(workers, max_in_flight), 1)
+  outf.write('!v2 framing=%s max_in_flight=%d workers=%d\n' % (
+      ('line', 'nul')[terminator == '\0'], max_in_flight, workers))
+  outf.flush()
+  in_flight = threading.Semaphore(max_in_flight)
+  request_queue = Queue.Queue()
+
+  def get_response(filename):
     try:
-      if has_lstat:
-        stat_obj = os.lstat(filename)
+      return get_pipe_response(
+          filename, get_file_info_func, has_lstat, terminator)
+    except (KeyboardInterrupt, SystemExit):
+      raise
+    except Exception, e:
+      print >>sys.stderr, 'error: error detecting in %r: %s.%s: %s' % (
+          filename, e.__class__.__module__, e.__class__.__name__, e)
+      return 'format=? error=error f=%s%s' % (filename, terminator)
+
+  def worker():
+    while 1:
+      request = request_queue.get()
+      if request is None:
+        break
+      request_id, filename = request
+      try:
+        if isinstance(filename, list):  # !batch.
+          output = ['%s %s' % (request_id, get_response(filename2))
+                    for filename2 in filename]
+          output.append('%s !end%s' % (request_id, terminator))
+          outf.write(''.join(output))
+        else:
+          outf.write('%s %s' % (request_id, get_response(filename)))
+        outf.flush()
+      finally:
+        in_flight.release()
+
+  threads = []
+  for _ in xrange(workers):
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    threads.append(thread)
+  request_count = 0
+  try:
+    while not (max_requests > 0 and request_count >= max_requests):
+      line = inf.readline(terminator)
+      if not line:
+        break
+      if not line.endswith(terminator):
+        outf.write('- format=? error=incomplete_line%s' % terminator)
+        outf.flush()
+        break
+      line = get_pipe_record_value(line, terminator)
+      i = line.find(' ')
+      if i <= 0:
+        outf.write('- format=? error=bad_request%s' % terminator)
+        outf.flush()
+        continue
+      request_id, filename = line[:i], line[i + 1:]
+      if filename == '!batch':
+        filename = read_pipe_batch(inf, terminator)
+        if filename is None:
+          outf.write('%s format=? error=incomplete_batch%s' % (
+              request_id, terminator))
+          outf.flush()
+          break
+        request_count += len(filename)
       else:
-        stat_obj = os.stat(filename)
+        request_count += 1
+      in_flight.acquire()
+      request_queue.put((request_id, filename))
+  finally:
+    for _ in threads:
+      request_queue.put(None)
+    for thread in threads:
+      thread.join()
+  return request_count
+
+
+# --- Daemon serving the --pipe protocol on a Unix domain socket.
+
+
+def open_daemon_socket(socket_path, backlog):
+  """Returns a listening Unix domain socket.
+
+  If the environment variable MEDIAFILEINFO_DAEMON_FD is set (by
+  run_daemon after a SIGHUP), reuses the listening socket with that file
+  descriptor instead of creating a new one.
+  """
+  import errno
+  import socket
+  fd = os.environ.pop('MEDIAFILEINFO_DAEMON_FD', '')
+  if fd:
+    fd = int(fd)
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)  # socket.fromfd has dup()ed it.
+    return sock
+  if os.path.exists(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      try:
+        sock.connect(socket_path)
+      except socket.error, e:
+        if e.args[0] not in (errno.ECONNREFUSED, errno.ENOENT):
+          raise
+      else:
+        raise RuntimeError('Daemon already listening on: %s' % socket_path)
+    finally:
+      sock.close()
+    os.remove(socket_path)  # Stale socket of a dead daemon.
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.bind(socket_path)
+  sock.listen(backlog)
+  return sock
+
+
+def serve_daemon_worker(sock, get_file_info_func, has_lstat,
+                        workers, max_in_flight, max_connections,
+                        max_requests=0):
+  """Accepts and serves connections one by one, until SIGHUP or SIGTERM.
+
+  Runs in a preforked child process of run_daemon. The signal only takes
+  effect when the current connection has been closed by the client. Also
+  returns after max_connections connections or max_requests requests (if
+  positive), so that run_daemon replaces the worker with a fresh fork. When
+  max_requests is reached in the middle of a connection, the responses are
+  finished, and then the connection is closed: the client has to reconnect
+  and resend the requests it hasn't received a response for.
+  """
+  import errno
+  import select
+  import signal
+  import socket
+  state = {'is_stopping': False}
+  def handle_stop(signum, frame):
+    state['is_stopping'] = True
+  for signum in (signal.SIGHUP, signal.SIGTERM):
+    signal.signal(signum, handle_stop)
+    if callable(getattr(signal, 'siginterrupt', None)):
+      signal.siginterrupt(signum, False)  # Restart reads and writes.
+  sock.setblocking(False)  # Other workers may accept the connection first.
+  connection_count = request_count = 0
+  while not state['is_stopping']:
+    try:
+      select.select((sock,), (), ())
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      continue
+    try:
+      conn = sock.accept()[0]
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        raise
+      continue
+    conn.setblocking(True)
+    inf = mediafileinfo_lines.RecordReader(conn.fileno())
+    outf = mediafileinfo_lines.LineWriter(conn.fileno(), flush_sec=None)
+    try:
+      try:
+        request_count += run_pipe(
+            inf, outf, get_file_info_func, has_lstat, workers, max_in_flight,
+            max_requests and max_requests - request_count)
+        outf.close()
+        # Signal EOF, and read the unserved requests, so that the client
+        # gets EOF (rather than ECONNRESET) after the last response.
+        conn.shutdown(socket.SHUT_WR)
+        while conn.recv(65536):
+          pass
+      except (IOError, OSError, socket.error), e:
+        if e.args[0] not in (errno.EPIPE, errno.ECONNRESET):
+          raise
+    finally:
+      conn.close()
+    connection_count += 1
+    if ((max_connections > 0 and connection_count >= max_connections) or
+        (max_requests > 0 and request_count >= max_requests)):
+      break
+
+
+def preload_for_fork():
+  """Prepares the process for forking many long-lived workers.
+
+  Forked workers share memory pages with the parent until either of them
+  writes to the page. CPython writes to an object when its reference count
+  changes (this can't be avoided) and when the cyclic garbage collector
+  traverses it: a full collection in a worker touches every container
+  object, thus it makes most of the heap private to the worker. To keep
+  the large constant tables (e.g. FORMAT_ITEMS and the prefix tables of
+  FORMAT_DB) shared, this function imports everything the workers need,
+  collects garbage created so far (so that the heap is compact), and
+  disables full (generation 2) collections, or freezes the existing
+  objects with gc.freeze() if available (Python >=3.7). Collections of
+  young generations still happen in the workers.
+
+  Without gc.freeze(), cyclic garbage which survives into generation 2 in
+  a worker is never freed, so run_daemon recycles the workers after
+  max_connections connections instead.
+  """
+  import gc
+  # Import modules which would be imported lazily by the workers. The
+  # FormatDb and the analyzer maps have already been built at import time.
+  import errno
+  import Queue
+  import select
+  import signal
+  import socket
+  import threading
+  import zlib
+  gc.collect()
+  if callable(getattr(gc, 'freeze', None)):
+    gc.freeze()
+  else:
+    threshold0, threshold1 = gc.get_threshold()[:2]
+    gc.set_threshold(threshold0, threshold1, 1 << 30)
+
+
+def get_process_memory(pid='self'):
+  """Returns (rss, private_rss) of the process in bytes, or None.
+
+  private_rss is the size of pages not shared with any other process (e.g.
+  pages copied after fork). Works on Linux only.
+  """
+  for filename in ('/proc/%s/smaps_rollup' % pid, '/proc/%s/smaps' % pid):
+    try:
+      f = open(filename)
+    except IOError:
+      continue
+    try:
+      rss = private_rss = 0
+      for line in f:
+        if line.startswith('Rss:'):
+          rss += int(line.split()[1]) << 10
+        elif line.startswith('Private_'):  # Private_Clean or Private_Dirty.
+          private_rss += int(line.split()[1]) << 10
+    finally:
+      f.close()
+    return rss, private_rss
+  return None
+
+
+def report_daemon_memory(pids):
+  """Prints memory usage of the daemon and its workers to stderr."""
+  for pid in [os.getpid()] + sorted(pids):
+    memory = get_process_memory(pid)
+    if memory:
+      print >>sys.stderr, (
+          'info: memory %s pid=%d rss=%d private_rss=%d shared_rss=%d' %
+          (('worker', 'daemon')[pid == os.getpid()], pid, memory[0],
+           memory[1], memory[0] - memory[1]))
+
+
+def run_daemon(socket_path, get_file_info_func, has_lstat, processes,
+               workers, max_in_flight, backlog, max_connections,
+               max_requests=0):
+  """Serves the --pipe protocol on a Unix domain socket.
+
+  Forks processes worker processes (after the analyzer modules have been
+  loaded), each of them serving one connection at a time. While all of them
+  are busy, new connections wait in the listen queue of the socket (at most
+  backlog of them). Worker processes which exit are restarted.
+
+  Each worker exits after serving max_connections connections or
+  max_requests requests (0 means unlimited), whichever comes first, and a
+  fresh one is forked (see serve_daemon_worker for long connections). This
+  is a trade-off: full
+  garbage collections are disabled in the workers (see preload_for_fork)
+  to keep the heap shared with the daemon, so cyclic garbage in the oldest
+  generation accumulates until the worker exits. A smaller value bounds
+  the memory growth of the workers, a larger value saves the forks (and
+  the page copies after them, a few MB per worker).
+
+  On SIGHUP, the daemon reloads gracefully: old workers finish their
+  current connection and then exit, and the daemon re-executes itself
+  with the same listening socket. On SIGTERM or SIGINT, the daemon
+  waits for the workers to finish their current connection, then exits.
+  On SIGUSR1, the daemon reports the memory usage of the workers.
+  """
+  import errno
+  import signal
+  import time
+  sock = open_daemon_socket(socket_path, backlog)
+  state = {'signum': None, 'is_report_pending': False}
+  def handle_signal(signum, frame):
+    state['signum'] = signum
+  def handle_report(signum, frame):
+    state['is_report_pending'] = True
+  for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+    signal.signal(signum, handle_signal)
+  signal.signal(signal.SIGUSR1, handle_report)
+  pids = {}  # Maps pid to start time.
+  preload_for_fork()
+  print >>sys.stderr, 'info: daemon listening on %s with %d processes' % (
+      socket_path, processes)
+  while 1:
+    if state['signum'] is not None:
+      break
+    if state['is_report_pending']:
+      state['is_report_pending'] = False
+      report_daemon_memory(pids)
+    while len(pids) < processes:
+      pid = os.fork()
+      if not pid:
+        exit_code = 1
+        try:
+          try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+              signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            if state['signum'] is None:
+              serve_daemon_worker(sock, get_file_info_func, has_lstat,
+                                  workers, max_in_flight, max_connections,
+                                  max_requests)
+            exit_code = 0
+          except:
+            sys.excepthook(*sys.exc_info())
+        finally:
+          os._exit(exit_code)
+      pids[pid] = time.time()
+    try:
+      pid, status = os.wait()
     except OSError, e:
-      stat_obj = None
-    if stat_obj is None:
-      response = 'format=? error=missing_file f=%s\n' % filename
-    elif stat.S_ISDIR(stat_obj.st_mode):
-      response = 'format=? error=is_dir f=%s\n' % filename
-    elif stat.S_ISREG(stat_obj.st_mode):
-      # This returns 'format=? ... error=...' upon an error.
-      info, had_error = get_file_info_func(filename, stat_obj)
-      response = format_info(info)
-    elif has_lstat and stat.S_ISLNK(stat_obj.st_mode):
-      info, had_error = get_symlink_info(filename, stat_obj)
-      response = format_info(info)
-    else:  # Not a file or directory.
-      response = 'format=? error=bad_node f=%s\n' % filename
-    outf.write(response)
-    outf.flush()
+      if e.args[0] != errno.EINTR:
+        raise
+      continue
+    started_at = pids.pop(pid, None)
+    if started_at is not None and status:
+      print >>sys.stderr, 'error: daemon worker %d failed with status 0x%x' % (
+          pid, status)
+      if time.time() - started_at < 1:
+        time.sleep(1)  # Avoid a busy loop of failing forks.
+  for pid in pids:
+    try:
+      os.kill(pid, signal.SIGHUP)  # Finish current connection, then exit.
+    except OSError:
+      pass
+  if state['signum'] == signal.SIGHUP:
+    print >>sys.stderr, 'info: daemon reloading'
+    # The old workers remain our children, os.wait() will reap them.
+    os.environ['MEDIAFILEINFO_DAEMON_FD'] = str(sock.fileno())
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+  while pids:
+    try:
+      pids.pop(os.wait()[0], None)
+    except OSError, e:
+      if e.args[0] != errno.EINTR:
+        raise
+  sock.close()
+  os.remove(socket_path)
+  print >>sys.stderr, 'info: daemon stopped'
 
 
 # ---
@@ -11671,21 +13332,70 @@ def main(argv):
         'This is free software, GNU GPL >=2.0. '
         'There is NO WARRANTY. Use at your risk.\n'
         'Usage: %s [<flag> ...] <filename> [...]\n'
-        '    or %s --pipe [--quick]\n'
-        % (argv[0], argv[0]))
+        '    or %s --pipe [--quick] [--workers=<n>] [--max-in-flight=<n>]\n'
+        '    or %s --daemon=<socket> [--processes=<n>] [--backlog=<n>] '
+        '[--max-connections=<n>] [--max-requests=<n>] [<pipe-flag> ...]\n'
+        '--max-connections=<n> restarts each daemon worker after <n> '
+        'connections (default: 100, 0: never),\n'
+        '--max-requests=<n> after <n> requests (default: 100000, 0: never; '
+        'then the client\n'
+        'has to reconnect and resend the unanswered requests), freeing its '
+        'garbage: full\n'
+        'garbage collections are disabled in the workers to keep their '
+        'memory shared with\n'
+        'the daemon.\n'
+        % (argv[0], argv[0], argv[0]))
     sys.exit(1)
   has_lstat = callable(getattr(os, 'lstat', None))
-  if argv[1] == '--pipe':
+  if argv[1] == '--pipe' or argv[1].startswith('--daemon='):
     mode = 'info'
-    if len(argv) > 2 and argv[2] == '--quick':
-      mode = 'quick'
+    workers, max_in_flight = 4, 64  # Only used by protocol v2.
+    # Only for --daemon=.
+    processes, backlog, max_connections, max_requests = 4, 128, 100, 100000
+    for arg in argv[2:]:
+      if arg in ('--quick', '--mode=quick'):
+        mode = 'quick'
+      elif arg in ('--info', '--mode=info'):
+        mode = 'info'
+      elif arg.startswith('--workers='):
+        workers = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--max-in-flight='):
+        max_in_flight = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--processes='):
+        processes = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--backlog='):
+        backlog = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--max-connections='):
+        max_connections = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--max-requests='):
+        max_requests = int(arg[arg.find('=') + 1:])
+      else:
+        sys.exit('Unknown --pipe flag: %s' % arg)
     get_file_info_func = (get_file_info, get_quick_info)[mode == 'quick']
-    inf, outf = sys.stdin, sys.stdout
+    if argv[1].startswith('--daemon='):
+      try:
+        run_daemon(argv[1][argv[1].find('=') + 1:], get_file_info_func,
+                   has_lstat, max(processes, 1), workers, max_in_flight,
+                   backlog, max_connections, max_requests)
+      except RuntimeError, e:
+        sys.exit(str(e))
+      return
+    inf = mediafileinfo_lines.RecordReader(sys.stdin.fileno())
     set_fd_binary(inf.fileno())
-    set_fd_binary(outf.fileno())
-    run_pipe(inf, outf, get_file_info_func, has_lstat)
+    set_fd_binary(sys.stdout.fileno())
+    # Flushed explicitly by run_pipe after each response.
+    outf = mediafileinfo_lines.LineWriter(sys.stdout.fileno(), flush_sec=None)
+    try:
+      run_pipe(inf, outf, get_file_info_func, has_lstat,
+               workers, max_in_flight)
+    finally:
+      outf.close()
     return
   mode = 'info'
+  # Output buffering: flush after this many bytes or this many seconds.
+  flush_size, flush_sec = 65536, 0.2
+  shard = None  # (shard_index, shard_count) from --shard=i/N.
+  shard_depth = 1
   i = 1
   while i < len(argv):
     arg = argv[i]
@@ -11701,6 +13411,17 @@ def main(argv):
       mode = 'quick'
     elif arg.startswith('--mode='):
       sys.exit('Invalid flag value: %s' % arg)
+    elif arg.startswith('--flush-size='):
+      flush_size = int(arg[arg.find('=') + 1:])
+    elif arg.startswith('--flush-sec='):
+      flush_sec = float(arg[arg.find('=') + 1:])
+    elif arg.startswith('--shard='):
+      try:
+        shard = parse_shard_flag(arg[arg.find('=') + 1:])
+      except ValueError, e:
+        sys.exit(str(e))
+    elif arg.startswith('--shard-depth='):
+      shard_depth = int(arg[arg.find('=') + 1:])
     elif arg == '--list-formats':
       sys.stdout.write('%s\n' % ' '.join(sorted(
           mediafileinfo_detect.FORMAT_DB.formats)))
@@ -11708,16 +13429,23 @@ def main(argv):
     else:
       sys.exit('Unknown flag: %s' % arg)
 
-  outf = sys.stdout
-  set_fd_binary(outf.fileno())
+  if shard:
+    shard += (shard_depth,)
+  sys.stdout.flush()
+  set_fd_binary(sys.stdout.fileno())
+  outf = mediafileinfo_lines.LineWriter(
+      sys.stdout.fileno(), flush_size, flush_sec)
   prefix = '.' + os.sep
   had_error = False
   get_file_info_func = (get_file_info, get_quick_info)[mode == 'quick']
-  # Keep the original argv order, don't sort.
-  for filename in argv[i:]:
-    if filename.startswith(prefix):
-      filename = filename[len(prefix):]
-    had_error |= process(filename, outf, get_file_info_func, has_lstat)
+  try:
+    # Keep the original argv order, don't sort.
+    for filename in argv[i:]:
+      if filename.startswith(prefix):
+        filename = filename[len(prefix):]
+      had_error |= process(filename, outf, get_file_info_func, has_lstat, shard)
+  finally:
+    outf.close()
   if had_error:
     sys.exit(2)
 
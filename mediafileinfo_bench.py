@@ -0,0 +1,657 @@
+#! /bin/sh
+
+""":" # mediafileinfo_bench.py: Benchmarks for pymediafileinfo internals.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: mediafileinfo_bench.py old_files --count=10000000
+          or: mediafileinfo_bench.py hash --size=4294967296
+          or: mediafileinfo_bench.py hash_uncached --dir=/var/tmp
+          or: mediafileinfo_bench.py fingerprint --count=100
+          or: mediafileinfo_bench.py fingerprint_preview --dir=$HOME/Photos
+          or: mediafileinfo_bench.py xfidfp_index --count=2000000
+          or: mediafileinfo_bench.py parse_lines --count=10000000
+          or: mediafileinfo_bench.py format_lines --count=1000000
+
+Each benchmark is a subcommand. Memory benchmarks run in a child process
+(on Unix), so that they don't affect each other.
+"""
+
+import os
+import sys
+import time
+
+
+def get_rss():
+  """Returns the resident set size of the current process in bytes, or 0."""
+  try:
+    f = open('/proc/self/status')
+  except IOError:
+    return 0
+  try:
+    for line in f:
+      if line.startswith('VmRSS:'):
+        return int(line.split()[1]) << 10
+  finally:
+    f.close()
+  return 0
+
+
+def run_in_child(func, *args):
+  """Runs func(*args) in a child process (if possible), returns its output.
+
+  func must return a str.
+  """
+  if not callable(getattr(os, 'fork', None)):
+    return func(*args)
+  rfd, wfd = os.pipe()
+  pid = os.fork()
+  if not pid:
+    try:
+      os.close(rfd)
+      os.write(wfd, func(*args))
+    finally:
+      os._exit(0)
+  os.close(wfd)
+  output = []
+  while 1:
+    data = os.read(rfd, 65536)
+    if not data:
+      break
+    output.append(data)
+  os.close(rfd)
+  os.waitpid(pid, 0)
+  return ''.join(output)
+
+
+def get_flag_value(args, name, default):
+  prefix = '--%s=' % name
+  for arg in args:
+    if arg.startswith(prefix):
+      return type(default)(arg[len(prefix):])
+  return default
+
+
+# --- old_files memory.
+
+
+def generate_old_items(count):
+  """Yields (path, value) pairs similar to a media_scan.py catalog."""
+  for i in xrange(count):
+    path = 'photos/%04d/%02d/IMG_%07d.jpg' % (i >> 14, (i >> 8) & 63, i)
+    yield path, (1000000 + i * 7, 1500000000 + i, None, None, False)
+
+
+def bench_old_files_store(store_name, count):
+  import media_scan_main
+  if store_name == 'compact':
+    old_files = media_scan_main.CompactOldFiles()
+  else:
+    old_files = {}
+  rss_before = get_rss()
+  start = time.time()
+  for path, value in generate_old_items(count):
+    old_files[path] = value
+  build_sec = time.time() - start
+  rss_after = get_rss()
+  start = time.time()
+  lookups = min(count, 1000000)
+  for path, value in generate_old_items(lookups):
+    assert old_files.get(path) == value
+  lookup_sec = time.time() - start
+  return ('%s: count=%d rss_delta=%d bytes_per_file=%.1f build_sec=%.2f '
+          'lookup_usec=%.2f\n' % (
+          store_name, count, rss_after - rss_before,
+          float(rss_after - rss_before) / max(count, 1), build_sec,
+          lookup_sec * 1e6 / max(lookups, 1)))
+
+
+def bench_old_files(args):
+  """Compares the memory usage of the dict and compact old_files stores."""
+  count = get_flag_value(args, 'count', 10000000)
+  for store_name in ('dict', 'compact'):
+    sys.stdout.write(run_in_child(bench_old_files_store, store_name, count))
+    sys.stdout.flush()
+
+
+# --- Parsing mediainfo lines (e.g. --old=).
+
+
+def parse_info_line_legacy(line, _percent_hex_re=[]):
+  """The mediainfo line parser of add_old_files before mediafileinfo_lines."""
+  if not _percent_hex_re:
+    import re
+    _percent_hex_re.append(re.compile(r'%([0-9a-fA-F]{2})'))
+  line = line.rstrip('\n')
+  i = line.find(' f=')
+  if i < 0:
+    raise ValueError('f= not found.')
+  info = {'f': line[line.find('=', i) + 1:]}
+  for item in line[:i].split(' '):
+    kv = item.split('=', 1)
+    if len(kv) != 2:
+      raise ValueError('Expected key=value, got: %s in line %r' % (kv, line))
+    if kv[0] in info:
+      raise ValueError('Duplicate key %r in info line %r' % (kv[0], line))
+    info[kv[0]] = _percent_hex_re[0].sub(
+        lambda match: chr(int(match.group(1), 16)), kv[1])
+  return info
+
+
+class NullOldFiles(object):
+  """An old_files which doesn't store anything, to measure the parsing."""
+
+  def __setitem__(self, key, value):
+    pass
+
+  def pop(self, key, default=None):
+    return default
+
+
+def bench_parse_lines(args):
+  """Compares mediainfo line parsers on a generated catalog of --count= lines.
+
+  1 in 100 lines has a %XX-escaped value. The catalog is written to --dir=.
+  """
+  import tempfile
+  import media_scan_main
+  import mediafileinfo_lines
+  count = get_flag_value(args, 'count', 10000000)
+  fd, filename = tempfile.mkstemp(
+      prefix='mediafileinfo_bench.', dir=get_flag_value(args, 'dir', '.'))
+  try:
+    f = os.fdopen(fd, 'wb')
+    try:
+      for path, value in generate_old_items(count):
+        tags = ('', ' tags=a%20b,c')[not value[0] % 100]
+        f.write('format=jpeg codec=jpeg hdr_done_at=%d height=%d mtime=%d '
+                'sha256=%064x size=%d%s width=%d f=%s\n' % (
+                600 + (value[0] & 1023), 480 + (value[0] & 511), value[1],
+                value[0] * 31337, value[0], tags, 640 + (value[0] & 255),
+                path))
+    finally:
+      f.close()
+    parse_info_line = mediafileinfo_lines.parse_info_line
+    keys = ('format', 'size', 'mtime', 'tags', 'symlink')  # get_old_item.
+    for name, parse_func in (
+        ('legacy', parse_info_line_legacy),
+        ('all_keys', parse_info_line),
+        ('all_keys_encoded',
+         lambda line: parse_info_line(line, do_decode=False)),
+        ('selected_keys', lambda line: parse_info_line(line, keys)),
+        ('add_old_files', None)):
+      f = open(filename, 'rb')
+      try:
+        start = time.time()
+        if parse_func is None:
+          media_scan_main.add_old_files(f, NullOldFiles())
+        else:
+          for line in f:
+            parse_func(line)
+        duration = max(time.time() - start, 1e-6)
+      finally:
+        f.close()
+      sys.stdout.write('parse_lines: parser=%s count=%d sec=%.2f '
+                       'lines_per_sec=%.0f\n' % (
+                       name, count, duration, count / duration))
+      sys.stdout.flush()
+  finally:
+    os.remove(filename)
+
+
+# --- Formatting mediainfo lines (output of all tools).
+
+
+def format_info_legacy(info):
+  """The format_info of media_scan_main.py before mediafileinfo_lines."""
+  def format_value(v):
+    if isinstance(v, bool):
+      return int(v)
+    if isinstance(v, float):
+      if abs(v) < 1e15 and int(v) == v:  # Remove the trailing '.0'.
+        return int(v)
+      return repr(v)
+    if isinstance(v, (int, long)):
+      return str(v)
+    if isinstance(v, str):
+      return (v.replace('%', '%25').replace('\0', '%00').replace('\n', '%0A')
+              .replace(' ', '%20'))
+    raise TypeError(type(v))
+  output = ['format=%s' % format_value(info.get('format') or '?')]
+  output.extend(
+      ' %s=%s' % (k, format_value(v))
+      for k, v in sorted(info.iteritems())
+      if k != 'f' and k != 'format' and
+      not isinstance(v, (tuple, list, dict, set)))
+  filename = info.get('f')
+  if filename is not None:
+    if '\n' in filename or '\0' in filename:
+      raise ValueError('Invalid byte in filename: %r' % filename)
+    output.append(' f=%s' % filename)
+  output.append('\n')
+  return ''.join(output)
+
+
+def bench_format_lines(args):
+  """Compares mediainfo line formatters on --count= info dicts.
+
+  The info dicts are similar to the ones of a JPEG file found by
+  media_scan.py, 1 in 100 has a value to be %XX-escaped.
+  """
+  import mediafileinfo_lines
+  count = get_flag_value(args, 'count', 1000000)
+  infos = []
+  for path, value in generate_old_items(min(count, 10000)):
+    info = {'format': 'jpeg', 'codec': 'jpeg', 'f': path,
+            'hdr_done_at': 600 + (value[0] & 1023),
+            'height': 480 + (value[0] & 511), 'width': 640 + (value[0] & 255),
+            'mtime': value[1], 'size': value[0], 'has_early_dht': True,
+            'sha256': '%064x' % (value[0] * 31337), 'brands': ['jfif']}
+    if not value[0] % 100:
+      info['tags'] = 'a b,c'
+    infos.append(info)
+  format_info = mediafileinfo_lines.format_info
+  raw_infos = [mediafileinfo_lines.parse_info_line(format_info(info),
+                                                   do_decode=False)
+               for info in infos]
+  for name, format_func, infos2 in (
+      ('legacy', format_info_legacy, infos),
+      ('encode', format_info, infos),
+      ('raw', lambda info: format_info(info, do_encode=False), raw_infos)):
+    infos3 = infos2 * (count // len(infos2)) + infos2[:count % len(infos2)]
+    start = time.time()
+    for info in infos3:
+      format_func(info)
+    duration = max(time.time() - start, 1e-6)
+    del infos3
+    sys.stdout.write('format_lines: formatter=%s count=%d sec=%.2f '
+                     'lines_per_sec=%.0f\n' % (
+                     name, count, duration, count / duration))
+    sys.stdout.flush()
+
+
+# --- sha256 hashing throughput.
+
+
+def create_bench_file(filename, size):
+  """Creates a file of the specified size with incompressible data."""
+  block = os.urandom(1 << 20)
+  f = open(filename, 'wb')
+  try:
+    while size > 0:
+      f.write(block[:size])
+      size -= len(block)
+  finally:
+    f.close()
+
+
+def bench_hash(args):
+  """Compares inline and threaded hashing of a large file (--file=).
+
+  If --file= is not specified, creates a temporary file of --size= bytes.
+  Unless the file is larger than the memory, it will be read from the page
+  cache (except for the first read), so this measures the CPU overhead.
+  """
+  import tempfile
+  import media_scan_main
+  filename = get_flag_value(args, 'file', '')
+  tmp_filename = None
+  if not filename:
+    fd, tmp_filename = tempfile.mkstemp(prefix='mediafileinfo_bench.')
+    os.close(fd)
+    filename = tmp_filename
+    create_bench_file(filename, get_flag_value(args, 'size', 2 << 30))
+  try:
+    file_size = os.stat(filename).st_size
+    digests = set()
+    for do_thread, chunk_size in (
+        (False, 65536), (False, 1 << 20), (True, 1 << 18), (True, 1 << 20),
+        (True, 1 << 22)):
+      hash_opts = media_scan_main.HashOptions(do_thread, chunk_size)
+      f = open(filename, 'rb')
+      try:
+        hash_obj = media_scan_main.sha256()
+        start = time.time()
+        media_scan_main.hash_file_tail(f, hash_obj, hash_opts)
+        duration = max(time.time() - start, 1e-6)
+      finally:
+        f.close()
+      digests.add(hash_obj.hexdigest())
+      sys.stdout.write('hash: thread=%d chunk_size=%d size=%d sec=%.3f '
+                       'mb_per_sec=%.1f\n' % (
+                       do_thread, chunk_size, file_size, duration,
+                       file_size / duration / (1 << 20)))
+      sys.stdout.flush()
+    assert len(digests) == 1, 'Digest mismatch.'
+  finally:
+    if tmp_filename:
+      os.remove(tmp_filename)
+
+
+# --- Page cache footprint of hashing large files.
+
+
+def get_libc():
+  import ctypes
+  libc = ctypes.CDLL(None, use_errno=True)
+  libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                        ctypes.c_int, ctypes.c_int, ctypes.c_long)
+  libc.mmap.restype = ctypes.c_void_p
+  libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+  libc.mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p)
+  libc.posix_fadvise64.argtypes = (
+      ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int)
+  return libc
+
+
+def get_cached_size(libc, filename):
+  """Returns the number of bytes of the file in the page cache (Linux)."""
+  import ctypes
+  import mmap
+  size = os.stat(filename).st_size
+  if not size:
+    return 0
+  fd = os.open(filename, os.O_RDONLY)
+  try:
+    addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr in (None, ctypes.c_void_p(-1).value):
+      raise OSError(ctypes.get_errno(), 'mmap failed')
+  finally:
+    os.close(fd)
+  try:
+    vec = ctypes.create_string_buffer((size + mmap.PAGESIZE - 1) //
+                                      mmap.PAGESIZE)
+    if libc.mincore(addr, size, vec):
+      raise OSError(ctypes.get_errno(), 'mincore failed')
+    return sum(ord(c) & 1 for c in vec.raw) * mmap.PAGESIZE
+  finally:
+    libc.munmap(addr, size)
+
+
+def drop_cached(libc, filename):
+  fd = os.open(filename, os.O_RDONLY)
+  try:
+    os.fsync(fd)  # Dirty pages can't be dropped.
+    libc.posix_fadvise64(fd, 0, 0, 4)  # POSIX_FADV_DONTNEED.
+  finally:
+    os.close(fd)
+
+
+def bench_hash_uncached(args):
+  """Compares the page cache footprint of buffered and uncached hashing.
+
+  Uses the file --file= or creates a temporary file of --size= bytes (in
+  --dir=, which shouldn't be a tmpfs, because then O_DIRECT is not
+  supported, and the file is always in the page cache). The file is dropped
+  from the page cache before each run, so this measures reading from disk.
+  Linux only.
+  """
+  import tempfile
+  import media_scan_main
+  libc = get_libc()
+  filename = get_flag_value(args, 'file', '')
+  tmp_filename = None
+  if not filename:
+    fd, tmp_filename = tempfile.mkstemp(
+        prefix='mediafileinfo_bench.', dir=get_flag_value(args, 'dir', '.'))
+    os.close(fd)
+    filename = tmp_filename
+    create_bench_file(filename, get_flag_value(args, 'size', 1 << 30))
+  try:
+    file_size = os.stat(filename).st_size
+    digests = set()
+    for mode_name, uncached_min_size in (
+        ('buffered', None), ('uncached', 0), ('buffered', None)):
+      hash_opts = media_scan_main.HashOptions(
+          chunk_size=1 << 20, uncached_min_size=uncached_min_size)
+      drop_cached(libc, filename)
+      cached_before = get_cached_size(libc, filename)
+      f = open(filename, 'rb')
+      try:
+        hash_obj = media_scan_main.sha256()
+        start = time.time()
+        media_scan_main.hash_file_tail(f, hash_obj, hash_opts)
+        duration = max(time.time() - start, 1e-6)
+      finally:
+        f.close()
+      digests.add(hash_obj.hexdigest())
+      sys.stdout.write(
+          'hash_uncached: mode=%s size=%d sec=%.3f mb_per_sec=%.1f '
+          'cached_before=%d cached_after=%d\n' % (
+          mode_name, file_size, duration, file_size / duration / (1 << 20),
+          cached_before, get_cached_size(libc, filename)))
+      sys.stdout.flush()
+    assert len(digests) == 1, 'Digest mismatch.'
+  finally:
+    if tmp_filename:
+      os.remove(tmp_filename)
+
+
+# --- Image fingerprinting speed.
+
+
+def bench_fingerprint(args):
+  """Compares the speed of the fingerprint_image backends.
+
+  Uses the images in --dir=, or creates --count= JPEG images (of size
+  --geometry=) with `gm convert'. Backends which are not installed are
+  skipped. The fingerprints must be the same for all backends.
+  """
+  import shutil
+  import subprocess
+  import tempfile
+  import media_scan_main
+  image_dir = get_flag_value(args, 'dir', '')
+  tmp_dir = None
+  if not image_dir:
+    image_dir = tmp_dir = tempfile.mkdtemp(prefix='mediafileinfo_bench.')
+    for i in xrange(get_flag_value(args, 'count', 100)):
+      subprocess.check_call((
+          'gm', 'convert', '-size', get_flag_value(args, 'geometry', '640x480'),
+          'plasma:fractal', '-seed', str(i),
+          os.path.join(image_dir, 'img%04d.jpg' % i)))
+  try:
+    filenames = [os.path.join(image_dir, name)
+                 for name in sorted(os.listdir(image_dir))]
+    results = {}
+    for impl in (media_scan_main.fingerprint_image_with_gm_convert,
+                 media_scan_main.fingerprint_image_with_gm_batch,
+                 media_scan_main.fingerprint_image_with_perl,
+                 media_scan_main.fingerprint_image_with_pgmagick):
+      try:
+        impl(filenames[0])  # Also starts the backend process.
+      except (ImportError, IOError, OSError):
+        sys.stdout.write('fingerprint: impl=%s skipped\n' % impl.__name__)
+        continue
+      start = time.time()
+      fps = []
+      for filename in filenames:
+        try:
+          fps.append(impl(filename))
+        except IOError:
+          fps.append('err')
+      duration = max(time.time() - start, 1e-6)
+      results[impl.__name__] = fps
+      sys.stdout.write('fingerprint: impl=%s count=%d sec=%.3f '
+                       'images_per_sec=%.1f\n' % (
+                       impl.__name__, len(filenames), duration,
+                       len(filenames) / duration))
+      sys.stdout.flush()
+    assert len(set(map(tuple, results.itervalues()))) <= 1, (
+        'Fingerprint mismatch.')
+  finally:
+    if tmp_dir:
+      shutil.rmtree(tmp_dir)
+
+
+def bench_fingerprint_preview(args):
+  """Compares fingerprints of embedded JPEG previews to the full image.
+
+  For each JPEG and TIFF (e.g. NEF) image in --dir= (recursively) with an
+  embedded preview of at least --min-size= pixels (see
+  media_scan_main.read_image_preview), computes both fingerprints, and
+  reports how often they agree: same=1 means identical, similar=1 means
+  within the findimagedupes threshold of 25 bits. With --verbose=1, also
+  prints per-image results.
+  """
+  import base64
+  import media_scan_main
+  image_dir = get_flag_value(args, 'dir', '.')
+  min_size = get_flag_value(args, 'min_size', 320)
+  is_verbose = get_flag_value(args, 'verbose', 0)
+  count = with_preview = same = similar = distance_sum = 0
+  full_sec = preview_sec = 0.0
+  for dirpath, dirnames, filenames in os.walk(image_dir):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      filename = os.path.join(dirpath, filename)
+      info, _ = media_scan_main.get_file_info(filename, os.stat(filename))
+      if (info.get('format') not in ('jpeg', 'tiff') or
+          not info.get('width') or not info.get('height')):
+        continue
+      count += 1
+      data = media_scan_main.read_image_preview(filename, info, min_size)
+      if data is None:
+        continue
+      try:
+        start = time.time()
+        fp = media_scan_main.fingerprint_image(filename)
+        mid = time.time()
+        preview_fp = media_scan_main.fingerprint_image_data(data, 'jpeg')
+        preview_sec += time.time() - mid
+        full_sec += mid - start
+      except IOError, e:
+        sys.stdout.write('fingerprint_preview: error=%s f=%s\n' % (
+            ' '.join(str(e).split()), filename))
+        continue
+      with_preview += 1
+      distance = sum(bin(ord(a) ^ ord(b)).count('1') for a, b in zip(
+          base64.b64decode(fp), base64.b64decode(preview_fp)))
+      same += distance == 0
+      similar += distance <= 25
+      distance_sum += distance
+      if is_verbose:
+        sys.stdout.write(
+            'fingerprint_preview: distance=%d preview_size=%d f=%s\n' %
+            (distance, len(data), filename))
+  sys.stdout.write(
+      'fingerprint_preview: count=%d with_preview=%d same=%d similar=%d '
+      'avg_distance=%.2f full_sec=%.3f preview_sec=%.3f\n' % (
+      count, with_preview, same, similar,
+      float(distance_sum) / max(with_preview, 1), full_sec, preview_sec))
+
+
+# --- Near-duplicate search in xfidfp= fingerprints.
+
+
+def bench_xfidfp_index(args):
+  """Compares xfidfp_index.py queries to brute force search.
+
+  Generates --count= random fingerprints, 1 in 100 of them with a planted
+  near-duplicate (up to 25 bits flipped), and builds, saves and loads the
+  index in --dir=. Random fingerprints are the worst case for the index
+  only in memory: real ones are clustered, thus they have more matches.
+  """
+  import random
+  import tempfile
+  import xfidfp_index
+  count = get_flag_value(args, 'count', 1000000)
+  max_distance = get_flag_value(args, 'max_distance', 25)
+  rng = random.Random(get_flag_value(args, 'seed', 42))
+  fps_by_filename = {}
+  for i in xrange(count):
+    fp = rng.getrandbits(256)
+    fps_by_filename['img%08d.jpg' % i] = fp
+    if not i % 100:
+      for bit in rng.sample(xrange(256), rng.randint(0, max_distance)):
+        fp ^= 1 << bit
+      fps_by_filename['img%08d_dup.jpg' % i] = fp
+  fd, filename = tempfile.mkstemp(
+      prefix='mediafileinfo_bench.', dir=get_flag_value(args, 'dir', '.'))
+  os.close(fd)
+  try:
+    start = time.time()
+    index = xfidfp_index.FingerprintIndex.build(fps_by_filename)
+    build_sec = time.time() - start
+    del fps_by_filename
+    start = time.time()
+    index.save(filename)
+    save_sec = time.time() - start
+    start = time.time()
+    index = xfidfp_index.FingerprintIndex.load(filename)
+    load_sec = time.time() - start
+    sys.stdout.write(
+        'xfidfp_index: count=%d build_sec=%.2f save_sec=%.2f load_sec=%.2f '
+        'file_size=%d\n' % (len(index.fps), build_sec, save_sec, load_sec,
+                            os.stat(filename).st_size))
+    sys.stdout.flush()
+  finally:
+    os.remove(filename)
+  fps = index.fps
+  queries = [fps[rng.randrange(len(fps))]
+             for _ in xrange(get_flag_value(args, 'queries', 1000))]
+  start = time.time()
+  results = [index.find_neighbors(fp, max_distance) for fp in queries]
+  index_sec = max(time.time() - start, 1e-6)
+  candidate_count = sum(len(index.get_candidates(fp, max_distance))
+                        for fp in queries)
+  brute_count = min(len(queries), get_flag_value(args, 'brute_queries', 10))
+  start = time.time()
+  for fp, result in zip(queries[:brute_count], results):
+    assert result == sorted(
+        (distance, i) for distance, i in
+        ((bin(fp ^ fps[i]).count('1'), i) for i in xrange(len(fps)))
+        if distance <= max_distance), 'Index result mismatch.'
+  brute_sec = max(time.time() - start, 1e-6)
+  sys.stdout.write(
+      'xfidfp_index: max_distance=%d index_query_usec=%.1f '
+      'candidates_per_query=%.1f brute_query_usec=%.1f\n' % (
+      max_distance, index_sec * 1e6 / max(len(queries), 1),
+      float(candidate_count) / max(len(queries), 1),
+      brute_sec * 1e6 / max(brute_count, 1)))
+  sys.stdout.flush()
+  pair_limit = min(len(fps), get_flag_value(args, 'pairs', 100000))
+  pair_count = 0
+  start = time.time()
+  for distance, i, j in index.iter_pairs(max_distance):
+    if i >= pair_limit:
+      break
+    pair_count += 1
+  pairs_sec = max(time.time() - start, 1e-6)
+  sys.stdout.write(
+      'xfidfp_index: pairs_scanned=%d pairs_found=%d pairs_sec=%.2f '
+      'est_all_pairs_sec=%.1f\n' % (
+      pair_limit, pair_count, pairs_sec,
+      pairs_sec * len(fps) / max(pair_limit, 1)))
+  sys.stdout.flush()
+
+
+# ---
+
+
+BENCHMARKS = {
+    'fingerprint': bench_fingerprint,
+    'fingerprint_preview': bench_fingerprint_preview,
+    'format_lines': bench_format_lines,
+    'hash': bench_hash,
+    'hash_uncached': bench_hash_uncached,
+    'old_files': bench_old_files,
+    'parse_lines': bench_parse_lines,
+    'xfidfp_index': bench_xfidfp_index,
+}
+
+
+def main(argv):
+  if len(argv) < 2 or argv[1] not in BENCHMARKS:
+    sys.stderr.write('Usage: %s <benchmark> [<flag> ...]\nBenchmarks: %s\n' %
+                     (argv[0], ' '.join(sorted(BENCHMARKS))))
+    sys.exit(1)
+  BENCHMARKS[argv[1]](argv[2:])
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
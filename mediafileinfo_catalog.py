@@ -0,0 +1,594 @@
+#! /usr/bin/python
+#
+# mediafileinfo_catalog.py: compact binary catalog of mediainfo lines
+#
+# Input: mediainfo lines (media_scan.py output, .mfo files)
+# Output: a binary catalog (.mfc file), or mediainfo lines converted back
+#
+# The .mfc file format (see also mediafileinfo_format.md) stores the lines in
+# blocks. Within a block, the filenames are sorted and prefix-compressed, the
+# key names are replaced by ids in a key dictionary, and the values are
+# stored in columns (one per key), integers and lowercase hex strings
+# (e.g. sha256=) in binary. The original order of the lines is also stored,
+# so conversion back to .mfo is lossless (byte-identical). Blocks are
+# compressed with zlib. The footer contains the key dictionary and the block
+# index (offset, filename range and format= values of each block), so the
+# entries of a filename or a format can be found without decompressing
+# everything. New blocks can be appended (e.g. for incremental scans), later
+# lines of the same filename take precedence, like with --old= of
+# media_scan.py.
+#
+# Usage:
+#
+#   mediafileinfo_catalog.py encode --catalog=all.mfc [--append=true]
+#       [--block-size=4096] mscan1.mfo ...
+#   mediafileinfo_catalog.py decode --catalog=all.mfc [--formats=jpeg,png]
+#       >all.mfo
+#   mediafileinfo_catalog.py get --catalog=all.mfc <f> ...
+#
+# If there are no .mfo files for encode, it reads stdin. For the best lookup
+# speed, encode lines sorted by filename (e.g. merge_mediainfo_lines.py
+# output), so that the filename ranges of the blocks don't overlap.
+#
+
+import binascii
+import bisect
+import os
+import struct
+import sys
+import zlib
+
+import mediafileinfo_lines
+
+
+HEADER = 'MFOCAT\1\n'
+TRAILER_MAGIC = 'MFCe'
+TRAILER_FMT = '<QL4s'  # Footer offset, footer size, TRAILER_MAGIC.
+TRAILER_SIZE = struct.calcsize(TRAILER_FMT)
+
+TAG_INT = 0  # Canonical decimal integer, zigzag-encoded.
+TAG_STR = 1  # Any other str.
+TAG_HEX = 2  # Lowercase hex str of even length, stored as bytes.
+
+HEX_DIGITS = '0123456789abcdef'
+
+# Encodings of the varints 0 ... 16383 (1 or 2 bytes).
+SMALL_VARINTS = ([chr(i) for i in xrange(128)] +
+                 [chr(i & 127 | 128) + chr(i >> 7) for i in xrange(128, 16384)])
+
+
+def encode_varint(value, output):
+  """Appends the LEB128 encoding of a nonnegative integer to output."""
+  if value < 16384:  # Fast path.
+    output.append(SMALL_VARINTS[value])
+    return
+  while value > 127:
+    output.append(chr(value & 127 | 128))
+    value >>= 7
+  output.append(chr(value))
+
+
+def encode_str(value, output):
+  encode_varint(len(value), output)
+  output.append(value)
+
+
+def encode_value(value, output):
+  """Appends the encoding of an %XX-encoded info value to output."""
+  if value.isdigit():
+    if value[0] != '0' or value == '0':
+      encode_varint(int(value) << 3 | TAG_INT, output)  # Zigzag << 2.
+      return
+  elif value[:1] == '-' and value[1:].isdigit() and value[1] != '0':
+    encode_varint((~int(value) << 1 | 1) << 2 | TAG_INT, output)
+    return
+  elif (len(value) >= 16 and not len(value) & 1 and
+        not value.strip(HEX_DIGITS)):
+    encode_varint(len(value) << 1 | TAG_HEX, output)  # (len >> 1) << 2.
+    output.append(binascii.unhexlify(value))
+    return
+  encode_varint(len(value) << 2 | TAG_STR, output)
+  output.append(value)
+
+
+class Decoder(object):
+  """Reads items encoded by the encode_* functions from a str."""
+
+  __slots__ = ('data', 'i')
+
+  def __init__(self, data):
+    self.data, self.i = data, 0
+
+  def varint(self):
+    data, i = self.data, self.i
+    value = ord(data[i])
+    i += 1
+    if value > 127:
+      value &= 127
+      shift = 7
+      while 1:
+        b = ord(data[i])
+        i += 1
+        value |= (b & 127) << shift
+        if b < 128:
+          break
+        shift += 7
+    self.i = i
+    return value
+
+  def str(self):
+    size = self.varint()
+    i = self.i
+    self.i = j = i + size
+    if j > len(self.data):
+      raise ValueError('Catalog data truncated.')
+    return self.data[i : j]
+
+  def value(self):
+    header = self.varint()
+    tag = header & 3
+    if tag == TAG_INT:
+      header >>= 2
+      if header & 1:
+        return str(~(header >> 1))
+      return str(header >> 1)
+    i = self.i
+    if tag == TAG_STR:
+      self.i = j = i + (header >> 2)
+      return self.data[i : j]
+    if tag == TAG_HEX:
+      self.i = j = i + (header >> 2)
+      return binascii.hexlify(self.data[i : j])
+    raise ValueError('Bad catalog value tag: %d' % tag)
+
+
+def split_line(line):
+  """Returns (fields, filename) of a mediainfo line, keeping the order.
+
+  fields is a list of [key, value] pairs, values are kept %XX-encoded.
+  """
+  if line.endswith('\n'):
+    line = line[:-1]
+  i = line.find(' f=')
+  if i < 0:
+    raise ValueError('f= not found in line: %r' % line)
+  fields = [item.split('=', 1) for item in line[:i].split(' ')]
+  for item in fields:
+    if len(item) != 2 or not item[0]:
+      raise ValueError('Expected key=value, got: %r' % '='.join(item))
+  return fields, line[i + 3:]
+
+
+def join_line(fields, filename):
+  """Returns the mediainfo line of the output of split_line."""
+  return '%s f=%s\n' % (' '.join(['='.join(item) for item in fields]),
+                        filename)
+
+
+def get_shared_prefix_size(a, b):
+  """Returns the size of the longest common prefix of a and b."""
+  low, high = 0, min(len(a), len(b))
+  while low < high:  # Binary search, comparing slices is fast.
+    mid = (low + high + 1) >> 1
+    if a[:mid] == b[:mid]:
+      low = mid
+    else:
+      high = mid - 1
+  return low
+
+
+class BlockInfo(object):
+  """Block index entry: location, size and contents summary of a block."""
+
+  __slots__ = ('offset', 'size', 'count', 'first', 'last', 'formats')
+
+  def __init__(self, offset, size, count, first, last, formats):
+    self.offset, self.size, self.count = offset, size, count
+    self.first, self.last, self.formats = first, last, formats
+
+
+def encode_footer(keys, blocks):
+  output = []
+  encode_varint(len(keys), output)
+  for key in keys:
+    encode_str(key, output)
+  encode_varint(len(blocks), output)
+  for block in blocks:
+    encode_varint(block.offset, output)
+    encode_varint(block.size, output)
+    encode_varint(block.count, output)
+    encode_str(block.first, output)
+    encode_str(block.last, output)
+    encode_varint(len(block.formats), output)
+    for format in block.formats:
+      encode_str(format, output)
+  return zlib.compress(''.join(output), 6)
+
+
+def decode_footer(data):
+  """Returns (keys, blocks)."""
+  decoder = Decoder(zlib.decompress(data))
+  keys = [decoder.str() for _ in xrange(decoder.varint())]
+  blocks = []
+  for _ in xrange(decoder.varint()):
+    offset, size, count = decoder.varint(), decoder.varint(), decoder.varint()
+    first, last = decoder.str(), decoder.str()
+    formats = tuple(decoder.str() for _ in xrange(decoder.varint()))
+    blocks.append(BlockInfo(offset, size, count, first, last, formats))
+  return keys, blocks
+
+
+def read_footer(f):
+  """Returns (keys, blocks, footer_offset) of the catalog file f."""
+  f.seek(0, 2)
+  file_size = f.tell()
+  if file_size < len(HEADER) + TRAILER_SIZE:
+    raise ValueError('Catalog file too short.')
+  f.seek(0)
+  if f.read(len(HEADER)) != HEADER:
+    raise ValueError('Bad catalog file header.')
+  f.seek(file_size - TRAILER_SIZE)
+  footer_offset, footer_size, magic = struct.unpack(
+      TRAILER_FMT, f.read(TRAILER_SIZE))
+  if (magic != TRAILER_MAGIC or
+      footer_offset + footer_size + TRAILER_SIZE != file_size):
+    raise ValueError('Bad catalog file trailer (truncated?).')
+  f.seek(footer_offset)
+  keys, blocks = decode_footer(f.read(footer_size))
+  return keys, blocks, footer_offset
+
+
+class CatalogWriter(object):
+  """Writes mediainfo lines to a new catalog file or appends to one.
+
+  Lines are buffered to blocks of block_size lines. close() must be called
+  to write the last block and the footer. If close() is not called, or it
+  fails, an appended catalog file is truncated to its original contents.
+  """
+
+  def __init__(self, filename, block_size=4096, do_append=False):
+    self.block_size = block_size
+    self._entries = []  # (filename, fields) pairs.
+    self._keys, self._blocks, self._key_ids = [], [], {}
+    self._f = self._orig_size = None
+    if do_append and os.path.exists(filename):
+      self._f = open(filename, 'r+b')
+      try:
+        self._keys, self._blocks, _ = read_footer(self._f)
+        self._f.seek(0, 2)
+        self._orig_size = self._f.tell()
+      except:
+        self._f.close()
+        raise
+      for key_id, key in enumerate(self._keys):
+        self._key_ids[key] = key_id
+    else:
+      self._f = open(filename, 'wb')
+      self._f.write(HEADER)
+
+  def write_line(self, line):
+    fields, filename = split_line(line)
+    self._entries.append((filename, fields))
+    if len(self._entries) >= self.block_size:
+      self._write_block()
+
+  def write_info(self, info):
+    """Writes an info dict (with f=), see mediafileinfo_lines.format_info."""
+    self.write_line(mediafileinfo_lines.format_info(info))
+
+  def _write_block(self):
+    entries, self._entries = self._entries, []
+    if not entries:
+      return
+    key_ids, keys = self._key_ids, self._keys
+    order = sorted(xrange(len(entries)), key=lambda i: entries[i][0])
+    output, shape_ids, columns, formats = [], {}, {}, set()
+    encode_varint(len(entries), output)
+    for i in order:
+      encode_varint(i, output)
+    prev_filename = ''
+    for i in order:
+      filename = entries[i][0]
+      shared = get_shared_prefix_size(prev_filename, filename)
+      encode_varint(shared, output)
+      encode_str(filename[shared:], output)
+      prev_filename = filename
+    shape_col = []
+    for i in order:
+      shape = []
+      for key, value in entries[i][1]:
+        key_id = key_ids.get(key)
+        if key_id is None:
+          key_ids[key] = key_id = len(keys)
+          keys.append(key)
+          columns[key_id] = []
+        elif key_id not in columns:
+          columns[key_id] = []
+        shape.append(key_id)
+        encode_value(value, columns[key_id])
+        if key == 'format':
+          formats.add(value)
+      shape = tuple(shape)
+      shape_id = shape_ids.get(shape)
+      if shape_id is None:
+        shape_ids[shape] = shape_id = len(shape_ids)
+      shape_col.append(shape_id)
+    encode_varint(len(shape_ids), output)
+    for _, shape in sorted((v, k) for k, v in shape_ids.iteritems()):
+      encode_varint(len(shape), output)
+      for key_id in shape:
+        encode_varint(key_id, output)
+    for shape_id in shape_col:
+      encode_varint(shape_id, output)
+    for key_id in sorted(columns):
+      output.extend(columns[key_id])
+    data = zlib.compress(''.join(output), 6)
+    offset = self._f.tell()
+    self._f.write(data)
+    self._blocks.append(BlockInfo(
+        offset, len(data), len(entries), entries[order[0]][0],
+        entries[order[-1]][0], tuple(sorted(formats))))
+
+  def close(self):
+    f = self._f
+    if f is None:
+      return
+    try:
+      self._write_block()
+      data = encode_footer(self._keys, self._blocks)
+      f.write(data + struct.pack(
+          TRAILER_FMT, f.tell(), len(data), TRAILER_MAGIC))
+      self._orig_size = None
+    finally:
+      self._f = None
+      if self._orig_size is not None:
+        f.truncate(self._orig_size)
+      f.close()
+
+  def __del__(self):
+    if self._f is not None and self._orig_size is not None:
+      f, self._f = self._f, None
+      f.truncate(self._orig_size)  # Discard incomplete append.
+      f.close()
+
+
+def decode_block_filenames(data):
+  """Returns (decoder, indexes, filenames) of a block.
+
+  filenames is the sorted list of filenames, without decoding the values.
+  The decoder is positioned after the filenames, decode_block continues
+  from there.
+  """
+  decoder = Decoder(zlib.decompress(data))
+  varint = decoder.varint
+  count = varint()
+  indexes = [varint() for _ in xrange(count)]
+  filenames, filename = [], ''
+  for _ in xrange(count):
+    shared = varint()
+    filename = filename[:shared] + decoder.str()
+    filenames.append(filename)
+  return decoder, indexes, filenames
+
+
+def decode_block(data, keys):
+  """Returns the entries of a block as a list sorted by filename.
+
+  Each entry is an (filename, index, fields) tuple, where index is the
+  position of the line in the block (as written), and fields is a list of
+  (key, value) pairs.
+  """
+  decoder, indexes, filenames = decode_block_filenames(data)
+  varint, count = decoder.varint, len(filenames)
+  shapes = [[varint() for _ in xrange(varint())] for _ in xrange(varint())]
+  shape_col = [shapes[varint()] for _ in xrange(count)]
+  value_counts = {}
+  for shape in shape_col:
+    for key_id in shape:
+      value_counts[key_id] = value_counts.get(key_id, 0) + 1
+  columns, value = {}, decoder.value
+  for key_id in sorted(value_counts):
+    # Reversed, so that list.pop() returns the values in order.
+    column = [value() for _ in xrange(value_counts[key_id])]
+    column.reverse()
+    columns[key_id] = column
+  entries = []
+  for i in xrange(count):
+    entries.append((filenames[i], indexes[i],
+                    [(keys[key_id], columns[key_id].pop())
+                     for key_id in shape_col[i]]))
+  return entries
+
+
+class BlockCache(object):
+  """Keeps the values of the max_size most recently used blocks."""
+
+  __slots__ = ('max_size', '_values', '_order')
+
+  def __init__(self, max_size):
+    self.max_size = max(max_size, 1)
+    self._values = {}  # Maps block_index to value.
+    self._order = []  # Block indexes, the most recently used is the last.
+
+  def get(self, block_index):
+    value = self._values.get(block_index)
+    if value is not None and self._order[-1] != block_index:
+      self._order.remove(block_index)
+      self._order.append(block_index)
+    return value
+
+  def put(self, block_index, value):
+    if block_index in self._values:
+      self._order.remove(block_index)
+    elif len(self._order) >= self.max_size:
+      del self._values[self._order.pop(0)]
+    self._values[block_index] = value
+    self._order.append(block_index)
+
+
+class CatalogReader(object):
+  """Reads a catalog file: streams lines or looks up filenames.
+
+  For lookups, the filenames of up to filenames_cache_size blocks and the
+  decoded entries of up to cache_size blocks are cached. Decoding the
+  filenames only is about 5 times faster than decoding the entries, so
+  blocks which don't contain the filename (but their filename range
+  does) are checked quickly.
+  """
+
+  def __init__(self, filename, cache_size=8, filenames_cache_size=64):
+    self._f = open(filename, 'rb')
+    try:
+      self.keys, self.blocks, _ = read_footer(self._f)
+    except:
+      self._f.close()
+      raise
+    self._entries_cache = BlockCache(cache_size)
+    self._filenames_cache = BlockCache(filenames_cache_size)
+
+  def close(self):
+    self._f.close()
+
+  def _read_block(self, block_index):
+    block = self.blocks[block_index]
+    self._f.seek(block.offset)
+    return self._f.read(block.size)
+
+  def get_block_entries(self, block_index):
+    """Returns the decode_block output of a block."""
+    entries = self._entries_cache.get(block_index)
+    if entries is None:
+      entries = decode_block(self._read_block(block_index), self.keys)
+      self._entries_cache.put(block_index, entries)
+    return entries
+
+  def get_block_filenames(self, block_index):
+    """Returns the sorted list of filenames in a block."""
+    filenames = self._filenames_cache.get(block_index)
+    if filenames is None:
+      entries = self._entries_cache.get(block_index)
+      if entries is None:
+        filenames = decode_block_filenames(self._read_block(block_index))[2]
+      else:
+        filenames = [entry[0] for entry in entries]
+      self._filenames_cache.put(block_index, filenames)
+    return filenames
+
+  def iter_entries(self, formats=None):
+    """Yields (fields, filename) pairs in the original line order.
+
+    If formats is not None, only the lines with a format= value in formats
+    are yielded, and the other blocks are skipped without decompressing.
+    """
+    if formats is not None:
+      formats = frozenset(formats)
+    for block_index, block in enumerate(self.blocks):
+      if formats is not None and formats.isdisjoint(block.formats):
+        continue
+      # Not cached: streaming shouldn't evict the blocks of lookups.
+      entries = sorted(decode_block(self._read_block(block_index), self.keys),
+                       key=lambda entry: entry[1])
+      for filename, _, fields in entries:
+        if formats is not None and dict(fields).get('format') not in formats:
+          continue
+        yield fields, filename
+
+  def iter_lines(self, formats=None):
+    """Yields mediainfo lines, see iter_entries."""
+    for fields, filename in self.iter_entries(formats):
+      yield join_line(fields, filename)
+
+  def get_line(self, filename):
+    """Returns the last mediainfo line of filename, or None if not found.
+
+    A format=deleted line is also returned.
+    """
+    result = None
+    for block_index, block in enumerate(self.blocks):
+      if not block.first <= filename <= block.last:
+        continue
+      filenames = self.get_block_filenames(block_index)
+      i = j = bisect.bisect_left(filenames, filename)
+      while j < len(filenames) and filenames[j] == filename:
+        j += 1
+      if i < j:  # Entries of a filename are sorted by index.
+        result = join_line(self.get_block_entries(block_index)[j - 1][2],
+                           filename)
+    return result
+
+  def get_info(self, filename, do_decode=True):
+    """Returns the last info dict of filename (like get_line) or None."""
+    line = self.get_line(filename)
+    if line is None:
+      return None
+    return mediafileinfo_lines.parse_info_line(line, do_decode=do_decode)
+
+
+def main(argv):
+  if len(argv) < 2 or argv[1] not in ('encode', 'decode', 'get'):
+    sys.stderr.write(
+        'Usage: %s {encode|decode|get} --catalog=<file> [<flag> ...] '
+        '[<arg> ...]\n' % argv[0])
+    sys.exit(1)
+  command, catalog_filename, block_size = argv[1], None, 4096
+  do_append, formats = False, None
+  i = 2
+  while i < len(argv):
+    arg = argv[i]
+    i += 1
+    if arg == '--':
+      break
+    if arg == '-' or not arg.startswith('-'):
+      i -= 1
+      break
+    value = arg[arg.find('=') + 1:]
+    if arg.startswith('--catalog='):
+      catalog_filename = value
+    elif arg.startswith('--block-size='):
+      block_size = int(value)
+    elif arg.startswith('--append='):
+      do_append = value.lower() in ('1', 'yes', 'true', 'on')
+    elif arg.startswith('--formats='):
+      formats = value.split(',')
+    else:
+      sys.exit('Unknown flag: %s' % arg)
+  if not catalog_filename:
+    sys.exit('Missing --catalog=')
+  of = sys.stdout
+  if command == 'encode':
+    writer = CatalogWriter(catalog_filename, block_size, do_append)
+    for filename in argv[i:] or ['-']:
+      if filename == '-':
+        f = sys.stdin
+      else:
+        f = open(filename, 'rb')
+      try:
+        for line in f:
+          writer.write_line(line)
+      finally:
+        if f is not sys.stdin:
+          f.close()
+    writer.close()
+    return
+  reader = CatalogReader(catalog_filename)
+  try:
+    if command == 'decode':
+      for line in reader.iter_lines(formats):
+        of.write(line)
+    else:
+      had_error = False
+      for filename in argv[i:]:
+        line = reader.get_line(filename)
+        if line is None:
+          print >>sys.stderr, 'error: not in catalog: %r' % filename
+          had_error = True
+        else:
+          of.write(line)
+      if had_error:
+        sys.exit(2)
+  finally:
+    reader.close()
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,86 @@
+#! /bin/sh
+
+""":" # mediafileinfo_catalog_test.py: Unit tests for mediafileinfo_catalog.py.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: mediafileinfo_catalog_test.py
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+import mediafileinfo_catalog
+
+
+LINES = (
+    'format=jpeg height=480 mtime=1500000000 sha256=%s size=42 f=a/b.jpg\n'
+    % ('0123456789abcdef' * 4),
+    'format=? hex=ABCDEF0123456789 neg=-5 zero=0 lead=007 mz=-0 f=a/a b\n',
+    'format=png size=1 size=2 tags=x%20y,%25 empty= f=a/b.jpg\n',
+    'mtime=12345678901234567890123 format=deleted f=z\n',
+    'format=jpeg hex=00ff00ff00ff00ff00 f=a/a\n')
+
+
+class CatalogTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self.filename = tempfile.mkstemp(suffix='.mfc')
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+  def write_lines(self, lines, block_size, do_append=False):
+    writer = mediafileinfo_catalog.CatalogWriter(
+        self.filename, block_size, do_append)
+    for line in lines:
+      writer.write_line(line)
+    writer.close()
+
+  def test_roundtrip(self):
+    self.write_lines(LINES[:3], 2)
+    self.write_lines(LINES[3:], 10, True)
+    reader = mediafileinfo_catalog.CatalogReader(self.filename)
+    try:
+      self.assertEqual(len(reader.blocks), 3)
+      self.assertEqual(''.join(reader.iter_lines()), ''.join(LINES))
+      self.assertEqual(list(reader.iter_lines(('png', 'deleted'))),
+                       [LINES[2], LINES[3]])
+      self.assertEqual(reader.get_line('a/b.jpg'), LINES[2])
+      self.assertEqual(reader.get_line('a/a'), LINES[4])
+      self.assertEqual(reader.get_line('a/c'), None)
+      self.assertEqual(reader.get_info('a/a b')['neg'], '-5')
+    finally:
+      reader.close()
+
+  def test_get_line_cache(self):
+    lines = ['format=? size=%d f=x/%d\n' % (i, i * 7 % 20) for i in xrange(40)]
+    self.write_lines(lines, 6)  # Blocks with overlapping filename ranges.
+    expected = dict((line.split(' f=')[1][:-1], line) for line in lines)
+    for cache_size, filenames_cache_size in ((1, 1), (1, 3), (8, 64)):
+      reader = mediafileinfo_catalog.CatalogReader(
+          self.filename, cache_size, filenames_cache_size)
+      try:
+        for filename in sorted(expected) * 2 + ['x/-', 'x/99']:
+          self.assertEqual(reader.get_line(filename), expected.get(filename))
+        self.assertEqual(''.join(reader.iter_lines()), ''.join(lines))
+      finally:
+        reader.close()
+
+  def test_failed_append(self):
+    self.write_lines(LINES[:2], 10)
+    size = os.path.getsize(self.filename)
+    self.assertRaises(ValueError, self.write_lines,
+                      (LINES[2], 'bad line\n'), 1, True)
+    self.assertEqual(os.path.getsize(self.filename), size)
+
+
+if __name__ == '__main__':
+  unittest.main(argv=[sys.argv[0], '-v'] + sys.argv[1:])
@@ -0,0 +1,461 @@
+"""Reading and writing lines of the mediafileinfo (.mfo) format.
+
+See mediafileinfo_format.md for the format. This module works with
+Python 2.4--2.7 and 3.x, so that sample clients (e.g. client.py) can also
+use it.
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+
+
+class LineWriter(object):
+  """Buffered writer of complete lines to a file descriptor.
+
+  Lines are buffered until the buffer reaches flush_size bytes or the oldest
+  buffered line becomes flush_sec seconds old (whichever happens first), and
+  then the buffer is written with a single os.write call (per 1 GiB). Thus a
+  killed process leaves only whole lines behind, just like with an
+  unbuffered file and one write call per line, but with much fewer system
+  calls. The time-based flushes are done by a background thread, started
+  at the first write.
+
+  Optionally, the file descriptor is also fsync()ed after a flush if the
+  previous fsync was at least fsync_sec seconds ago.
+
+  Callers which need a response to be visible immediately (e.g. the --pipe
+  server) should call flush() explicitly after each response.
+
+  If a write fails, the unwritten data is kept in the buffer. An exception
+  raised by a flush in the background thread is re-raised by the next call
+  to write(), flush(), fsync() or close().
+
+  This class is thread-safe. close() must be called (e.g. with atexit) to
+  stop the background thread before the interpreter exits.
+  """
+
+  def __init__(self, fd, flush_size=65536, flush_sec=0.2, fsync_sec=None,
+               do_close_fd=False):
+    self.fd = fd
+    self.flush_size = flush_size
+    self.flush_sec = flush_sec
+    self.fsync_sec = fsync_sec
+    self.do_close_fd = do_close_fd
+    self._buf = []
+    self._buf_size = 0
+    self._buf_time = 0  # time.time() of the first write to an empty _buf.
+    self._lock = threading.Lock()
+    self._cond = threading.Condition(self._lock)
+    self._thread = None
+    self._fsynced_at = time.time()
+    self._error = None  # Exception raised in the background thread.
+
+  def fileno(self):
+    return self.fd
+
+  def write(self, data):
+    """Buffers data, which must be a concatenation of complete lines."""
+    self._lock.acquire()
+    try:
+      if self.fd < 0:
+        raise ValueError('Write to closed LineWriter.')
+      self._raise_error_locked()
+      if not self._buf_size:
+        self._buf_time = time.time()
+        if self.flush_sec is not None:
+          if self._thread is None:
+            self._thread = threading.Thread(target=self._run_flusher)
+            self._thread.setDaemon(True)
+            self._thread.start()
+          self._cond.notify()
+      self._buf.append(data)
+      self._buf_size += len(data)
+      if self._buf_size >= self.flush_size:
+        self._flush_locked()
+    finally:
+      self._lock.release()
+
+  def _run_flusher(self):
+    """Flushes the buffer flush_sec seconds after the first write to it."""
+    self._lock.acquire()
+    try:
+      while self.fd >= 0:
+        if not self._buf_size or self._error is not None:
+          self._cond.wait()  # Don't retry until the error is reported.
+          continue
+        delay = self._buf_time + self.flush_sec - time.time()
+        if delay > 0:
+          self._cond.wait(delay)
+        else:
+          try:
+            self._flush_locked()
+          except Exception:
+            self._error = sys.exc_info()[1]
+    finally:
+      self._lock.release()
+
+  def _raise_error_locked(self):
+    error = self._error
+    if error is not None:
+      self._error = None
+      self._cond.notify()  # Let the background thread retry.
+      raise error
+
+  def _flush_locked(self):
+    if not self._buf_size:
+      return
+    data = self._buf[0][:0].join(self._buf)  # Works with str and bytes.
+    i, size = 0, len(data)
+    try:
+      while i < size:
+        if i or size > 1 << 30:
+          i += os.write(self.fd, data[i : i + (1 << 30)])
+        else:  # Fast path without copying.
+          i += os.write(self.fd, data)
+    except:
+      self._buf[:] = [data[i:]]  # Keep the unwritten data for a retry.
+      self._buf_size = size - i
+      raise
+    del self._buf[:]
+    self._buf_size = 0
+    if (self.fsync_sec is not None and
+        time.time() >= self._fsynced_at + self.fsync_sec):
+      self._fsync_locked()
+
+  def _fsync_locked(self):
+    os.fsync(self.fd)
+    self._fsynced_at = time.time()
+
+  def flush(self):
+    self._lock.acquire()
+    try:
+      if self.fd >= 0:
+        self._raise_error_locked()
+        self._flush_locked()
+    finally:
+      self._lock.release()
+
+  def fsync(self):
+    """Flushes and fsync()s the file descriptor."""
+    self._lock.acquire()
+    try:
+      self._raise_error_locked()
+      self._flush_locked()
+      self._fsync_locked()
+    finally:
+      self._lock.release()
+
+  def close(self):
+    self._lock.acquire()
+    try:
+      thread, self._thread = self._thread, None
+      error, self._error = self._error, None
+      if self.fd >= 0:
+        try:
+          self._flush_locked()
+          if self.fsync_sec is not None:
+            self._fsync_locked()
+        finally:
+          if self.do_close_fd:
+            os.close(self.fd)
+          self.fd = -1
+          self._cond.notify()
+    finally:
+      self._lock.release()
+    if thread is not None and thread is not threading.currentThread():
+      thread.join()
+    if error is not None:
+      raise error
+
+
+class RecordReader(object):
+  """Buffered reader of records (e.g. lines) from a file descriptor.
+
+  Unlike a file object, this supports any single-byte record terminator
+  (e.g. '\\0'), and the terminator can be changed between records.
+  readline() returns as soon as a complete record is available, it doesn't
+  wait for more data.
+  """
+
+  def __init__(self, fd, read_size=65536):
+    self.fd = fd
+    self.read_size = read_size
+    self._buf = ''.encode('ascii')
+    self._i = 0  # Start of unread data in self._buf.
+    self._nl = '\n'.encode('ascii')
+
+  def fileno(self):
+    return self.fd
+
+  def readline(self, terminator=None):
+    """Returns the next record including the terminator, or the partial
+    record without a terminator at EOF, or an empty string at EOF."""
+    if terminator is None:
+      terminator = self._nl
+    buf, i = self._buf, self._i
+    j = buf.find(terminator, i)
+    while j < 0:
+      data = os.read(self.fd, self.read_size)
+      if not data:
+        self._buf, self._i = buf[:0], 0
+        return buf[i:]
+      k = len(buf) - i
+      buf, i = buf[i:] + data, 0
+      j = buf.find(terminator, k)
+    self._buf, self._i = buf, j + 1
+    return buf[i : j + 1]
+
+
+# --- Parsing mediainfo lines.
+
+_bytes_type = type(''.encode('ascii'))
+
+
+def _get_parse_consts(str_type):
+  if str_type is str:
+    encode = str
+    hex_to_char = lambda match: chr(int(match.group(1), 16))
+  else:  # bytes in Python 3.
+    encode = lambda s: s.encode('ascii')
+    hex_to_char = lambda match: str_type((int(match.group(1), 16),))
+  return (encode(' f='), encode(' '), encode('='), encode('%'),
+          encode('\n'), encode('f'),
+          re.compile(encode(r'%([0-9a-fA-F]{2})')), hex_to_char)
+
+
+# (f_sep, item_sep, eq, percent, newline, f_key, percent_hex_re,
+# hex_to_char) for str, and for bytes (if different, i.e. in Python 3).
+_PARSE_CONSTS = {str: _get_parse_consts(str)}
+if _bytes_type is not str:
+  _PARSE_CONSTS[_bytes_type] = _get_parse_consts(_bytes_type)
+
+
+def decode_info_value(value):
+  """Decodes the %XX escapes in an info value (as written by format_info)."""
+  consts = _PARSE_CONSTS[type(value)]
+  if consts[3] not in value:  # Fast path.
+    return value
+  return consts[6].sub(consts[7], value)
+
+
+def parse_info_fields(fields, keys=None, do_decode=True):
+  """Parses space-separated key=value fields of a mediainfo line to a dict.
+
+  Args:
+    fields: The part of the line before ` f=', a str (or bytes in Python 3).
+    keys: None to keep all fields, or a collection of the keys to keep.
+      Other fields are not decoded.
+    do_decode: Whether to decode %XX escapes in the values. If false, values
+      are kept encoded, and can be decoded later with decode_info_value.
+  Returns:
+    A dict mapping keys to values (of the same type as fields).
+  Raises:
+    ValueError: If a field is not key=value, or a key is duplicate or f.
+  """
+  item_sep, eq, percent, _, f_key, percent_hex_re, hex_to_char = (
+      _PARSE_CONSTS[type(fields)][1:])
+  items = fields.split(item_sep)
+  try:
+    info = dict([item.split(eq, 1) for item in items])  # Fast, in C.
+  except ValueError:
+    for item in items:
+      if eq not in item:
+        raise ValueError('Expected key=value, got: %r' % item)
+    raise
+  if len(info) != len(items) or f_key in info:
+    seen = {}
+    for item in items:
+      key = item.split(eq, 1)[0]
+      if key in seen or key == f_key:
+        raise ValueError('Duplicate key %r in info line %r' % (key, fields))
+      seen[key] = True
+  if keys is not None:
+    info = dict([(key, info[key]) for key in keys if key in info])
+  if do_decode and percent in fields:  # Most lines don't have %XX.
+    for key, value in list(info.items()):
+      if percent in value:
+        info[key] = percent_hex_re.sub(hex_to_char, value)
+  return info
+
+
+def parse_info_line(line, keys=None, do_decode=True):
+  """Parses a mediainfo line (format_info output) to a dict.
+
+  The filename (f=, always present in the result) is never decoded. See
+  parse_info_fields for the arguments.
+
+  Raises:
+    ValueError: If the line is malformed.
+  """
+  consts = _PARSE_CONSTS[type(line)]
+  if line.endswith(consts[4]):
+    line = line[:-1]  # Don't remove '\r', it's binary.
+  i = line.find(consts[0])
+  if i < 0:
+    raise ValueError('f= not found in line: %r' % line)
+  info = parse_info_fields(line[:i], keys, do_decode)
+  info[consts[5]] = line[i + 3:]
+  return info
+
+
+def iter_info_lines(line_source, keys=None, do_decode=True):
+  """Yields the parsed lines of line_source (e.g. a file) lazily.
+
+  See parse_info_line for the arguments.
+  """
+  for line in line_source:
+    yield parse_info_line(line, keys, do_decode)
+
+
+# --- Formatting mediainfo lines.
+
+
+def _format_bool(v):
+  return str(int(v))
+
+
+def _format_float(v):
+  if abs(v) < 1e15 and int(v) == v:  # Remove the trailing '.0'.
+    return str(int(v))
+  return repr(v)
+
+
+def _encode_str(v):
+  # Most values don't need escaping, and `in' is faster than .replace.
+  if '%' in v or ' ' in v or '\n' in v or '\0' in v:
+    return (v.replace('%', '%25').replace('\0', '%00').replace('\n', '%0A')
+            .replace(' ', '%20'))
+  return v
+
+
+def _check_encoded_str(v):
+  if ' ' in v or '\n' in v:
+    raise ValueError('Bad info string value: %r' % v)
+  return v
+
+
+def _get_value_formatters(format_str):
+  """Returns a dict mapping value types to formatter functions.
+
+  None as a formatter means that values of that type are omitted.
+  """
+  formatters = {bool: _format_bool, int: str, type(1 << 64): str,
+                float: _format_float, str: format_str}
+  for type_obj in (tuple, list, dict, set):
+    formatters[type_obj] = None
+  return formatters
+
+
+# Dispatch tables by exact type, for format_info(..., do_encode=...).
+_VALUE_FORMATTERS = {True: _get_value_formatters(_encode_str),
+                     False: _get_value_formatters(_check_encoded_str)}
+
+
+def _get_subclass_formatter(formatters, type_obj):
+  """Finds the formatter of a subclass (slow path) and caches it."""
+  for base_type in (bool, int, type(1 << 64), float, str,
+                    tuple, list, dict, set):
+    if issubclass(type_obj, base_type):
+      formatters[type_obj] = formatter = formatters[base_type]
+      return formatter
+  raise TypeError(type_obj)
+
+
+def format_info(info, terminator='\n', do_encode=True):
+  """Formats an info dict as a mediainfo line.
+
+  The output is format=... first, then the other fields sorted by key, and
+  then f=... (unescaped) last. Values of type tuple, list, dict and set are
+  omitted.
+
+  Args:
+    info: A dict mapping str keys to values.
+    terminator: The line terminator, '\\n' or '\\0'.
+    do_encode: Whether to %XX-escape str values. If false, the values must
+      already be escaped (e.g. parsed with do_decode=False).
+  Returns:
+    The line as a str.
+  Raises:
+    ValueError: If the filename or a value (with do_encode=False) contains
+      an invalid byte.
+    TypeError: If a value has an unsupported type.
+  """
+  formatters = _VALUE_FORMATTERS[bool(do_encode)]
+  value = info.get('format') or '?'
+  try:
+    formatter = formatters[type(value)]
+  except KeyError:
+    formatter = _get_subclass_formatter(formatters, type(value))
+  if formatter is None:
+    raise TypeError(type(value))
+  output = ['format=', formatter(value)]
+  for key, value in sorted(info.items()):
+    if key != 'f' and key != 'format':
+      try:
+        formatter = formatters[type(value)]
+      except KeyError:
+        formatter = _get_subclass_formatter(formatters, type(value))
+      if formatter is not None:
+        output.append(' %s=%s' % (key, formatter(value)))
+  filename = info.get('f')
+  if filename is not None:
+    if '\0' in filename or (terminator == '\n' and '\n' in filename):
+      raise ValueError('Invalid byte in filename: %r' % filename)
+    output.append(' f=')  # Emit ` f=' last.
+    output.append(filename)
+  output.append(terminator)
+  return ''.join(output)
+
+
+# --- Sharding: splitting a scan among multiple independent runs.
+#
+# With --shard=i/N (media_scan.py and mediafileinfo.py), each of the N runs
+# scans a disjoint part of the same directory trees, without coordination.
+# Directories within --shard-depth= (the command-line arguments have depth
+# 1) are split: their files and subdirectories are assigned to a shard by a
+# hash of their path. Each deeper subdirectory, with its entire subtree,
+# belongs to a single shard. The decisions depend only on the path (not on
+# e.g. the number of entries, which may change between the runs), so the
+# shards are disjoint and together they cover everything.
+#
+
+
+def get_shard_index(path, shard_count):
+  """Returns the shard index of path, the same on all platforms."""
+  return (zlib.crc32(path) & 0xffffffff) % shard_count
+
+
+def get_shard_subdir_depth(path, shard_depth, shard):
+  """Decides about a subdirectory of a split directory.
+
+  Args:
+    path: Path of the subdirectory.
+    shard_depth: Depth of the split parent directory. The (virtual) parent
+      of the command-line arguments has depth 0.
+    shard: A (shard_index, shard_count, max_split_depth) tuple.
+  Returns:
+    (is_in_shard, subdir_shard_depth) pair. If is_in_shard is false, the
+    subdirectory should be skipped. subdir_shard_depth is None if the entire
+    subtree is in the shard, otherwise it is the depth of path, and its
+    entries have to be filtered.
+  """
+  shard_index, shard_count, max_split_depth = shard
+  shard_depth += 1
+  if shard_depth <= max_split_depth:
+    return True, shard_depth
+  return get_shard_index(path, shard_count) == shard_index, None
+
+
+def parse_shard_flag(value):
+  """Parses the i/N value of --shard=, returns (shard_index, shard_count)."""
+  try:
+    shard_index, shard_count = map(int, value.split('/'))
+  except ValueError:
+    shard_index = shard_count = 0
+  if not 0 <= shard_index < shard_count:
+    raise ValueError('Bad shard, expected i/N with 0 <= i < N: %s' % value)
+  return shard_index, shard_count
@@ -0,0 +1,108 @@
+#! /bin/sh
+
+""":" # mediafileinfo_lines_test.py: Unit tests for mediafileinfo_lines.py.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: mediafileinfo_lines_test.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import mediafileinfo_lines
+
+
+def wait_until(func, timeout=10):
+  deadline = time.time() + timeout
+  while not func() and time.time() < deadline:
+    time.sleep(0.005)
+
+
+class LineWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self.filename = tempfile.mkstemp(prefix='mediafileinfo_lines_test.')
+    os.close(fd)
+    self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+    self.ro_fd = os.open(self.filename, os.O_RDONLY)  # Writes fail.
+
+  def tearDown(self):
+    os.close(self.fd)
+    os.close(self.ro_fd)
+    os.remove(self.filename)
+
+  def get_data(self):
+    f = open(self.filename, 'rb')
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  def test_flush_size(self):
+    writer = mediafileinfo_lines.LineWriter(self.fd, 8, None)
+    writer.write('abc\n')
+    self.assertEqual(self.get_data(), '')
+    writer.write('def\n')
+    self.assertEqual(self.get_data(), 'abc\ndef\n')
+    writer.write('g\n')
+    self.assertEqual(self.get_data(), 'abc\ndef\n')
+    writer.close()
+    self.assertEqual(self.get_data(), 'abc\ndef\ng\n')
+    self.assertRaises(ValueError, writer.write, 'h\n')
+
+  def test_flush_sec(self):
+    writer = mediafileinfo_lines.LineWriter(self.fd, 65536, 0.05)
+    try:
+      writer.write('abc\n')
+      writer.write('def\n')
+      wait_until(self.get_data)
+      self.assertEqual(self.get_data(), 'abc\ndef\n')
+      writer.write('g\n')  # Flushed by the same background thread.
+      wait_until(lambda: len(self.get_data()) > 8)
+      self.assertEqual(self.get_data(), 'abc\ndef\ng\n')
+    finally:
+      writer.close()
+    self.assertEqual(writer._thread, None)
+
+  def test_failed_flush(self):
+    writer = mediafileinfo_lines.LineWriter(self.ro_fd, 65536, None)
+    writer.write('abc\n')
+    self.assertRaises(OSError, writer.flush)
+    writer.fd = self.fd
+    writer.write('def\n')
+    writer.close()
+    self.assertEqual(self.get_data(), 'abc\ndef\n')  # Nothing lost.
+
+  def test_failed_background_flush(self):
+    writer = mediafileinfo_lines.LineWriter(self.ro_fd, 65536, 0.01)
+    try:
+      writer.write('abc\n')
+      wait_until(lambda: writer._error is not None)
+      writer.fd = self.fd
+      self.assertRaises(OSError, writer.write, 'def\n')  # Not buffered.
+      writer.write('ghi\n')
+    finally:
+      writer.close()
+    self.assertEqual(self.get_data(), 'abc\nghi\n')
+    for method in ('flush', 'fsync', 'close'):
+      writer = mediafileinfo_lines.LineWriter(self.ro_fd, 65536, 0.01)
+      try:
+        writer.write('jkl\n')
+        wait_until(lambda: writer._error is not None)
+        writer.fd = self.fd
+        self.assertRaises(OSError, getattr(writer, method))
+      finally:
+        writer.close()
+    self.assertEqual(self.get_data(), 'abc\nghi\n' + 'jkl\n' * 3)
+
+
+if __name__ == '__main__':
+  unittest.main(argv=[sys.argv[0], '-v'] + sys.argv[1:])
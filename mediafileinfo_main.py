@@ -24,6 +24,7 @@ Typical usage: mediafileinfo.py *.mp4
 
 import mediafileinfo_detect
 import mediafileinfo_formatdb
+import mediafileinfo_lines
 
 import os
 import os.path
@@ -35,35 +36,7 @@ ANALYZE = mediafileinfo_formatdb.FormatDb(mediafileinfo_detect).analyze
 ANALYZE_FUNCS_BY_FORMAT = mediafileinfo_formatdb.get_analyze_funcs_by_format(mediafileinfo_detect)
 
 
-def format_info(info):
-  def format_value(v):
-    if isinstance(v, bool):
-      return int(v)
-    if isinstance(v, float):
-      if abs(v) < 1e15 and int(v) == v:  # Remove the trailing '.0'.
-        return int(v)
-      return repr(v)
-    if isinstance(v, (int, long)):
-      return str(v)
-    if isinstance(v, str):
-      # Faster than a regexp if there are no matches.
-      return (v.replace('%', '%25').replace('\0', '%00').replace('\n', '%0A')
-              .replace(' ', '%20'))
-    raise TypeError(type(v))
-  output = ['format=%s' % format_value(info.get('format') or '?')]
-  # TODO(pts): Display brands list.
-  output.extend(
-      ' %s=%s' % (k, format_value(v))
-      for k, v in sorted(info.iteritems())
-      if k != 'f' and k != 'format' and
-      not isinstance(v, (tuple, list, dict, set)))
-  filename = info.get('f')
-  if filename is not None:
-    if '\n' in filename or '\0' in filename:
-      raise ValueError('Invalid byte in filename: %r' % filename)
-    output.append(' f=%s' % filename)  # Emit ` f=' last.
-  output.append('\n')
-  return ''.join(output)
+format_info = mediafileinfo_lines.format_info
 
 
 def get_file_info(filename, stat_obj):
@@ -148,8 +121,25 @@ def get_symlink_info(filename, stat_obj):
   return info, False
 
 
-def info_scan(dirname, outf, get_file_info_func, has_lstat):
-  """Prints results sorted by filename."""
+# --- Sharding: see mediafileinfo_lines.py .
+
+
+get_shard_index = mediafileinfo_lines.get_shard_index
+get_shard_subdir_depth = mediafileinfo_lines.get_shard_subdir_depth
+parse_shard_flag = mediafileinfo_lines.parse_shard_flag
+
+
+# ---
+
+
+def info_scan(dirname, outf, get_file_info_func, has_lstat, shard=None, shard_depth=None):
+  """Prints results sorted by filename.
+
+  Args:
+    shard: None or a (shard_index, shard_count, shard_depth) tuple.
+    shard_depth: None if all entries in dirname are in the shard, otherwise
+      the depth of dirname. See get_shard_subdir_depth for details.
+  """
   had_error = False
   try:
     entries = os.listdir(dirname)
@@ -175,6 +165,8 @@ def info_scan(dirname, outf, get_file_info_func, has_lstat):
       had_error = True
     elif stat.S_ISDIR(stat_obj.st_mode):
       subdirs.append(filename)
+    elif shard_depth is not None and get_shard_index(filename, shard[1]) != shard[0]:
+      pass
     elif (stat.S_ISREG(stat_obj.st_mode) or
           stat.S_ISLNK(stat_obj.st_mode)):
       files.append((filename, stat_obj))
@@ -189,13 +181,18 @@ def info_scan(dirname, outf, get_file_info_func, has_lstat):
       print >>sys.stderr, 'warning: unknown file format: %r' % filename
       had_error = True
     outf.write(format_info(info))
-    outf.flush()
   for filename in sorted(subdirs):
-    had_error |= info_scan(filename, outf, get_file_info_func, has_lstat)
+    subdir_shard_depth = None
+    if shard_depth is not None:
+      is_in_shard, subdir_shard_depth = get_shard_subdir_depth(
+          filename, shard_depth, shard)
+      if not is_in_shard:
+        continue
+    had_error |= info_scan(filename, outf, get_file_info_func, has_lstat, shard, subdir_shard_depth)
   return had_error
 
 
-def process(filename, outf, get_file_info_func, has_lstat):
+def process(filename, outf, get_file_info_func, has_lstat, shard=None):
   """Prints results sorted by filename."""
   try:
     if has_lstat:
@@ -206,11 +203,17 @@ def process(filename, outf, get_file_info_func, has_lstat):
     print >>sys.stderr, 'error: missing file %r: %s' % (filename, e)
     return True
   if stat.S_ISDIR(stat_obj.st_mode):
-    return info_scan(filename, outf, get_file_info_func, has_lstat)
+    shard_depth = None
+    if shard:
+      is_in_shard, shard_depth = get_shard_subdir_depth(filename, 0, shard)
+      if not is_in_shard:
+        return False
+    return info_scan(filename, outf, get_file_info_func, has_lstat, shard, shard_depth)
+  elif shard and get_shard_index(filename, shard[1]) != shard[0]:
+    return False
   elif stat.S_ISREG(stat_obj.st_mode):
     info, had_error = get_file_info_func(filename, stat_obj)
     outf.write(format_info(info))
-    outf.flush()
     if not had_error and info.get('format') == '?':
       print >>sys.stderr, 'warning: unknown file format: %r' % filename
       had_error = True
@@ -218,46 +221,507 @@ def process(filename, outf, get_file_info_func, has_lstat):
   elif has_lstat and stat.S_ISLNK(stat_obj.st_mode):
     info, had_error = get_symlink_info(filename, stat_obj)
     outf.write(format_info(info))
-    outf.flush()
     return had_error
   else:
     return False
 
 
-def run_pipe(inf, outf, get_file_info_func, has_lstat):
+def get_pipe_response(filename, get_file_info_func, has_lstat,
+                      terminator='\n'):
+  """Returns the response record (including the terminator) for filename."""
+  try:
+    if has_lstat:
+      stat_obj = os.lstat(filename)
+    else:
+      stat_obj = os.stat(filename)
+  except OSError, e:
+    stat_obj = None
+  if stat_obj is None:
+    return 'format=? error=missing_file f=%s%s' % (filename, terminator)
+  elif stat.S_ISDIR(stat_obj.st_mode):
+    return 'format=? error=is_dir f=%s%s' % (filename, terminator)
+  elif stat.S_ISREG(stat_obj.st_mode):
+    # This returns 'format=? ... error=...' upon an error.
+    info, had_error = get_file_info_func(filename, stat_obj)
+    if info is None:  # File disappeared or unreadable.
+      return 'format=? error=missing_file f=%s%s' % (filename, terminator)
+    return format_info(info, terminator)
+  elif has_lstat and stat.S_ISLNK(stat_obj.st_mode):
+    info, had_error = get_symlink_info(filename, stat_obj)
+    return format_info(info, terminator)
+  else:  # Not a file or directory.
+    return 'format=? error=bad_node f=%s%s' % (filename, terminator)
+
+
+def parse_pipe_options(line):
+  """Parses the `!v2 key=value ...' handshake line, returns a dict."""
+  options = {}
+  for item in line.split(' ')[1:]:
+    if item:
+      key, value = (item.split('=', 1) + [''])[:2]
+      options[key] = value
+  return options
+
+
+def get_pipe_record_value(record, terminator):
+  if terminator == '\n':
+    return record.rstrip('\r\n')  # Either, both etc.
+  return record[:-1]
+
+
+def read_pipe_batch(inf, terminator):
+  """Reads the filenames of a !batch request, up to an empty record.
+
+  Returns the list of filenames, or None if EOF or an incomplete record was
+  reached before the empty record.
+  """
+  filenames = []
+  while 1:
+    record = inf.readline(terminator)
+    if not record.endswith(terminator):
+      return None
+    filename = get_pipe_record_value(record, terminator)
+    if not filename:
+      return filenames
+    filenames.append(filename)
+
+
+def run_pipe(inf, outf, get_file_info_func, has_lstat,
+             workers=4, max_in_flight=64, max_requests=0):
+  """Serves requests on inf, flushing outf after each response.
+
+  inf must be a mediafileinfo_lines.RecordReader or similar. If the first
+  line is a handshake (`!v1 ...' or `!v2 ...'), then the session is
+  extended: it has the options (e.g. framing=nul) specified in the
+  handshake, and it accepts !batch requests. `!v2' makes requests
+  concurrent, see run_pipe_v2. Otherwise requests are served one by one,
+  in order.
+
+  If max_requests is positive, stops reading requests after that many
+  (each filename in a !batch counts as a request), and returns when their
+  responses have been written.
+
+  Returns:
+    The number of requests served.
+  """
   import signal
   signal.signal(signal.SIGINT, signal.SIG_DFL)  # Prevent KeyboardInterrupt.
-  while 1:
-    line = inf.readline()
-    if not line:
-      break
-    if not line.endswith('\n'):
-      outf.write('format=? error=incomplete_line\n')
+  line = inf.readline()
+  terminator, is_extended = '\n', False
+  if line.endswith('\n') and line[:3] in ('!v1', '!v2'):
+    version = line[:3]
+    value = get_pipe_record_value(line, '\n')
+    if value == version or value.startswith(version + ' '):
+      options = parse_pipe_options(value)
+      if options.get('framing') == 'nul':
+        terminator = '\0'
+      if version == '!v2':
+        return run_pipe_v2(inf, outf, get_file_info_func, has_lstat, options,
+                           terminator, workers, max_in_flight, max_requests)
+      outf.write('!v1 framing=%s\n' % ('line', 'nul')[terminator == '\0'])
+      outf.flush()
+      line, is_extended = inf.readline(terminator), True
+  request_count = 0
+  while line:
+    if not line.endswith(terminator):
+      outf.write('format=? error=incomplete_line%s' % terminator)
       outf.flush()
       break
-    filename = line = line.rstrip('\r\n')  # Either, both etc.
+    filename = get_pipe_record_value(line, terminator)
+    if is_extended and filename == '!batch':
+      filenames = read_pipe_batch(inf, terminator)
+      if filenames is None:
+        outf.write('format=? error=incomplete_batch%s' % terminator)
+        outf.flush()
+        break
+      output = [get_pipe_response(
+          filename, get_file_info_func, has_lstat, terminator)
+          for filename in filenames]
+      output.append('!end%s' % terminator)
+      outf.write(''.join(output))
+      request_count += len(filenames)
+    else:
+      outf.write(get_pipe_response(
+          filename, get_file_info_func, has_lstat, terminator))
+      request_count += 1
+    outf.flush()
+    if max_requests > 0 and request_count >= max_requests:
+      break
+    line = inf.readline(terminator)
+  return request_count
+
+
+def run_pipe_v2(inf, outf, get_file_info_func, has_lstat, options,
+                terminator, workers, max_in_flight, max_requests=0):
+  """Serves `<id> <filename>' and `<id> !batch' requests on inf concurrently.
+
+  Responses are written as `<id> <response>' records in the order they are
+  ready, which is not necessarily the request order. The responses of a
+  batch are written together (followed by `<id> !end'), in request order.
+  At most max_in_flight requests are being processed (or waiting for a
+  worker thread) at a time; when this limit is reached, no more requests
+  are read from inf. Returns the number of requests served, stopping after
+  max_requests (if positive) like run_pipe.
+  """
+  import Queue
+  import threading
+  try:
+    client_max_in_flight = int(options.get('max_in_flight') or 0)
+  except ValueError:
+    client_max_in_flight = 0
+  if client_max_in_flight > 0:
+    max_in_flight = min(max_in_flight, client_max_in_flight)
+  max_in_flight = max(max_in_flight, 1)
+  workers = max(min(workers, max_in_flight), 1)
+  outf.write('!v2 framing=%s max_in_flight=%d workers=%d\n' % (
+      ('line', 'nul')[terminator == '\0'], max_in_flight, workers))
+  outf.flush()
+  in_flight = threading.Semaphore(max_in_flight)
+  request_queue = Queue.Queue()
+
+  def get_response(filename):
     try:
-      if has_lstat:
-        stat_obj = os.lstat(filename)
+      return get_pipe_response(
+          filename, get_file_info_func, has_lstat, terminator)
+    except (KeyboardInterrupt, SystemExit):
+      raise
+    except Exception, e:
+      print >>sys.stderr, 'error: error detecting in %r: %s.%s: %s' % (
+          filename, e.__class__.__module__, e.__class__.__name__, e)
+      return 'format=? error=error f=%s%s' % (filename, terminator)
+
+  def worker():
+    while 1:
+      request = request_queue.get()
+      if request is None:
+        break
+      request_id, filename = request
+      try:
+        if isinstance(filename, list):  # !batch.
+          output = ['%s %s' % (request_id, get_response(filename2))
+                    for filename2 in filename]
+          output.append('%s !end%s' % (request_id, terminator))
+          outf.write(''.join(output))
+        else:
+          outf.write('%s %s' % (request_id, get_response(filename)))
+        outf.flush()
+      finally:
+        in_flight.release()
+
+  threads = []
+  for _ in xrange(workers):
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    threads.append(thread)
+  request_count = 0
+  try:
+    while not (max_requests > 0 and request_count >= max_requests):
+      line = inf.readline(terminator)
+      if not line:
+        break
+      if not line.endswith(terminator):
+        outf.write('- format=? error=incomplete_line%s' % terminator)
+        outf.flush()
+        break
+      line = get_pipe_record_value(line, terminator)
+      i = line.find(' ')
+      if i <= 0:
+        outf.write('- format=? error=bad_request%s' % terminator)
+        outf.flush()
+        continue
+      request_id, filename = line[:i], line[i + 1:]
+      if filename == '!batch':
+        filename = read_pipe_batch(inf, terminator)
+        if filename is None:
+          outf.write('%s format=? error=incomplete_batch%s' % (
+              request_id, terminator))
+          outf.flush()
+          break
+        request_count += len(filename)
       else:
-        stat_obj = os.stat(filename)
+        request_count += 1
+      in_flight.acquire()
+      request_queue.put((request_id, filename))
+  finally:
+    for _ in threads:
+      request_queue.put(None)
+    for thread in threads:
+      thread.join()
+  return request_count
+
+
+# --- Daemon serving the --pipe protocol on a Unix domain socket.
+
+
+def open_daemon_socket(socket_path, backlog):
+  """Returns a listening Unix domain socket.
+
+  If the environment variable MEDIAFILEINFO_DAEMON_FD is set (by
+  run_daemon after a SIGHUP), reuses the listening socket with that file
+  descriptor instead of creating a new one.
+  """
+  import errno
+  import socket
+  fd = os.environ.pop('MEDIAFILEINFO_DAEMON_FD', '')
+  if fd:
+    fd = int(fd)
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)  # socket.fromfd has dup()ed it.
+    return sock
+  if os.path.exists(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      try:
+        sock.connect(socket_path)
+      except socket.error, e:
+        if e.args[0] not in (errno.ECONNREFUSED, errno.ENOENT):
+          raise
+      else:
+        raise RuntimeError('Daemon already listening on: %s' % socket_path)
+    finally:
+      sock.close()
+    os.remove(socket_path)  # Stale socket of a dead daemon.
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.bind(socket_path)
+  sock.listen(backlog)
+  return sock
+
+
+def serve_daemon_worker(sock, get_file_info_func, has_lstat,
+                        workers, max_in_flight, max_connections,
+                        max_requests=0):
+  """Accepts and serves connections one by one, until SIGHUP or SIGTERM.
+
+  Runs in a preforked child process of run_daemon. The signal only takes
+  effect when the current connection has been closed by the client. Also
+  returns after max_connections connections or max_requests requests (if
+  positive), so that run_daemon replaces the worker with a fresh fork. When
+  max_requests is reached in the middle of a connection, the responses are
+  finished, and then the connection is closed: the client has to reconnect
+  and resend the requests it hasn't received a response for.
+  """
+  import errno
+  import select
+  import signal
+  import socket
+  state = {'is_stopping': False}
+  def handle_stop(signum, frame):
+    state['is_stopping'] = True
+  for signum in (signal.SIGHUP, signal.SIGTERM):
+    signal.signal(signum, handle_stop)
+    if callable(getattr(signal, 'siginterrupt', None)):
+      signal.siginterrupt(signum, False)  # Restart reads and writes.
+  sock.setblocking(False)  # Other workers may accept the connection first.
+  connection_count = request_count = 0
+  while not state['is_stopping']:
+    try:
+      select.select((sock,), (), ())
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      continue
+    try:
+      conn = sock.accept()[0]
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        raise
+      continue
+    conn.setblocking(True)
+    inf = mediafileinfo_lines.RecordReader(conn.fileno())
+    outf = mediafileinfo_lines.LineWriter(conn.fileno(), flush_sec=None)
+    try:
+      try:
+        request_count += run_pipe(
+            inf, outf, get_file_info_func, has_lstat, workers, max_in_flight,
+            max_requests and max_requests - request_count)
+        outf.close()
+        # Signal EOF, and read the unserved requests, so that the client
+        # gets EOF (rather than ECONNRESET) after the last response.
+        conn.shutdown(socket.SHUT_WR)
+        while conn.recv(65536):
+          pass
+      except (IOError, OSError, socket.error), e:
+        if e.args[0] not in (errno.EPIPE, errno.ECONNRESET):
+          raise
+    finally:
+      conn.close()
+    connection_count += 1
+    if ((max_connections > 0 and connection_count >= max_connections) or
+        (max_requests > 0 and request_count >= max_requests)):
+      break
+
+
+def preload_for_fork():
+  """Prepares the process for forking many long-lived workers.
+
+  Forked workers share memory pages with the parent until either of them
+  writes to the page. CPython writes to an object when its reference count
+  changes (this can't be avoided) and when the cyclic garbage collector
+  traverses it: a full collection in a worker touches every container
+  object, thus it makes most of the heap private to the worker. To keep
+  the large constant tables (e.g. FORMAT_ITEMS and the prefix tables of
+  FORMAT_DB) shared, this function imports everything the workers need,
+  collects garbage created so far (so that the heap is compact), and
+  disables full (generation 2) collections, or freezes the existing
+  objects with gc.freeze() if available (Python >=3.7). Collections of
+  young generations still happen in the workers.
+
+  Without gc.freeze(), cyclic garbage which survives into generation 2 in
+  a worker is never freed, so run_daemon recycles the workers after
+  max_connections connections instead.
+  """
+  import gc
+  # Import modules which would be imported lazily by the workers. The
+  # FormatDb and the analyzer maps have already been built at import time.
+  import errno
+  import Queue
+  import select
+  import signal
+  import socket
+  import threading
+  import zlib
+  gc.collect()
+  if callable(getattr(gc, 'freeze', None)):
+    gc.freeze()
+  else:
+    threshold0, threshold1 = gc.get_threshold()[:2]
+    gc.set_threshold(threshold0, threshold1, 1 << 30)
+
+
+def get_process_memory(pid='self'):
+  """Returns (rss, private_rss) of the process in bytes, or None.
+
+  private_rss is the size of pages not shared with any other process (e.g.
+  pages copied after fork). Works on Linux only.
+  """
+  for filename in ('/proc/%s/smaps_rollup' % pid, '/proc/%s/smaps' % pid):
+    try:
+      f = open(filename)
+    except IOError:
+      continue
+    try:
+      rss = private_rss = 0
+      for line in f:
+        if line.startswith('Rss:'):
+          rss += int(line.split()[1]) << 10
+        elif line.startswith('Private_'):  # Private_Clean or Private_Dirty.
+          private_rss += int(line.split()[1]) << 10
+    finally:
+      f.close()
+    return rss, private_rss
+  return None
+
+
+def report_daemon_memory(pids):
+  """Prints memory usage of the daemon and its workers to stderr."""
+  for pid in [os.getpid()] + sorted(pids):
+    memory = get_process_memory(pid)
+    if memory:
+      print >>sys.stderr, (
+          'info: memory %s pid=%d rss=%d private_rss=%d shared_rss=%d' %
+          (('worker', 'daemon')[pid == os.getpid()], pid, memory[0],
+           memory[1], memory[0] - memory[1]))
+
+
+def run_daemon(socket_path, get_file_info_func, has_lstat, processes,
+               workers, max_in_flight, backlog, max_connections,
+               max_requests=0):
+  """Serves the --pipe protocol on a Unix domain socket.
+
+  Forks processes worker processes (after the analyzer modules have been
+  loaded), each of them serving one connection at a time. While all of them
+  are busy, new connections wait in the listen queue of the socket (at most
+  backlog of them). Worker processes which exit are restarted.
+
+  Each worker exits after serving max_connections connections or
+  max_requests requests (0 means unlimited), whichever comes first, and a
+  fresh one is forked (see serve_daemon_worker for long connections). This
+  is a trade-off: full
+  garbage collections are disabled in the workers (see preload_for_fork)
+  to keep the heap shared with the daemon, so cyclic garbage in the oldest
+  generation accumulates until the worker exits. A smaller value bounds
+  the memory growth of the workers, a larger value saves the forks (and
+  the page copies after them, a few MB per worker).
+
+  On SIGHUP, the daemon reloads gracefully: old workers finish their
+  current connection and then exit, and the daemon re-executes itself
+  with the same listening socket. On SIGTERM or SIGINT, the daemon
+  waits for the workers to finish their current connection, then exits.
+  On SIGUSR1, the daemon reports the memory usage of the workers.
+  """
+  import errno
+  import signal
+  import time
+  sock = open_daemon_socket(socket_path, backlog)
+  state = {'signum': None, 'is_report_pending': False}
+  def handle_signal(signum, frame):
+    state['signum'] = signum
+  def handle_report(signum, frame):
+    state['is_report_pending'] = True
+  for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+    signal.signal(signum, handle_signal)
+  signal.signal(signal.SIGUSR1, handle_report)
+  pids = {}  # Maps pid to start time.
+  preload_for_fork()
+  print >>sys.stderr, 'info: daemon listening on %s with %d processes' % (
+      socket_path, processes)
+  while 1:
+    if state['signum'] is not None:
+      break
+    if state['is_report_pending']:
+      state['is_report_pending'] = False
+      report_daemon_memory(pids)
+    while len(pids) < processes:
+      pid = os.fork()
+      if not pid:
+        exit_code = 1
+        try:
+          try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+              signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            if state['signum'] is None:
+              serve_daemon_worker(sock, get_file_info_func, has_lstat,
+                                  workers, max_in_flight, max_connections,
+                                  max_requests)
+            exit_code = 0
+          except:
+            sys.excepthook(*sys.exc_info())
+        finally:
+          os._exit(exit_code)
+      pids[pid] = time.time()
+    try:
+      pid, status = os.wait()
     except OSError, e:
-      stat_obj = None
-    if stat_obj is None:
-      response = 'format=? error=missing_file f=%s\n' % filename
-    elif stat.S_ISDIR(stat_obj.st_mode):
-      response = 'format=? error=is_dir f=%s\n' % filename
-    elif stat.S_ISREG(stat_obj.st_mode):
-      # This returns 'format=? ... error=...' upon an error.
-      info, had_error = get_file_info_func(filename, stat_obj)
-      response = format_info(info)
-    elif has_lstat and stat.S_ISLNK(stat_obj.st_mode):
-      info, had_error = get_symlink_info(filename, stat_obj)
-      response = format_info(info)
-    else:  # Not a file or directory.
-      response = 'format=? error=bad_node f=%s\n' % filename
-    outf.write(response)
-    outf.flush()
+      if e.args[0] != errno.EINTR:
+        raise
+      continue
+    started_at = pids.pop(pid, None)
+    if started_at is not None and status:
+      print >>sys.stderr, 'error: daemon worker %d failed with status 0x%x' % (
+          pid, status)
+      if time.time() - started_at < 1:
+        time.sleep(1)  # Avoid a busy loop of failing forks.
+  for pid in pids:
+    try:
+      os.kill(pid, signal.SIGHUP)  # Finish current connection, then exit.
+    except OSError:
+      pass
+  if state['signum'] == signal.SIGHUP:
+    print >>sys.stderr, 'info: daemon reloading'
+    # The old workers remain our children, os.wait() will reap them.
+    os.environ['MEDIAFILEINFO_DAEMON_FD'] = str(sock.fileno())
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+  while pids:
+    try:
+      pids.pop(os.wait()[0], None)
+    except OSError, e:
+      if e.args[0] != errno.EINTR:
+        raise
+  sock.close()
+  os.remove(socket_path)
+  print >>sys.stderr, 'info: daemon stopped'
 
 
 # ---
@@ -278,21 +742,70 @@ def main(argv):
         'This is free software, GNU GPL >=2.0. '
         'There is NO WARRANTY. Use at your risk.\n'
         'Usage: %s [<flag> ...] <filename> [...]\n'
-        '    or %s --pipe [--quick]\n'
-        % (argv[0], argv[0]))
+        '    or %s --pipe [--quick] [--workers=<n>] [--max-in-flight=<n>]\n'
+        '    or %s --daemon=<socket> [--processes=<n>] [--backlog=<n>] '
+        '[--max-connections=<n>] [--max-requests=<n>] [<pipe-flag> ...]\n'
+        '--max-connections=<n> restarts each daemon worker after <n> '
+        'connections (default: 100, 0: never),\n'
+        '--max-requests=<n> after <n> requests (default: 100000, 0: never; '
+        'then the client\n'
+        'has to reconnect and resend the unanswered requests), freeing its '
+        'garbage: full\n'
+        'garbage collections are disabled in the workers to keep their '
+        'memory shared with\n'
+        'the daemon.\n'
+        % (argv[0], argv[0], argv[0]))
     sys.exit(1)
   has_lstat = callable(getattr(os, 'lstat', None))
-  if argv[1] == '--pipe':
+  if argv[1] == '--pipe' or argv[1].startswith('--daemon='):
     mode = 'info'
-    if len(argv) > 2 and argv[2] == '--quick':
-      mode = 'quick'
+    workers, max_in_flight = 4, 64  # Only used by protocol v2.
+    # Only for --daemon=.
+    processes, backlog, max_connections, max_requests = 4, 128, 100, 100000
+    for arg in argv[2:]:
+      if arg in ('--quick', '--mode=quick'):
+        mode = 'quick'
+      elif arg in ('--info', '--mode=info'):
+        mode = 'info'
+      elif arg.startswith('--workers='):
+        workers = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--max-in-flight='):
+        max_in_flight = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--processes='):
+        processes = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--backlog='):
+        backlog = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--max-connections='):
+        max_connections = int(arg[arg.find('=') + 1:])
+      elif arg.startswith('--max-requests='):
+        max_requests = int(arg[arg.find('=') + 1:])
+      else:
+        sys.exit('Unknown --pipe flag: %s' % arg)
     get_file_info_func = (get_file_info, get_quick_info)[mode == 'quick']
-    inf, outf = sys.stdin, sys.stdout
+    if argv[1].startswith('--daemon='):
+      try:
+        run_daemon(argv[1][argv[1].find('=') + 1:], get_file_info_func,
+                   has_lstat, max(processes, 1), workers, max_in_flight,
+                   backlog, max_connections, max_requests)
+      except RuntimeError, e:
+        sys.exit(str(e))
+      return
+    inf = mediafileinfo_lines.RecordReader(sys.stdin.fileno())
     set_fd_binary(inf.fileno())
-    set_fd_binary(outf.fileno())
-    run_pipe(inf, outf, get_file_info_func, has_lstat)
+    set_fd_binary(sys.stdout.fileno())
+    # Flushed explicitly by run_pipe after each response.
+    outf = mediafileinfo_lines.LineWriter(sys.stdout.fileno(), flush_sec=None)
+    try:
+      run_pipe(inf, outf, get_file_info_func, has_lstat,
+               workers, max_in_flight)
+    finally:
+      outf.close()
     return
   mode = 'info'
+  # Output buffering: flush after this many bytes or this many seconds.
+  flush_size, flush_sec = 65536, 0.2
+  shard = None  # (shard_index, shard_count) from --shard=i/N.
+  shard_depth = 1
   i = 1
   while i < len(argv):
     arg = argv[i]
@@ -308,6 +821,17 @@ def main(argv):
       mode = 'quick'
     elif arg.startswith('--mode='):
       sys.exit('Invalid flag value: %s' % arg)
+    elif arg.startswith('--flush-size='):
+      flush_size = int(arg[arg.find('=') + 1:])
+    elif arg.startswith('--flush-sec='):
+      flush_sec = float(arg[arg.find('=') + 1:])
+    elif arg.startswith('--shard='):
+      try:
+        shard = parse_shard_flag(arg[arg.find('=') + 1:])
+      except ValueError, e:
+        sys.exit(str(e))
+    elif arg.startswith('--shard-depth='):
+      shard_depth = int(arg[arg.find('=') + 1:])
     elif arg == '--list-formats':
       sys.stdout.write('%s\n' % ' '.join(sorted(
           mediafileinfo_detect.FORMAT_DB.formats)))
@@ -315,16 +839,23 @@ def main(argv):
     else:
       sys.exit('Unknown flag: %s' % arg)
 
-  outf = sys.stdout
-  set_fd_binary(outf.fileno())
+  if shard:
+    shard += (shard_depth,)
+  sys.stdout.flush()
+  set_fd_binary(sys.stdout.fileno())
+  outf = mediafileinfo_lines.LineWriter(
+      sys.stdout.fileno(), flush_size, flush_sec)
   prefix = '.' + os.sep
   had_error = False
   get_file_info_func = (get_file_info, get_quick_info)[mode == 'quick']
-  # Keep the original argv order, don't sort.
-  for filename in argv[i:]:
-    if filename.startswith(prefix):
-      filename = filename[len(prefix):]
-    had_error |= process(filename, outf, get_file_info_func, has_lstat)
+  try:
+    # Keep the original argv order, don't sort.
+    for filename in argv[i:]:
+      if filename.startswith(prefix):
+        filename = filename[len(prefix):]
+      had_error |= process(filename, outf, get_file_info_func, has_lstat, shard)
+  finally:
+    outf.close()
   if had_error:
     sys.exit(2)
 
@@ -0,0 +1,237 @@
+#! /bin/sh
+
+""":" # mediafileinfo_main_test.py: Unit tests for mediafileinfo_main.py.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: mediafileinfo_main_test.py
+"""
+
+import cStringIO
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import mediafileinfo_lines
+import mediafileinfo_main
+
+
+def fake_get_file_info(filename, stat_obj):
+  return {'format': 'fake', 'size': stat_obj.st_size, 'f': filename}, False
+
+
+class RunPipeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='mediafileinfo_main_test.')
+    self.filename = os.path.join(self.tmp_dir, 'a b')
+    f = open(self.filename, 'wb')
+    try:
+      f.write('hello')
+    finally:
+      f.close()
+    self.missing = os.path.join(self.tmp_dir, 'missing')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def run_pipe(self, data, **kwargs):
+    rfd, wfd = os.pipe()
+    try:
+      os.write(wfd, data)  # Small enough for the pipe buffer.
+      os.close(wfd)
+      wfd = None
+      outf = cStringIO.StringIO()
+      mediafileinfo_main.run_pipe(
+          mediafileinfo_lines.RecordReader(rfd), outf, fake_get_file_info,
+          True, **kwargs)
+      return outf.getvalue()
+    finally:
+      os.close(rfd)
+      if wfd is not None:
+        os.close(wfd)
+
+  def get_found(self, terminator='\n'):
+    return 'format=fake size=5 f=%s%s' % (self.filename, terminator)
+
+  def get_missing(self, terminator='\n'):
+    return 'format=? error=missing_file f=%s%s' % (self.missing, terminator)
+
+  def test_plain(self):
+    self.assertEqual(
+        self.run_pipe('%s\n%s\r\n' % (self.filename, self.missing)),
+        self.get_found() + self.get_missing())
+    self.assertEqual(
+        self.run_pipe('%s\n!batch\n' % self.filename),
+        self.get_found() + 'format=? error=missing_file f=!batch\n')
+    self.assertEqual(
+        self.run_pipe('%s\n%s' % (self.filename, self.missing)),
+        self.get_found() + 'format=? error=incomplete_line\n')
+
+  def test_not_handshake(self):
+    self.assertEqual(
+        self.run_pipe('!v1x\n%s\n' % self.filename),
+        'format=? error=missing_file f=!v1x\n' + self.get_found())
+    self.assertEqual(
+        self.run_pipe('!v2x y\n%s\n' % self.filename),
+        'format=? error=missing_file f=!v2x y\n' + self.get_found())
+
+  def test_v1(self):
+    self.assertEqual(
+        self.run_pipe('!v1\n%s\n!batch\n%s\n%s\n\n%s\n' % (
+            self.filename, self.missing, self.filename, self.missing)),
+        '!v1 framing=line\n' + self.get_found() + self.get_missing() +
+        self.get_found() + '!end\n' + self.get_missing())
+    self.assertEqual(
+        self.run_pipe('!v1\n!batch\n%s\n' % self.filename),
+        '!v1 framing=line\nformat=? error=incomplete_batch\n')
+
+  def test_v1_nul(self):
+    self.assertEqual(
+        self.run_pipe('!v1 framing=nul\n%s\0!batch\0%s\0\0' % (
+            self.filename, self.missing)),
+        '!v1 framing=nul\n' + self.get_found('\0') + self.get_missing('\0') +
+        '!end\0')
+    self.assertEqual(
+        self.run_pipe('!v1 framing=nul\n%s\n' % self.filename),
+        '!v1 framing=nul\nformat=? error=incomplete_line\0')
+
+  def test_v2(self):
+    output = self.run_pipe(
+        '!v2 max_in_flight=8\n1 %s\n2 %s\nbad\n3 !batch\n%s\n%s\n\n' % (
+            self.filename, self.missing, self.missing, self.filename),
+        workers=2)
+    self.assertEqual(output.split('\n', 1)[0],
+                     '!v2 framing=line max_in_flight=8 workers=2')
+    records = output.split('\n')[1 : -1]
+    batch_start = records.index('3 ' + self.get_missing()[:-1])
+    self.assertEqual(records[batch_start : batch_start + 3], [
+        '3 ' + self.get_missing()[:-1], '3 ' + self.get_found()[:-1],
+        '3 !end'])
+    del records[batch_start : batch_start + 3]
+    self.assertEqual(sorted(records), [
+        '- format=? error=bad_request', '1 ' + self.get_found()[:-1],
+        '2 ' + self.get_missing()[:-1]])
+
+  def test_v2_nul(self):
+    output = self.run_pipe('!v2 framing=nul\n1 %s\0002 !batch\0%s\0' % (
+        self.filename, self.filename), workers=1)
+    header, output = output.split('\n', 1)
+    self.assertEqual(header, '!v2 framing=nul max_in_flight=64 workers=1')
+    self.assertEqual(sorted(output.split('\0')), [
+        '', '1 ' + self.get_found(''), '2 format=? error=incomplete_batch'])
+
+
+
+def get_child_pids(pid):
+  """Returns the sorted list of the child pids of a process (Linux only)."""
+  child_pids = []
+  for name in os.listdir('/proc'):
+    if name.isdigit():
+      try:
+        f = open('/proc/%s/stat' % name)
+        try:
+          data = f.read()
+        finally:
+          f.close()
+      except IOError:  # The process has exited.
+        continue
+      if int(data[data.rfind(')') + 1:].split()[1]) == pid:
+        child_pids.append(int(name))
+  child_pids.sort()
+  return child_pids
+
+
+def wait_until(func, timeout=10):
+  deadline = time.time() + timeout
+  while 1:
+    result = func()
+    if result or time.time() >= deadline:
+      return result
+    time.sleep(0.01)
+
+
+class DaemonTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='mediafileinfo_main_test.')
+    self.socket_path = os.path.join(self.tmp_dir, 'sock')
+    self.filename = os.path.join(self.tmp_dir, 'a b')
+    f = open(self.filename, 'wb')
+    try:
+      f.write('hello')
+    finally:
+      f.close()
+    os.utime(self.filename, (5, 5))
+    stderr = open(os.path.join(self.tmp_dir, 'stderr'), 'wb')
+    try:
+      self.p = subprocess.Popen(
+          (sys.executable, os.path.join(
+              os.path.dirname(os.path.abspath(__file__)),
+              'mediafileinfo_main.py'),
+           '--daemon=' + self.socket_path, '--quick', '--processes=1',
+           '--max-connections=0', '--max-requests=3'),
+          stderr=stderr)
+    finally:
+      stderr.close()
+
+  def tearDown(self):
+    if self.p.returncode is None:
+      os.kill(self.p.pid, signal.SIGTERM)
+      self.p.wait()
+    shutil.rmtree(self.tmp_dir)
+
+  def query(self, data):
+    """Sends data in a new connection, returns all data received."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.socket_path)
+      sock.sendall(data)
+      sock.shutdown(socket.SHUT_WR)
+      output = []
+      while 1:
+        data = sock.recv(65536)
+        if not data:
+          break
+        output.append(data)
+      return ''.join(output)
+    finally:
+      sock.close()
+
+  def test_max_requests(self):
+    if not os.path.isfile('/proc/self/stat'):
+      return
+    get_worker_pids = lambda: get_child_pids(self.p.pid)
+    self.assertTrue(wait_until(lambda: os.path.exists(self.socket_path)))
+    worker_pids = wait_until(get_worker_pids)
+    self.assertEqual(len(worker_pids), 1)
+    response = 'format=? mtime=5 size=5 f=%s\n' % self.filename
+    self.assertEqual(self.query('%s\n' % self.filename), response)
+    self.assertEqual(get_worker_pids(), worker_pids)
+    # The limit is reached in the middle of this connection.
+    self.assertEqual(self.query('!v1\n!batch\n%s\n\n%s\n%s\n' % (
+        self.filename, self.filename, self.filename)),
+        '!v1 framing=line\n%s!end\n%s' % (response, response))
+    new_worker_pids = wait_until(
+        lambda: [pid for pid in get_worker_pids() if pid not in worker_pids])
+    self.assertEqual(len(new_worker_pids), 1)
+    self.assertTrue(wait_until(lambda: get_worker_pids() == new_worker_pids))
+    output = self.query('!v2\n1 %s\n2 %s\n3 %s\n4 %s\n' % (
+        (self.filename,) * 4))
+    self.assertEqual(output.split('\n', 1)[0],
+                     '!v2 framing=line max_in_flight=64 workers=4')
+    self.assertEqual(sorted(output.split('\n')[1 : -1]),
+                     ['%d %s' % (i, response[:-1]) for i in (1, 2, 3)])
+
+if __name__ == '__main__':
+  unittest.main(argv=[sys.argv[0], '-v'] + sys.argv[1:])
@@ -6,40 +6,30 @@
 # Input: mediainfo lines (cat mscan*.out) on stdin
 # Output: mediainfo lines on stdout (as many duplicates as possible by filename merged), merge errors on stderr
 #
+# Usage for merging the outputs of sharded scans (media_scan.py --shard=i/N)
+# in a streaming way, keeping the scan order of filenames:
+#
+#   merge_mediainfo_lines.py --shards shard0.mfo shard1.mfo ... >all.mfo
+#
+# Usage for inputs larger than the memory (external merge sort using
+# temporary files, the output is the same as without flags):
+#
+#   cat mscan*.out | merge_mediainfo_lines.py --max-memory=1000000000
+#       [--tmp-dir=/var/tmp] >all.mfo
+#
 
-import re
+import heapq
+import operator
+import os
 import sys
+import tempfile
+
+import mediafileinfo_lines
 
 
 def format_info(info):
-  def format_value(v):
-    if isinstance(v, bool):
-      return int(v)
-    if isinstance(v, float):
-      if abs(v) < 1e15 and int(v) == v:  # Remove the trailing '.0'.
-        return int(v)
-      return repr(v)
-    if isinstance(v, (int, long)):
-      return str(v)
-    if isinstance(v, str):
-      if ' ' in v or '\n' in v:
-        raise ValueError('Bad info string value: %r' % v)
-      return v
-    raise TypeError(type(v))
-  output = ['format=%s' % format_value(info.get('format') or '?')]
-  # TODO(pts): Display brands list.
-  output.extend(
-      ' %s=%s' % (k, format_value(v))
-      for k, v in sorted(info.iteritems())
-      if k != 'f' and k != 'format' and
-      not isinstance(v, (tuple, list, dict, set)))
-  filename = info.get('f')
-  if filename is not None:
-    if '\n' in filename or '\0' in filename:
-      raise ValueError('Invalid byte in filename: %r' % filename)
-    output.append(' f=%s' % filename)  # Emit ` f=' last.
-  output.append('\n')
-  return ''.join(output)
+  """Formats info parsed with do_decode=False as a mediainfo line."""
+  return mediafileinfo_lines.format_info(info, do_encode=False)
 
 
 def merge_infos(infos):
@@ -78,41 +68,226 @@ def merge_by_key(infos, key):
   return infos3
 
 
-def main(argv):
-  f, of = sys.stdin, sys.stdout
-  infos_by_fn = {}
+def write_merged_infos(fn, infos, of):
+  """Merges infos (all with filename fn) and writes them to of."""
+  info2, mismatches = merge_infos(infos)
+  if not mismatches:
+    of.write(format_info(info2))
+    return
+  if 'size' in mismatches:
+    print >>sys.stderr, 'warning: found size mismatches: fn=%r' % fn
+    infos = merge_by_key(infos, 'size')
+  elif 'sha256' in mismatches:
+    print >>sys.stderr, 'warning: found sha256 mismatches: fn=%r' % fn
+    infos = merge_by_key(infos, 'sha256')
+  else:
+    print >>sys.stderr, 'warning: found mismatches: fn=%r info=%r mismatches=%r' % (fn, info2, mismatches)
+  for info2 in infos:
+    of.write(format_info(info2))
+
+
+def get_scan_order_key(fn):
+  """Returns a sort key of fn for the order of media_scan.py output.
+
+  media_scan.py and `mediafileinfo.py <dir>' emit the files of a directory
+  (sorted) first, and then the contents of the subdirectories (sorted),
+  recursively. Within a directory, this order is the same as sorting
+  by a list of (is_dir, component) pairs, which this key emulates as a
+  string. (It works because components don't contain '\\0'.)
+  """
+  i = fn.rfind('/') + 1
+  if i:
+    return '\1%s\0\0%s' % (fn[:i - 1].replace('/', '\0\1'), fn[i:])
+  return '\0' + fn
+
+
+def iter_sorted_infos(f, input_idx):
+  """Yields (key, input_idx, info) tuples from f, checks the order."""
+  prev_key = None
   for line in f:
-    line = line.rstrip('\n')  # Don't remove '\r', it's binary.
-    i = line.find(' f=')
-    if i < 0:
-      raise ValueError('f= not found: %d' % line_source.tell())
-    fn = line[line.find('=', i) + 1:]
-    info = {'f': fn}
-    for item in line[:i].split(' '):
-      kv = item.split('=', 1)
-      if len(kv) != 2:
-        raise ValueError('Expected key=value, got: %s in line %r' % (kv, line))
-      if kv[0] in info:
-        raise ValueError('Duplicate key %r in info line %r' % (kv[0], line))
-      info[kv[0]] = kv[1]
+    info = mediafileinfo_lines.parse_info_line(line, do_decode=False)
+    key = get_scan_order_key(info['f'])
+    if prev_key is not None and key < prev_key:
+      raise ValueError('Input not in scan order: %r before %r in %r' % (
+          prev_key, info['f'], getattr(f, 'name', input_idx)))
+    prev_key = key
+    yield key, input_idx, info
+
+
+def merge_shards(filenames, of):
+  """Merges sorted mediainfo files in a streaming way (k-way merge)."""
+  files = []
+  try:
+    for filename in filenames:
+      files.append(open(filename, 'rb'))
+    prev_key, infos = None, []
+    for key, _, info in heapq.merge(*[
+        iter_sorted_infos(f, i) for i, f in enumerate(files)]):
+      if key != prev_key and infos:
+        write_merged_infos(infos[0]['f'], infos, of)
+        infos = []
+      prev_key = key
+      infos.append(info)
+    if infos:
+      write_merged_infos(infos[0]['f'], infos, of)
+  finally:
+    for f in files:
+      f.close()
+
+
+def get_line_filename(line):
+  """Returns the filename (f=) of a mediainfo line, like parse_info_line."""
+  i = line.find(' f=')
+  if i < 0:
+    raise ValueError('f= not found in line: %r' % line)
+  if line.endswith('\n'):
+    return line[i + 3 : -1]
+  return line[i + 3:]
+
+
+def write_sorted_run(items, tmp_dir):
+  """Sorts (filename, line) pairs stably, writes the lines to a temporary
+  file, and returns its name."""
+  items.sort(key=operator.itemgetter(0))  # Stable: keeps the input order.
+  fd, filename = tempfile.mkstemp(prefix='merge_mediainfo_lines.',
+                                  suffix='.run', dir=tmp_dir)
+  f = os.fdopen(fd, 'wb')
+  try:
+    f.writelines([line for _, line in items])
+  finally:
+    f.close()
+  return filename
+
+
+def iter_run(f, run_idx):
+  """Yields (filename, run_idx, line) tuples of a sorted run file."""
+  for line in f:
+    yield get_line_filename(line), run_idx, line
+
+
+def iter_merged_runs(run_filenames, files, last_items=()):
+  """Yields (filename, run_idx, line) tuples of runs in filename order.
+
+  Lines with the same filename are yielded in run order (and within a run,
+  in the order of the run). last_items is the last run, in memory.
+  """
+  iters = []
+  for run_idx, run_filename in enumerate(run_filenames):
+    files.append(open(run_filename, 'rb'))
+    iters.append(iter_run(files[-1], run_idx))
+  run_idx = len(run_filenames)
+  iters.append((fn, run_idx, line) for fn, line in last_items)
+  return heapq.merge(*iters)
+
+
+def merge_runs(run_filenames, tmp_dir):
+  """Merges sorted runs to a single sorted run, and returns its name."""
+  fd, filename = tempfile.mkstemp(prefix='merge_mediainfo_lines.',
+                                  suffix='.run', dir=tmp_dir)
+  files, is_ok = [], False
+  try:
+    of = os.fdopen(fd, 'wb')
+    try:
+      for _, _, line in iter_merged_runs(run_filenames, files):
+        of.write(line)
+    finally:
+      of.close()
+    is_ok = True
+  finally:
+    for f in files:
+      f.close()
+    if not is_ok:
+      os.remove(filename)
+  for run_filename in run_filenames:
+    os.remove(run_filename)
+  return filename
+
+
+def iter_sorted_lines(line_source, max_memory, tmp_dir=None, max_runs=64):
+  """Yields (filename, line) pairs of line_source, stably sorted by filename.
+
+  It uses about max_memory bytes of memory for the lines: it sorts them in
+  runs of at most max_memory bytes, writes the runs to temporary files in
+  tmp_dir, and then merges the runs in a streaming way. If there are more
+  than max_runs runs, consecutive runs are merged to larger runs first.
+  """
+  run_filenames, files, items, size = [], [], [], 0
+  try:
+    for line in line_source:
+      if not line.endswith('\n'):
+        line += '\n'
+      fn = get_line_filename(line)
+      items.append((fn, line))
+      # Estimated memory use of the item (str, tuple and sort overhead).
+      size += len(line) + len(fn) + 200
+      if size >= max_memory:
+        run_filenames.append(write_sorted_run(items, tmp_dir))
+        items, size = [], 0
+    items.sort(key=operator.itemgetter(0))
+    while len(run_filenames) > max_runs:
+      i = 0
+      while i < len(run_filenames):
+        run_filenames[i : i + max_runs] = [
+            merge_runs(run_filenames[i : i + max_runs], tmp_dir)]
+        i += 1
+    for fn, _, line in iter_merged_runs(run_filenames, files, items):
+      yield fn, line
+  finally:
+    for f in files:
+      f.close()
+    for run_filename in run_filenames:
+      try:
+        os.remove(run_filename)
+      except OSError:
+        pass
+
+
+def merge_in_memory(line_source, of):
+  """Merges mediainfo lines by filename, keeping all lines in memory."""
+  infos_by_fn = {}
+  for line in line_source:
+    info = mediafileinfo_lines.parse_info_line(line, do_decode=False)
+    fn = info['f']
     if fn not in infos_by_fn:
       infos_by_fn[fn] = []
     infos_by_fn[fn].append(info)
   for fn, infos in sorted(infos_by_fn.iteritems()):
-    info2, mismatches = merge_infos(infos)
-    if not mismatches:
-      of.write(format_info(info2))
-      continue
-    if 'size' in mismatches:
-      print >>sys.stderr, 'warning: found size mismatches: fn=%r' % fn
-      infos = merge_by_key(infos, 'size')
-    elif 'sha256' in mismatches:
-      print >>sys.stderr, 'warning: found sha256 mismatches: fn=%r' % fn
-      infos = merge_by_key(infos, 'sha256')
+    write_merged_infos(fn, infos, of)
+
+
+def merge_external(line_source, of, max_memory, tmp_dir=None, max_runs=64):
+  """Merges mediainfo lines by filename, like merge_in_memory, using about
+  max_memory bytes of memory for the lines (see iter_sorted_lines)."""
+  prev_fn, infos = None, []
+  for fn, line in iter_sorted_lines(line_source, max_memory, tmp_dir,
+                                    max_runs):
+    if fn != prev_fn and infos:
+      write_merged_infos(prev_fn, infos, of)
+      infos = []
+    prev_fn = fn
+    infos.append(mediafileinfo_lines.parse_info_line(line, do_decode=False))
+  if infos:
+    write_merged_infos(prev_fn, infos, of)
+
+
+def main(argv):
+  f, of = sys.stdin, sys.stdout
+  if len(argv) > 1 and argv[1] == '--shards':
+    merge_shards(argv[2:], of)
+    return
+  max_memory, tmp_dir = None, None
+  for arg in argv[1:]:
+    value = arg[arg.find('=') + 1:]
+    if arg.startswith('--max-memory='):
+      max_memory = int(value)
+    elif arg.startswith('--tmp-dir='):
+      tmp_dir = value
     else:
-      print >>sys.stderr, 'warning: found mismatches: fn=%r info=%r mismatches=%r' % (fn, info2, mismatches)
-    for info2 in infos:
-      of.write(format_info(info2))
+      sys.exit('Unknown flag: %s' % arg)
+  if max_memory is not None:
+    merge_external(f, of, max_memory, tmp_dir)
+  else:
+    merge_in_memory(f, of)
 
 if __name__ == '__main__':
   sys.exit(main(sys.argv))
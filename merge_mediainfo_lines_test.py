@@ -0,0 +1,73 @@
+#! /bin/sh
+
+""":" # merge_mediainfo_lines_test.py: Unit tests for merge_mediainfo_lines.py.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: merge_mediainfo_lines_test.py
+"""
+
+import cStringIO
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import merge_mediainfo_lines
+
+
+def get_lines():
+  """Returns mediainfo lines with duplicate filenames, in random order."""
+  rnd, lines = random.Random(42), []
+  for i in xrange(60):
+    fn = ('d%d/f %d.jpg' % (i % 7, i), 'f%d' % i)[i % 5 == 0]
+    size = rnd.randrange(1000)
+    for j in xrange(1 + i % 4):
+      # Same size, other mtime (merged to the earliest), or extra keys.
+      lines.append('format=jpeg mtime=%d size=%d%s f=%s\n' % (
+          1000 + (i * j) % 3, size, ('', ' width=5')[j == 2], fn))
+  rnd.shuffle(lines)
+  return lines
+
+
+class MergeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='merge_mediainfo_lines_test.')
+    self.lines = get_lines()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_iter_sorted_lines(self):
+    get_line_filename = merge_mediainfo_lines.get_line_filename
+    expected = [(get_line_filename(line), line) for line in
+                sorted(self.lines, key=get_line_filename)]  # Stable.
+    for max_memory, max_runs in ((1 << 30, 64), (1, 64), (1000, 2), (1, 2)):
+      self.assertEqual(list(merge_mediainfo_lines.iter_sorted_lines(
+          iter(self.lines), max_memory, self.tmp_dir, max_runs)), expected)
+      self.assertEqual(os.listdir(self.tmp_dir), [])
+
+  def test_merge_external(self):
+    of = cStringIO.StringIO()
+    merge_mediainfo_lines.merge_in_memory(iter(self.lines), of)
+    expected = of.getvalue()
+    self.assertEqual(len(expected.split('\n')), 61)
+    self.assertTrue(
+        'format=jpeg mtime=1000 size=' in expected.split('\n')[0])
+    for max_memory, max_runs in ((1 << 30, 64), (1, 64), (1000, 2), (1, 2)):
+      of = cStringIO.StringIO()
+      merge_mediainfo_lines.merge_external(
+          iter(self.lines), of, max_memory, self.tmp_dir, max_runs)
+      self.assertEqual(of.getvalue(), expected)
+      self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+if __name__ == '__main__':
+  unittest.main(argv=[sys.argv[0], '-v'] + sys.argv[1:])
@@ -0,0 +1,271 @@
+#! /usr/bin/python
+#
+# xfidfp_index.py: find similar images by their xfidfp= fingerprints
+#
+# Input: mediainfo lines (media_scan.py --fp=true output, .mfo files)
+# Output: pairs or neighbors of similar images, tab-separated:
+#         <distance> <filename> [<filename2>]
+#
+# Two images are similar (according to findimagedupes) iff their xfidfp=
+# fingerprints (256 bits) differ in at most 25 bits. Instead of comparing
+# all pairs (O(n**2)), this tool builds a multi-index hashing index (see
+# https://www.cs.toronto.edu/~norouzi/research/papers/multi_index_hashing.pdf):
+# the fingerprint is split to chunk_count chunks of about 20 bits each, and
+# there is a hash table (bucket array) for each chunk. By the pigeonhole
+# principle, if two fingerprints differ in at most d bits, then there is a
+# chunk in which they differ in at most d // chunk_count bits, so only the
+# fingerprints in nearby buckets have to be compared.
+#
+# Usage:
+#
+#   xfidfp_index.py build --index=fp.xfi mscan1.mfo mscan2.mfo ...
+#   xfidfp_index.py pairs --index=fp.xfi [--max-distance=25] >pairs.tsv
+#   xfidfp_index.py neighbors --index=fp.xfi [--max-distance=25] <f> ...
+#
+# For neighbors, <f> is a filename in the index (as in f=) or a fingerprint
+# (44 bytes base64, ending with '=').
+#
+
+import array
+import base64
+import binascii
+import marshal
+import sys
+
+import mediafileinfo_lines
+
+
+def parse_fingerprint(fp):
+  """Returns the fingerprint as a 256-bit long, or None if invalid."""
+  if len(fp) != 44 or fp[-1] != '=':
+    return None
+  try:
+    return long(binascii.hexlify(base64.b64decode(fp)), 16)
+  except (TypeError, ValueError):
+    return None
+
+
+def read_fingerprints(filenames):
+  """Returns a dict mapping filenames to fingerprints in .mfo files.
+
+  Later lines for the same filename override earlier ones, format=deleted
+  removes the file, like --old= of media_scan.py.
+  """
+  fps = {}
+  for filename in filenames:
+    f = open(filename, 'rb')
+    try:
+      for info in mediafileinfo_lines.iter_info_lines(
+          f, ('format', 'xfidfp'), do_decode=False):
+        fn, fp = info['f'], None
+        if 'xfidfp' in info and info['format'] != 'deleted':
+          fp = parse_fingerprint(info['xfidfp'])
+        if fp is None:
+          fps.pop(fn, None)
+        else:
+          fps[fn] = fp
+    finally:
+      f.close()
+  return fps
+
+
+# Chunks are at most this long, because the bucket array of a chunk has
+# 2 ** bit_count + 1 entries (64 MiB for 24 bits).
+MAX_CHUNK_BIT_COUNT = 24
+
+# Minimum chunk_count for MAX_CHUNK_BIT_COUNT.
+MIN_CHUNK_COUNT = -(-256 // MAX_CHUNK_BIT_COUNT)
+
+
+def get_chunks(chunk_count):
+  """Returns a list of (shift, bit_count) pairs splitting 256 bits."""
+  chunks, shift = [], 0
+  for i in xrange(chunk_count):
+    bit_count = (256 - shift) // (chunk_count - i)
+    chunks.append((shift, bit_count))
+    shift += bit_count
+  return chunks
+
+
+def get_xor_masks(bit_count, radius, _cache={}):
+  """Returns all bit_count-bit masks with at most radius 1 bits."""
+  key = (bit_count, radius)
+  if key not in _cache:
+    masks = [0]
+    prev = [(0, 0)]  # (mask, next_bit) pairs with the same popcount.
+    for _ in xrange(radius):
+      prev = [(mask | 1 << k, k + 1) for mask, next_bit in prev
+              for k in xrange(next_bit, bit_count)]
+      masks.extend(mask for mask, _ in prev)
+    _cache[key] = masks
+  return _cache[key]
+
+
+class FingerprintIndex(object):
+  """Multi-index hashing index of xfidfp= fingerprints.
+
+  The bucket array of chunk j is in CSR format: the ids (indexes to
+  self.filenames and self.fps) of fingerprints whose chunk j has value v are
+  ids[j][offsets[j][v] : offsets[j][v + 1]].
+  """
+
+  __slots__ = ('filenames', 'fps', 'chunks', 'offsets', 'ids')
+
+  VERSION = 1
+
+  def __init__(self, filenames, fps, chunks, offsets, ids):
+    self.filenames, self.fps, self.chunks = filenames, fps, chunks
+    self.offsets, self.ids = offsets, ids
+
+  @classmethod
+  def build(cls, fps_by_filename, chunk_count=13):
+    filenames = sorted(fps_by_filename)
+    fps = [fps_by_filename[fn] for fn in filenames]
+    chunks = get_chunks(chunk_count)
+    offsets, ids = [], []
+    for shift, bit_count in chunks:
+      mask = (1 << bit_count) - 1
+      values = [int((fp >> shift) & mask) for fp in fps]
+      ids.append(array.array('I', sorted(xrange(len(fps)),
+                                         key=values.__getitem__)))
+      counts = array.array('I', [0]) * ((1 << bit_count) + 1)
+      for value in values:
+        counts[value + 1] += 1
+      total = 0
+      for i in xrange(len(counts)):
+        total += counts[i]
+        counts[i] = total
+      offsets.append(counts)
+    return cls(filenames, fps, chunks, offsets, ids)
+
+  def save(self, filename):
+    f = open(filename, 'wb')
+    try:
+      marshal.dump({
+          'version': self.VERSION, 'chunks': self.chunks,
+          'filenames': '\n'.join(self.filenames),
+          'fps': ''.join(binascii.unhexlify('%064x' % fp) for fp in self.fps),
+          'offsets': [a.tostring() for a in self.offsets],
+          'ids': [a.tostring() for a in self.ids]}, f)
+    finally:
+      f.close()
+
+  @classmethod
+  def load(cls, filename):
+    f = open(filename, 'rb')
+    try:
+      data = marshal.load(f)
+    finally:
+      f.close()
+    if not isinstance(data, dict) or data.get('version') != cls.VERSION:
+      raise ValueError('Bad xfidfp index file: %s' % filename)
+    filenames = data['filenames'] and data['filenames'].split('\n') or []
+    fps_data = data['fps']
+    fps = [long(binascii.hexlify(fps_data[i : i + 32]), 16)
+           for i in xrange(0, len(fps_data), 32)]
+    offsets, ids = [], []
+    for offsets_data, ids_data in zip(data['offsets'], data['ids']):
+      offsets.append(array.array('I', offsets_data))
+      ids.append(array.array('I', ids_data))
+    return cls(filenames, fps, data['chunks'], offsets, ids)
+
+  def get_candidates(self, fp, max_distance):
+    """Returns the set of ids which may be within max_distance of fp."""
+    radius = max_distance // len(self.chunks)
+    candidates = set()
+    for (shift, bit_count), offsets, ids in zip(
+        self.chunks, self.offsets, self.ids):
+      value = int((fp >> shift) & ((1 << bit_count) - 1))
+      for xor_mask in get_xor_masks(bit_count, radius):
+        i = value ^ xor_mask
+        start, end = offsets[i], offsets[i + 1]
+        if start != end:
+          candidates.update(ids[start : end])
+    return candidates
+
+  def find_neighbors(self, fp, max_distance=25):
+    """Returns a sorted list of (distance, id) pairs within max_distance."""
+    fps, result = self.fps, []
+    for i in self.get_candidates(fp, max_distance):
+      distance = bin(fp ^ fps[i]).count('1')
+      if distance <= max_distance:
+        result.append((distance, i))
+    result.sort()
+    return result
+
+  def iter_pairs(self, max_distance=25):
+    """Yields (distance, id1, id2) for all pairs within max_distance."""
+    fps = self.fps
+    for i in xrange(len(fps)):
+      fp = fps[i]
+      result = []
+      for j in self.get_candidates(fp, max_distance):
+        if j > i:
+          distance = bin(fp ^ fps[j]).count('1')
+          if distance <= max_distance:
+            result.append((j, distance))
+      result.sort()
+      for j, distance in result:
+        yield distance, i, j
+
+
+def main(argv):
+  if len(argv) < 2 or argv[1] not in ('build', 'pairs', 'neighbors'):
+    sys.stderr.write(
+        'Usage: %s {build|pairs|neighbors} --index=<file> [<flag> ...] '
+        '[<arg> ...]\n' % argv[0])
+    sys.exit(1)
+  command, index_filename, max_distance, chunk_count = argv[1], None, 25, 13
+  i = 2
+  while i < len(argv):
+    arg = argv[i]
+    i += 1
+    if arg == '--':
+      break
+    if arg == '-' or not arg.startswith('-'):
+      i -= 1
+      break
+    if arg.startswith('--index='):
+      index_filename = arg[arg.find('=') + 1:]
+    elif arg.startswith('--max-distance='):
+      max_distance = int(arg[arg.find('=') + 1:])
+    elif arg.startswith('--chunks='):
+      chunk_count = int(arg[arg.find('=') + 1:])
+      if not MIN_CHUNK_COUNT <= chunk_count <= 256:
+        sys.exit('Bad --chunks=, must be between %d and 256: %s' %
+                 (MIN_CHUNK_COUNT, arg))
+    else:
+      sys.exit('Unknown flag: %s' % arg)
+  if not index_filename:
+    sys.exit('Missing --index=')
+  of = sys.stdout
+  if command == 'build':
+    index = FingerprintIndex.build(read_fingerprints(argv[i:]), chunk_count)
+    index.save(index_filename)
+    print >>sys.stderr, 'info: indexed %d fingerprints' % len(index.fps)
+    return
+  index = FingerprintIndex.load(index_filename)
+  filenames = index.filenames
+  if command == 'pairs':
+    for distance, id1, id2 in index.iter_pairs(max_distance):
+      of.write('%d\t%s\t%s\n' % (distance, filenames[id1], filenames[id2]))
+  else:
+    ids_by_filename = dict((fn, i) for i, fn in enumerate(filenames))
+    had_error = False
+    for arg in argv[i:]:
+      fp = parse_fingerprint(arg)
+      if fp is None:
+        if arg not in ids_by_filename:
+          print >>sys.stderr, 'error: not in index: %r' % arg
+          had_error = True
+          continue
+        fp = index.fps[ids_by_filename[arg]]
+      for distance, id2 in index.find_neighbors(fp, max_distance):
+        if filenames[id2] != arg:
+          of.write('%d\t%s\t%s\n' % (distance, arg, filenames[id2]))
+    if had_error:
+      sys.exit(2)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,101 @@
+#! /bin/sh
+
+""":" # xfidfp_index_test.py: Unit tests for xfidfp_index.py.
+
+type python2.7 >/dev/null 2>&1 && exec python2.7 -- "$0" ${1+"$@"}
+type python2.6 >/dev/null 2>&1 && exec python2.6 -- "$0" ${1+"$@"}
+exec python -- ${1+"$@"}; exit 1
+
+This script need Python 2.6 or 2.7. Python 3.x won't work.
+
+Typical usage: xfidfp_index_test.py
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+import xfidfp_index
+
+
+def get_distance(fp1, fp2):
+  return bin(fp1 ^ fp2).count('1')
+
+
+class FingerprintIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    rnd = random.Random(42)
+    self.fps_by_filename = {}
+    for i in xrange(40):  # Clusters of similar fingerprints.
+      fp = rnd.getrandbits(256)
+      for j in xrange(5):
+        fp2 = fp
+        for bit in rnd.sample(xrange(256), rnd.randrange(40)):
+          fp2 ^= 1 << bit
+        self.fps_by_filename['f%d/%d.jpg' % (i, j)] = fp2
+    self.fps_by_filename['dup.jpg'] = fp2
+    self.index = xfidfp_index.FingerprintIndex.build(
+        self.fps_by_filename, chunk_count=16)
+    self.assertEqual(self.index.filenames, sorted(self.fps_by_filename))
+
+  def test_iter_pairs(self):
+    fps = self.index.fps
+    for max_distance in (0, 15, 25, 40):
+      expected = []
+      for i in xrange(len(fps)):
+        for j in xrange(i + 1, len(fps)):
+          distance = get_distance(fps[i], fps[j])
+          if distance <= max_distance:
+            expected.append((distance, i, j))
+      self.assertTrue(expected)
+      self.assertEqual(list(self.index.iter_pairs(max_distance)), expected)
+
+  def test_find_neighbors(self):
+    rnd = random.Random(43)
+    fps = self.index.fps
+    for fp in fps[::7] + [rnd.getrandbits(256)]:
+      for max_distance in (0, 25, 40):
+        expected = sorted(
+            (get_distance(fp, fp2), i) for i, fp2 in enumerate(fps)
+            if get_distance(fp, fp2) <= max_distance)
+        self.assertEqual(self.index.find_neighbors(fp, max_distance),
+                         expected)
+
+  def test_save_load(self):
+    fd, filename = tempfile.mkstemp(prefix='xfidfp_index_test.', suffix='.xfi')
+    try:
+      os.close(fd)
+      for index in (self.index, xfidfp_index.FingerprintIndex.build({}, 16)):
+        index.save(filename)
+        index2 = xfidfp_index.FingerprintIndex.load(filename)
+        self.assertEqual(index2.filenames, index.filenames)
+        self.assertEqual(index2.fps, index.fps)
+        self.assertEqual(index2.chunks, index.chunks)
+        self.assertEqual(index2.offsets, index.offsets)
+        self.assertEqual(index2.ids, index.ids)
+        self.assertEqual(list(index2.iter_pairs()), list(index.iter_pairs()))
+    finally:
+      os.remove(filename)
+
+  def test_parse_fingerprint(self):
+    fp = self.index.fps[0]
+    encoded = ('%064x' % fp).decode('hex').encode('base64').replace('\n', '')
+    self.assertEqual(xfidfp_index.parse_fingerprint(encoded), fp)
+    self.assertEqual(xfidfp_index.parse_fingerprint(encoded[:-1] + 'A'), None)
+    self.assertEqual(xfidfp_index.parse_fingerprint('err'), None)
+
+  def test_bad_chunks(self):
+    self.assertEqual(xfidfp_index.MIN_CHUNK_COUNT, 11)
+    self.assertEqual(max(bit_count for _, bit_count in xfidfp_index.get_chunks(
+        xfidfp_index.MIN_CHUNK_COUNT)), xfidfp_index.MAX_CHUNK_BIT_COUNT)
+    for chunk_count in (-1, 0, 4, 10, 257):
+      self.assertRaises(SystemExit, xfidfp_index.main, (
+          'xfidfp_index.py', 'build', '--index=unused.xfi',
+          '--chunks=%d' % chunk_count))
+
+
+if __name__ == '__main__':
+  unittest.main(argv=[sys.argv[0], '-v'] + sys.argv[1:])